@@ -0,0 +1,204 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import os
+import numpy as np
+from corefunctions import csfFitParameters
+
+PARAMETER_HEADER = ["Name", "Session", "Peak Sensitivity", "Peak Frequency", "Width L", "Width R"]
+
+
+def readTestResults(filename):
+    """Read a subject's TestResults.csv file.
+
+    The first row holds the spatial frequencies tested and every
+    following row holds the sensitivities measured in one session.
+
+    Parameters:
+        filename (str): path to TestResults.csv
+
+    Returns:
+        sfs (array): spatial frequencies tested
+        sessions (list of arrays): contrast sensitivities, one array per session
+    """
+
+    with open(filename, 'r', newline='') as file:
+        rows = [row for row in csv.reader(file) if row]
+
+    if not rows:
+        return np.empty(0), []
+
+    sfs = np.asarray(rows[0], dtype = np.float64)
+    sessions = [np.asarray(row, dtype = np.float64) for row in rows[1:]]
+
+    return sfs, sessions
+
+
+def fitSubject(name, sfs, sessions, session_ids = None):
+    """Fit every session of one subject, warm starting each fit from the
+    previous session's parameters.
+
+    Parameters:
+        name (str): subject name
+        sfs (array or list of arrays): spatial frequencies tested, shared by every
+            session or one array per session
+        sessions (list of arrays): contrast sensitivities, one array per session
+        session_ids (list): session of each row of the table (default is its index)
+
+    Returns:
+        list: one [name, session, peak_sensitivity, peak_frequency, width_l, width_r]
+        row per session (parameters are NaN if the session could not be fit)
+    """
+
+    rows = []
+    x0 = None
+
+    if not isinstance(sfs, list):
+        sfs = [sfs]*len(sessions)
+    if session_ids is None:
+        session_ids = range(len(sessions))
+
+    for session, session_sfs, values in zip(session_ids, sfs, sessions):
+        valid = np.isfinite(values) & (values > 0)
+
+        if len(values) != len(session_sfs) or np.count_nonzero(valid) < 4:
+            rows.append([name, session, np.nan, np.nan, np.nan, np.nan])
+            continue
+
+        params = csfFitParameters(session_sfs[valid], values[valid], x0)
+        x0 = params
+        rows.append([name, session, *params])
+
+    return rows
+
+
+def _fitSubjectFile(task):
+    """Process pool entry point: read and fit a single TestResults.csv."""
+
+    name, filename = task
+    sfs, sessions = readTestResults(filename)
+
+    return fitSubject(name, sfs, sessions)
+
+
+def _fitStoreSubject(task):
+    """Process pool entry point: fit the sessions of one subject read from a results store."""
+
+    name, session_ids, sfs, sessions = task
+
+    return fitSubject(name, sfs, sessions, session_ids)
+
+
+def readStoreResults(store_file):
+    """Read the sessions with thresholds in a results store (see resultsstore.ResultsStore).
+
+    Returns:
+        list: one (name, session ids, sfs, sensitivities) task per subject, with
+        the sfs and sensitivities of each session as lists of arrays, oldest first
+    """
+
+    from resultsstore import ResultsStore
+
+    store = ResultsStore(store_file)
+    sessions = store.sessions()
+    ids, sfs, sensitivities = store.thresholds()
+    store.close()
+
+    # Measurements are ordered by session, so each session is one slice
+    session_ids, first, counts = np.unique(ids, return_index = True, return_counts = True)
+    measured = {int(session): slice(start, start + count) for session, start, count in zip(session_ids, first, counts)}
+
+    tasks = {}
+    for row in sessions:
+        if row["session"] in measured:
+            task = tasks.setdefault(row["name"], (row["name"], [], [], []))
+            task[1].append(row["session"])
+            task[2].append(sfs[measured[row["session"]]])
+            task[3].append(sensitivities[measured[row["session"]]])
+
+    return list(tasks.values())
+
+
+def findTestResults(results_dir = "Results"):
+    """List (name, path) pairs for every Results/<name>/TestResults.csv."""
+
+    tasks = []
+    for name in sorted(os.listdir(results_dir)):
+        filename = os.path.join(results_dir, name, "TestResults.csv")
+        if os.path.isfile(filename):
+            tasks.append((name, filename))
+
+    return tasks
+
+
+def csfBatchFit(results_dir = "Results", output_file = None, max_workers = None, store_file = None):
+    """Refit the CSF of every subject in a results directory, or in a results
+    store, in parallel and optionally write a consolidated parameter table.
+
+    Parameters:
+        results_dir (str): directory holding one sub-directory per subject
+        output_file (str): csv file to write the parameter table to (default is None, not written)
+        max_workers (int): number of worker processes (default is one per core)
+        store_file (str): results store database to refit instead of the csv files
+            in (results_dir); the new fits are also written back to the store
+
+    Returns:
+        list: parameter table rows (see PARAMETER_HEADER), with session ids as the
+        sessions of a store
+    """
+
+    if store_file is not None:
+        tasks, fitTask = readStoreResults(store_file), _fitStoreSubject
+    else:
+        tasks, fitTask = findTestResults(results_dir), _fitSubjectFile
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    # Hand each worker several subjects at a time to keep IPC overhead low
+    chunksize = max(1, len(tasks) // (max_workers * 4))
+
+    table = []
+    if tasks:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            for rows in executor.map(fitTask, tasks, chunksize = chunksize):
+                table.extend(rows)
+
+    if store_file is not None:
+        from resultsstore import ResultsStore
+
+        store = ResultsStore(store_file)
+        store.addFits({row[1]: row[2:] for row in table if np.all(np.isfinite(row[2:]))})
+        store.close()
+
+    if output_file is not None:
+        with open(output_file, 'w', newline='') as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(PARAMETER_HEADER)
+            csv_writer.writerows(table)
+
+    return table
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description = "Refit CSF parameters for every subject in a results directory.")
+    parser.add_argument("results_dir", nargs = "?", default = "Results",
+                        help = "directory containing <name>/TestResults.csv files")
+    parser.add_argument("-o", "--output", default = None,
+                        help = "output csv file (default is <results_dir>/FitParameters.csv)")
+    parser.add_argument("-j", "--workers", type = int, default = None,
+                        help = "number of worker processes (default is one per core)")
+    parser.add_argument("-s", "--store", default = None,
+                        help = "refit the sessions in this results store database instead of the csv files "
+                               "(e.g. Results/Results.db), updating its fits")
+    args = parser.parse_args()
+
+    output_file = args.output or os.path.join(args.results_dir, "FitParameters.csv")
+    table = csfBatchFit(args.results_dir, output_file, args.workers, args.store)
+
+    print(f"Fit {len(table)} sessions, parameters written to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,84 @@
-from corefunctions import (deg2pix, getScreenDims, createShaderProgram,
+from corefunctions import (ScreenGeometry, getShaderProgram, releaseShaderProgram,
                            genQuadWithTextureCoords, genVAOandVBOWithTextureCoords,
-                           genTextureFromImage, csfParabola, csfBestFit, pix2deg,
-                           getNyquist)
+                           getTexture, getTextureAtlas, releaseTexture, purgeTextures,
+                           makeWindowedGratingStack, pack10BitSigned)
+from qcsf import loadQuickCSF
+from stimuluslibrary import StimulusLibrary
+from frametiming import FrameTimingLog, FrameScheduler
+from triallog import TrialLog
+from norms import normStartValues
+from resultsplot import ResultsPlot
 import ctypes
 from OpenGL import GL
 from PyQt6.QtWidgets import QMessageBox
-from PyQt6.QtCore import QTimer, Qt, QUrl, pyqtSignal
+from PyQt6.QtCore import Qt, QUrl, pyqtSignal
 from PyQt6.QtMultimedia import QSoundEffect
 from PyQt6.QtOpenGL import QOpenGLWindow
 import numpy as np
 import numpy.random as random
 import time
+from math import ceil
 
-import matplotlib
-matplotlib.use('QtAgg')
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
-from matplotlib.figure import Figure
+## OpenGL Windows and Stimulus Classes ##
 
-import matplotlib.pyplot as plt
+# Images drawn small, packed (downscaled to UI_IMAGE_SIZE pixels) into one texture atlas shared
+# by the demo and test windows. Full screen instruction and feedback panels get their own textures.
+UI_IMAGES = ["Assets/fixation_hash.png"]
+UI_IMAGE_SIZE = 128
 
-## OpenGL Windows and Stimulus Classes ##
+# Stimulus location reported by each response key (Z means the stimulus wasn't seen)
+RESPONSE_KEYS = {Qt.Key.Key_Up: 0, Qt.Key.Key_Right: 1, Qt.Key.Key_Down: 2, Qt.Key.Key_Left: 3, Qt.Key.Key_Z: None}
+
+# Grating orientations and phases used by the test, which a GLStimulusBank prebuilds
+TEST_ORIENTATIONS = [0, 90]
+TEST_PHASES = [0, 45, 90, 135, 180, 225, 270, 315]
+
+# Stimulus bank layers built per frame while the instructions are up (one sf and orientation)
+BANK_LAYERS_PER_FRAME = len(TEST_PHASES)
 
 class GLImageStim:
 
-    def __init__(self, filename, width, height, x_offset = 0, y_offset = 0, subject_distance = 1000):
+    def __init__(self, filename, width, height, x_offset = 0, y_offset = 0, subject_distance = 1000, atlas = None, geometry = None):
+        """OpenGL image stimulus class. If (atlas) is a list of image files that
+        includes (filename), the image is drawn from the shared texture atlas
+        built from those files instead of its own texture."""
         
-        pixel_ratio, pixel_dims, physical_dims = getScreenDims()
+        if geometry is None:
+            geometry = ScreenGeometry.fromScreen(subject_distance)
 
-        if pixel_ratio > 1:
-            pixel_dims[0] /= pixel_ratio
-            pixel_dims[1] /= pixel_ratio
+        self.geometry = geometry
+        pixel_dims = geometry.pixel_dims
 
         self.filename = filename
         self.width = width
         self.height = height
         self.subject_distance = subject_distance
-        self.x_offset = deg2pix(x_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.y_offset = deg2pix(y_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
+        self.x_offset = geometry.ecc2pix(x_offset)
+        self.y_offset = geometry.ecc2pix(y_offset)
 
-        self.quad_width = deg2pix(self.width, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.quad_height = deg2pix(self.height, self.subject_distance, physical_dims[0], pixel_dims[0])
+        self.quad_width = geometry.deg2pix(self.width)
+        self.quad_height = geometry.deg2pix(self.height)
+
+        # Textures are shared with every other stim using the same image or atlas
+        self.texture = None
+        tex_coords = (0.0, 0.0, 1.0, 1.0)
+
+        if atlas is not None and self.filename in atlas:
+            self.texture, regions = getTextureAtlas(atlas, max_image_size = UI_IMAGE_SIZE)
+            if self.texture is not None:
+                tex_coords = regions[self.filename]
+
+        if self.texture is None:
+            self.texture = getTexture(self.filename)
 
         self.vertices, self.vertex_count = genQuadWithTextureCoords(self.quad_width, self.quad_height, pixel_dims[0], 
-                                                              pixel_dims[1], self.x_offset, self.y_offset)
-        
-        self.texture = genTextureFromImage(self.filename)
+                                                              pixel_dims[1], self.x_offset, self.y_offset, tex_coords)
         
         # Create vao and vbo
         self.vao, self.vbo = genVAOandVBOWithTextureCoords(self.vertices)
 
         # Create shader program
-        self.shader_program = createShaderProgram("Shaders/vertex_shader.txt", "Shaders/image_frag_shader.txt")
+        self.shader_program = getShaderProgram("Shaders/vertex_shader.txt", "Shaders/image_frag_shader.txt")
         self.tex_uniform = GL.glGetUniformLocation(self.shader_program, "imageTexture")
 
         GL.glUseProgram(self.shader_program)
@@ -67,23 +95,24 @@ class GLImageStim:
     def destroy(self):
         GL.glDeleteBuffers(1, ctypes.byref(self.vbo))
         GL.glDeleteVertexArrays(1, ctypes.byref(self.vao))
-        GL.glDeleteProgram(self.shader_program)
+        releaseShaderProgram(self.shader_program)
+        releaseTexture(self.texture)
 
 
 class GLMaskStim:
-    def __init__(self, size = 3, x_offset = 0, y_offset = 0, subject_distance = 1000):
+    def __init__(self, size = 3, x_offset = 0, y_offset = 0, subject_distance = 1000, geometry = None):
 
-        pixel_ratio, pixel_dims, physical_dims = getScreenDims()
+        if geometry is None:
+            geometry = ScreenGeometry.fromScreen(subject_distance)
 
-        if pixel_ratio > 1:
-            pixel_dims[0] /= pixel_ratio
-            pixel_dims[1] /= pixel_ratio
+        self.geometry = geometry
+        pixel_dims = geometry.pixel_dims
 
         self.size = size
         self.subject_distance = subject_distance
-        self.x_offset = deg2pix(x_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.y_offset = deg2pix(y_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.quad_size = deg2pix(self.size, self.subject_distance, physical_dims[0], pixel_dims[0])
+        self.x_offset = geometry.ecc2pix(x_offset)
+        self.y_offset = geometry.ecc2pix(y_offset)
+        self.quad_size = geometry.deg2pix(self.size)
 
         self.vertices, self.vertex_count = genQuadWithTextureCoords(quad_width = self.quad_size,
                                                                quad_height = self.quad_size,
@@ -96,7 +125,7 @@ class GLMaskStim:
         self.vao, self.vbo = genVAOandVBOWithTextureCoords(self.vertices)
 
         # Create shader program
-        self.shader_program = createShaderProgram("Shaders/vertex_shader.txt", "Shaders/mask_frag_shader.txt")
+        self.shader_program = getShaderProgram("Shaders/vertex_shader.txt", "Shaders/mask_frag_shader.txt")
 
         GL.glUseProgram(self.shader_program)
 
@@ -109,22 +138,22 @@ class GLMaskStim:
     def destroy(self):
         GL.glDeleteBuffers(1, ctypes.byref(self.vbo))
         GL.glDeleteVertexArrays(1, ctypes.byref(self.vao))
-        GL.glDeleteProgram(self.shader_program)
+        releaseShaderProgram(self.shader_program)
 
 class GLCircleStim:
-    def __init__(self, size = 4, x_offset = 0, y_offset = 0, subject_distance = 1000):
+    def __init__(self, size = 4, x_offset = 0, y_offset = 0, subject_distance = 1000, geometry = None):
 
-        pixel_ratio, pixel_dims, physical_dims = getScreenDims()
+        if geometry is None:
+            geometry = ScreenGeometry.fromScreen(subject_distance)
 
-        if pixel_ratio > 1:
-            pixel_dims[0] /= pixel_ratio
-            pixel_dims[1] /= pixel_ratio
+        self.geometry = geometry
+        pixel_dims = geometry.pixel_dims
 
         self.size = size
         self.subject_distance = subject_distance
-        self.x_offset = deg2pix(x_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.y_offset = deg2pix(y_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.quad_size = deg2pix(self.size, self.subject_distance, physical_dims[0], pixel_dims[0])
+        self.x_offset = geometry.ecc2pix(x_offset)
+        self.y_offset = geometry.ecc2pix(y_offset)
+        self.quad_size = geometry.deg2pix(self.size)
 
         self.vertices, self.vertex_count = genQuadWithTextureCoords(quad_width = self.quad_size,
                                                                quad_height = self.quad_size,
@@ -137,7 +166,7 @@ class GLCircleStim:
         self.vao, self.vbo = genVAOandVBOWithTextureCoords(self.vertices)
 
         # Create shader program
-        self.shader_program = createShaderProgram("Shaders/vertex_shader.txt", "Shaders/circle_frag_shader.txt")
+        self.shader_program = getShaderProgram("Shaders/vertex_shader.txt", "Shaders/circle_frag_shader.txt")
 
         GL.glUseProgram(self.shader_program)
 
@@ -150,35 +179,35 @@ class GLCircleStim:
     def destroy(self):
         GL.glDeleteBuffers(1, ctypes.byref(self.vbo))
         GL.glDeleteVertexArrays(1, ctypes.byref(self.vao))
-        GL.glDeleteProgram(self.shader_program)
+        releaseShaderProgram(self.shader_program)
 
 
 class GLGratingStim:
 
     def __init__(self, size = 4, x_offset = 0, y_offset = 0, subject_distance = 1000,
-                 sf = 4, ori = 0, contrast = 0.1, phase = 0, sd = 0.15, wave = 'sin'):
+                 sf = 4, ori = 0, contrast = 0.1, phase = 0, sd = 0.15, wave = 'sin', geometry = None):
         
         """OpenGL gabor stimulus class with given size, location, spatial frequency, orientation
         contrast, and phase."""
 
-        pixel_ratio, pixel_dims, physical_dims = getScreenDims()
+        if geometry is None:
+            geometry = ScreenGeometry.fromScreen(subject_distance)
 
-        if pixel_ratio > 1:
-            pixel_dims[0] /= pixel_ratio
-            pixel_dims[1] /= pixel_ratio
+        self.geometry = geometry
+        pixel_dims = geometry.pixel_dims
 
         self.wave = wave
         self.size = size
         self.sd = sd
         self.sf = sf
         self.subject_distance = subject_distance
-        self.x_offset = deg2pix(x_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
-        self.y_offset = deg2pix(y_offset, self.subject_distance, physical_dims[0], pixel_dims[0])
+        self.x_offset = geometry.ecc2pix(x_offset)
+        self.y_offset = geometry.ecc2pix(y_offset)
         self.ori = ori
         self.contrast = contrast
         self.phase = phase
 
-        self.quad_size = deg2pix(self.size, self.subject_distance, physical_dims[0], pixel_dims[0])
+        self.quad_size = geometry.deg2pix(self.size)
 
         self.vertices, self.vertex_count = genQuadWithTextureCoords(quad_width = self.quad_size,
                                                                quad_height = self.quad_size,
@@ -192,9 +221,9 @@ class GLGratingStim:
 
         # Create shader program and requisite uniform variables for stim creation
         if self.wave == 'sqr':
-            self.shader_program = createShaderProgram("Shaders/vertex_shader.txt", "Shaders/square_wave_frag_shader.txt")
+            self.shader_program = getShaderProgram("Shaders/vertex_shader.txt", "Shaders/square_wave_frag_shader.txt")
         else:
-            self.shader_program = createShaderProgram("Shaders/vertex_shader.txt", "Shaders/gabor_frag_shader.txt")
+            self.shader_program = getShaderProgram("Shaders/vertex_shader.txt", "Shaders/gabor_frag_shader.txt")
 
         self.u_orientation = GL.glGetUniformLocation(self.shader_program, "u_orientation")
         self.u_contrast = GL.glGetUniformLocation(self.shader_program, "u_contrast")
@@ -203,21 +232,253 @@ class GLGratingStim:
 
         self.sf *= self.size
 
+    def setParams(self, sf = None, ori = None, phase = None, contrast = None):
+        """Update the grating parameters (sf is in cycles per stimulus). The shader
+        program is shared with other gratings, so the values are uploaded when drawn."""
+
+        if sf is not None:
+            self.sf = sf
+        if ori is not None:
+            self.ori = ori
+        if phase is not None:
+            self.phase = phase
+        if contrast is not None:
+            self.contrast = contrast
+
+    def use(self):
         GL.glUseProgram(self.shader_program)
         GL.glUniform1f(self.u_orientation, self.ori)
         GL.glUniform1f(self.u_contrast, self.contrast)
         GL.glUniform1f(self.u_sf, self.sf)
         GL.glUniform1f(self.u_phase, self.phase)
+        GL.glBindVertexArray(self.vao)
+        GL.glDrawArrays(GL.GL_TRIANGLES, 0, self.vertex_count)
+
+    def destroy(self):
+        GL.glDeleteBuffers(1, ctypes.byref(self.vbo))
+        GL.glDeleteVertexArrays(1, ctypes.byref(self.vao))
+        releaseShaderProgram(self.shader_program)
+
+
+class GLGratingBatch:
+
+    def __init__(self, positions, size = 4, subject_distance = 1000, sf = 4, ori = 0, contrast = 0.1,
+                 phase = 0, wave = 'sin', geometry = None, bank = None):
+
+        """OpenGL renderer for several gabor stimuli of the same size that share one
+        quad and are drawn with a single instanced draw call. Each location (x, y)
+        in degrees in (positions) has its own spatial frequency, orientation, phase,
+        contrast and visibility; hidden locations are drawn at zero contrast.
+
+        With a GLStimulusBank (bank), gratings are looked up from its prebuilt
+        textures instead of computed per fragment, and every sf, ori and phase
+        passed to setParams must be one the bank holds."""
+
+        if geometry is None:
+            geometry = ScreenGeometry.fromScreen(subject_distance)
+
+        self.geometry = geometry
+        pixel_dims = geometry.pixel_dims
+
+        self.wave = wave
+        self.size = size
+        self.subject_distance = subject_distance
+        self.bank = bank
+        self.num_instances = len(positions)
+        self.quad_size = geometry.deg2pix(self.size)
+
+        self.vertices, self.vertex_count = genQuadWithTextureCoords(quad_width = self.quad_size,
+                                                               quad_height = self.quad_size,
+                                                               screen_width = pixel_dims[0],
+                                                               screen_height = pixel_dims[1])
+
+        # Per-instance [x offset, y offset, sf, orientation, phase, contrast, visible, bank layer]
+        self.instances = np.zeros((self.num_instances, 8), dtype = np.float32)
+        for i, (x_offset, y_offset) in enumerate(positions):
+            self.instances[i, 0] = 2*geometry.ecc2pix(x_offset)/pixel_dims[0]
+            self.instances[i, 1] = 2*geometry.ecc2pix(y_offset)/pixel_dims[1]
+        self.instances[:, 2] = sf*self.size
+        self.instances[:, 3] = ori
+        self.instances[:, 4] = phase
+        self.instances[:, 5] = contrast
+
+        # Full precision [sf, orientation, phase] of every location, the bank is
+        # looked up with these rather than the float32 values in (instances)
+        self.gratings = np.zeros((self.num_instances, 3), dtype = np.float64)
+        self.gratings[:] = [sf*self.size, ori, phase]
+
+        # Create vao and vbo for the shared quad, then the instance buffer
+        self.vao, self.vbo = genVAOandVBOWithTextureCoords(self.vertices)
+
+        self.instance_vbo = GL.GLuint()
+        GL.glGenBuffers(1, ctypes.byref(self.instance_vbo))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.instance_vbo)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, self.instances.nbytes, self.instances, GL.GL_DYNAMIC_DRAW)
+
+        for location, count, offset in [(2, 2, 0), (3, 4, 8), (4, 1, 24), (5, 1, 28)]:
+            GL.glVertexAttribPointer(location, count, GL.GL_FLOAT, GL.GL_FALSE, self.instances.strides[0],
+                                     ctypes.c_void_p(offset))
+            GL.glEnableVertexAttribArray(location)
+            GL.glVertexAttribDivisor(location, 1)
+
+        self.dirty = False
+
+        # Create shader program
+        if self.bank is not None:
+            self.shader_program = getShaderProgram("Shaders/instanced_vertex_shader.txt", "Shaders/instanced_bank_frag_shader.txt")
+            GL.glUseProgram(self.shader_program)
+            GL.glUniform1i(GL.glGetUniformLocation(self.shader_program, "u_bank"), 0)
+        elif self.wave == 'sqr':
+            self.shader_program = getShaderProgram("Shaders/instanced_vertex_shader.txt", "Shaders/instanced_square_wave_frag_shader.txt")
+        else:
+            self.shader_program = getShaderProgram("Shaders/instanced_vertex_shader.txt", "Shaders/instanced_gabor_frag_shader.txt")
+
+    def setParams(self, index, sf = None, ori = None, phase = None, contrast = None):
+        """Update the grating parameters of one location (sf is in cycles per stimulus)."""
+
+        for column, value in ((2, sf), (3, ori), (4, phase), (5, contrast)):
+            if value is not None:
+                self.instances[index, column] = value
+                if column < 5:
+                    self.gratings[index, column - 2] = value
+
+        if self.bank is not None and (sf is not None or ori is not None or phase is not None):
+            self.instances[index, 7] = self.bank.layer(*self.gratings[index])
+
+        self.dirty = True
+
+    def setVisible(self, index, visible):
+        if self.instances[index, 6] != visible:
+            self.instances[index, 6] = visible
+            self.dirty = True
+
+    def instance(self, index):
+        """Stim-like handle for one location, see GLGratingInstance."""
+        return GLGratingInstance(self, index)
 
     def use(self):
-        GL.glUseProgram(self.shader_program)
         GL.glBindVertexArray(self.vao)
-        GL.glDrawArrays(GL.GL_TRIANGLES, 0, self.vertex_count)
+
+        # Only re-upload the instance buffer when something changed
+        if self.dirty:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.instance_vbo)
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, self.instances.nbytes, self.instances)
+            self.dirty = False
+
+        if self.bank is not None:
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+            GL.glBindTexture(GL.GL_TEXTURE_2D_ARRAY, self.bank.texture)
+
+        GL.glUseProgram(self.shader_program)
+        GL.glDrawArraysInstanced(GL.GL_TRIANGLES, 0, self.vertex_count, self.num_instances)
 
     def destroy(self):
         GL.glDeleteBuffers(1, ctypes.byref(self.vbo))
+        GL.glDeleteBuffers(1, ctypes.byref(self.instance_vbo))
         GL.glDeleteVertexArrays(1, ctypes.byref(self.vao))
-        GL.glDeleteProgram(self.shader_program)
+        releaseShaderProgram(self.shader_program)
+
+
+class GLStimulusBank:
+
+    def __init__(self, sfs, oris = TEST_ORIENTATIONS, phases = TEST_PHASES, size = 256, wave = 'sin', library = None):
+
+        """Every grating a session can show, prebuilt as the layers of one GL_RGB10_A2
+        array texture: each spatial frequency in (sfs) (cycles per stimulus) at every
+        orientation in (oris) and phase in (phases), (size x size) pixels each.
+        Layers hold the windowed grating before contrast (see makeWindowedGrating)
+        so GLGratingBatch applies contrast as a single scale. The texture storage is
+        allocated here, and the layers are filled by buildNext, a few per frame.
+        With a StimulusLibrary (see makePackedGrating) in (library), layers are
+        uploaded straight from the library file, so they are only generated the
+        first time a station uses them."""
+
+        self.size = size
+        self.wave = wave
+        self.library = library
+        # Layers sharing an sf and orientation are adjacent so they are generated together
+        self.keys = [(sf, ori, phase) for ori in oris for sf in sfs for phase in phases]
+        self.layers = {self.key(*key): i for i, key in enumerate(self.keys)}
+        self.num_built = 0
+
+        self.texture = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(self.texture))
+        GL.glBindTexture(GL.GL_TEXTURE_2D_ARRAY, self.texture)
+
+        GL.glTexParameteri(GL.GL_TEXTURE_2D_ARRAY, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D_ARRAY, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D_ARRAY, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D_ARRAY, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+
+        GL.glTexImage3D(GL.GL_TEXTURE_2D_ARRAY, 0, GL.GL_RGB10_A2, size, size, len(self.keys), 0,
+                        GL.GL_RGBA, GL.GL_UNSIGNED_INT_2_10_10_10_REV, None)
+
+    def key(self, sf, ori, phase):
+        return (round(float(sf), 6), round(float(ori) % 360, 6), round(float(phase) % 360, 6))
+
+    def layer(self, sf, ori, phase):
+        """Texture layer holding the grating with (sf, ori, phase)."""
+
+        try:
+            return self.layers[self.key(sf, ori, phase)]
+        except KeyError:
+            raise ValueError(f"Stimulus bank has no grating with sf {sf}, ori {ori} and phase {phase}")
+
+    def finished(self):
+        return self.num_built == len(self.keys)
+
+    def buildNext(self, count = 1):
+        """Generate and upload the next (count) layers. Returns True once every layer is built."""
+
+        last = min(self.num_built + count, len(self.keys))
+        if self.num_built < last:
+            GL.glBindTexture(GL.GL_TEXTURE_2D_ARRAY, self.texture)
+            GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+
+        if self.library is not None:
+            views = self.library.getMany([(self.size, sf, ori, phase, 1.0, self.wave)
+                                          for sf, ori, phase in self.keys[self.num_built:last]])
+            for layer, pixels in enumerate(views, self.num_built):
+                GL.glTexSubImage3D(GL.GL_TEXTURE_2D_ARRAY, 0, 0, 0, layer, self.size, self.size, 1,
+                                   GL.GL_RGBA, GL.GL_UNSIGNED_INT_2_10_10_10_REV, pixels)
+
+            self.num_built = last
+            return self.finished()
+
+        # Generate each run of layers with the same sf and orientation as one stack
+        first = self.num_built
+        while first < last:
+            sf, ori, phase = self.keys[first]
+            end = first
+            while end < last and self.keys[end][:2] == (sf, ori):
+                end += 1
+
+            phases = [key[2] for key in self.keys[first:end]]
+            pixels = pack10BitSigned(makeWindowedGratingStack(self.size, [sf], phases, ori, self.wave))
+            GL.glTexSubImage3D(GL.GL_TEXTURE_2D_ARRAY, 0, 0, 0, first, self.size, self.size, end - first,
+                               GL.GL_RGBA, GL.GL_UNSIGNED_INT_2_10_10_10_REV, pixels)
+            first = end
+
+        self.num_built = last
+
+        return self.finished()
+
+    def buildAll(self):
+        return self.buildNext(len(self.keys) - self.num_built)
+
+    def destroy(self):
+        GL.glDeleteTextures(1, ctypes.byref(self.texture))
+
+
+class GLGratingInstance:
+    """One location of a GLGratingBatch, with the same setParams interface as GLGratingStim."""
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def setParams(self, sf = None, ori = None, phase = None, contrast = None):
+        self.batch.setParams(self.index, sf = sf, ori = ori, phase = phase, contrast = contrast)
 
 
 class GL_CSFDemoWindow(QOpenGLWindow):
@@ -244,35 +505,32 @@ class GL_CSFDemoWindow(QOpenGLWindow):
 
         GL.glClearColor(0.5**(1/2.42), 0.5**(1/2.42), 0.5**(1/2.42), 1.0)
 
-        pixel_ratio, pixel_dims, physical_dims = getScreenDims()
-
-        if pixel_ratio > 1:
-            pixel_dims[0] /= pixel_ratio
-            pixel_dims[1] /= pixel_ratio
-
-        degree_dims = [pix2deg(pixel_dims[0], self.subject_distance, physical_dims[0], pixel_dims[0]), 
-                       pix2deg(pixel_dims[1], self.subject_distance, physical_dims[0], pixel_dims[0])]
+        # Screen geometry is queried once and shared by every stim in the window
+        self.geometry = ScreenGeometry.fromScreen(self.subject_distance)
+        degree_dims = self.geometry.degree_dims
 
         if self.context().format().redBufferSize() == 8:
             QMessageBox.critical(None, "Color Depth Warning", """Currently running in 8-bit color mode.
                                 Maximum contrast limited!""", QMessageBox.StandardButton.Ok)
 
-        # Create controller classes
-        self.demoController = DemoController(num_stims=4)
+        # Create controller classes, timed in display frames
+        self.scheduler = FrameScheduler(self.screen().refreshRate())
+        self.demoController = DemoController(self.scheduler, num_stims=4)
         
         # Generate gabors and fixation
-        self.top_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = 0, y_offset = self.eccentricity)
-        self.bottom_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = 0, y_offset = -self.eccentricity)
-        self.right_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = self.eccentricity, y_offset = 0)
-        self.left_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = -self.eccentricity, y_offset = 0)
-
-        self.fixation = GLImageStim("Assets/fixation_hash.png", width = 0.5, height = 0.5, subject_distance = self.subject_distance)
-        self.explanation = GLImageStim("Assets/explanation_window.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance)
-        self.press_space = GLImageStim("Assets/begin_demo.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance)
-        self.correct_message = GLImageStim("Assets/correct.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance)
-        self.wrong_message = GLImageStim("Assets/wrong.png", width = degree_dims[1], height = degree_dims[1], subject_distance=self.subject_distance)
-
-        # Sync screen repaint to vertical refresh rate
+        self.top_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = 0, y_offset = self.eccentricity, geometry = self.geometry)
+        self.bottom_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = 0, y_offset = -self.eccentricity, geometry = self.geometry)
+        self.right_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = self.eccentricity, y_offset = 0, geometry = self.geometry)
+        self.left_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = -self.eccentricity, y_offset = 0, geometry = self.geometry)
+
+        self.fixation = GLImageStim("Assets/fixation_hash.png", width = 0.5, height = 0.5, subject_distance = self.subject_distance, atlas = UI_IMAGES, geometry = self.geometry)
+        self.explanation = GLImageStim("Assets/explanation_window.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance, geometry = self.geometry)
+        self.press_space = GLImageStim("Assets/begin_demo.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance, geometry = self.geometry)
+        self.correct_message = GLImageStim("Assets/correct.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance, geometry = self.geometry)
+        self.wrong_message = GLImageStim("Assets/wrong.png", width = degree_dims[1], height = degree_dims[1], subject_distance=self.subject_distance, geometry = self.geometry)
+
+        # Sync screen repaint to vertical refresh rate, advancing the scheduler before each repaint
+        self.frameSwapped.connect(self.scheduler.advance)
         self.frameSwapped.connect(self.update)
 
         self.correct = 0
@@ -409,50 +667,15 @@ class GL_CSFDemoWindow(QOpenGLWindow):
             self.YN_active = True
 
     def shuffleAttributes(self):
-        # shuffle contrast
+        # shuffle contrast and sf, vertical gratings above and below fixation, horizontal to the sides
         contrast = random.choice([0.08, 0.16, 0.32, 0.64])
-
-        GL.glUseProgram(self.top_gabor.shader_program)
-        GL.glUniform1f(self.top_gabor.u_contrast, contrast)
-
-        GL.glUseProgram(self.bottom_gabor.shader_program)
-        GL.glUniform1f(self.bottom_gabor.u_contrast, contrast)
-
-        GL.glUseProgram(self.right_gabor.shader_program)
-        GL.glUniform1f(self.right_gabor.u_contrast, contrast)
-
-        GL.glUseProgram(self.left_gabor.shader_program)
-        GL.glUniform1f(self.left_gabor.u_contrast, contrast)
-
-        # set orientation
-
-        GL.glUseProgram(self.top_gabor.shader_program)
-        GL.glUniform1f(self.top_gabor.u_orientation, 0)
-
-        GL.glUseProgram(self.bottom_gabor.shader_program)
-        GL.glUniform1f(self.bottom_gabor.u_orientation, 0)
-
-        GL.glUseProgram(self.right_gabor.shader_program)
-        GL.glUniform1f(self.right_gabor.u_orientation, 90)
-
-        GL.glUseProgram(self.left_gabor.shader_program)
-        GL.glUniform1f(self.left_gabor.u_orientation, 90)
-
-        # shuffle sf
         sf = random.choice([2, 4, 6, 8, 16])
         sf = sf*self.stim_size
 
-        GL.glUseProgram(self.top_gabor.shader_program)
-        GL.glUniform1f(self.top_gabor.u_sf, sf)
-
-        GL.glUseProgram(self.bottom_gabor.shader_program)
-        GL.glUniform1f(self.bottom_gabor.u_sf, sf)
-
-        GL.glUseProgram(self.left_gabor.shader_program)
-        GL.glUniform1f(self.left_gabor.u_sf, sf)
-
-        GL.glUseProgram(self.right_gabor.shader_program)
-        GL.glUniform1f(self.right_gabor.u_sf, sf)
+        self.top_gabor.setParams(sf = sf, ori = 0, contrast = contrast)
+        self.bottom_gabor.setParams(sf = sf, ori = 0, contrast = contrast)
+        self.right_gabor.setParams(sf = sf, ori = 90, contrast = contrast)
+        self.left_gabor.setParams(sf = sf, ori = 90, contrast = contrast)
 
     def close(self):
         self.top_gabor.destroy()
@@ -464,92 +687,114 @@ class GL_CSFDemoWindow(QOpenGLWindow):
         self.press_space.destroy()
         self.wrong_message.destroy()
         self.correct_message.destroy()
+        purgeTextures()
         super().close()
 
 
 class GL_CSFTestWindow(QOpenGLWindow):
 
-    finished=pyqtSignal(dict)
+    # Emitted with the thresholds and the staircase reversal values measured at each spatial frequency
+    finished=pyqtSignal(dict, dict)
 
-    def __init__(self, subject_distance, stim_duration = 250, stim_size = 2, eccentricity = 2, parent=None):
+    def __init__(self, subject_distance, stim_duration = 250, stim_size = 2, eccentricity = 2, method = "staircase",
+                 timing_file = None, trial_file = None, stimulus_bank = False, expected_thresholds = None, parent=None):
         super(GL_CSFTestWindow, self).__init__(parent)
         self.subject_distance = subject_distance
         self.eccentricity = eccentricity
         self.stim_size = stim_size
         self.duration = stim_duration
+        self.method = method
+        self.timing_file = timing_file
+        self.trial_file = trial_file
+        self.stimulus_bank = stimulus_bank
+        self.expected_thresholds = expected_thresholds
         self.confirmation_beep = QSoundEffect()
         self.confirmation_beep.setSource(QUrl.fromLocalFile("Assets/confirmation.wav"))
 
-        self.keyPressTimer = QTimer()
-        self.keyPressTimer.setTimerType(Qt.TimerType.PreciseTimer)
-        self.keyPressTimer.setSingleShot(True)
-        self.keyPressTimer.setInterval(1750)
-        self.keyPressTimer.timeout.connect(self.activateArrows)
-
     def initializeGL(self) -> None:
 
-        self.spaceActive = True
-        self.arrowsActive = False
+        # Screen geometry is queried once and shared by every stim in the window
+        geometry = ScreenGeometry.fromScreen(self.subject_distance)
 
-        self.first_page = True
-        self.show_stim = False
-        self.show_fixation = False
-
-        GL.glClearColor(0.5**(1/2.42), 0.5**(1/2.42), 0.5**(1/2.42), 1.0)
+        if self.context().format().redBufferSize() == 8:
+            QMessageBox.critical(None, "Color Depth Warning", """Currently running in 8-bit color mode.
+                                Maximum contrast limited!""", QMessageBox.StandardButton.Ok)
 
-        pixel_ratio, pixel_dims, physical_dims = getScreenDims()
-        nyquist = getNyquist(physical_dims[0], pixel_dims[0], self.subject_distance)
-        print(nyquist)
+        self.initializeStims(geometry, self.screen().refreshRate())
 
-        if pixel_ratio > 1:
-            pixel_dims[0] /= pixel_ratio
-            pixel_dims[1] /= pixel_ratio
+        # Sync screen repaint to vertical refresh rate, timestamp every swapped frame
+        # and advance the stimulus schedule before the next repaint
+        self.frameSwapped.connect(self.frameLog.frameSwapped)
+        self.frameSwapped.connect(self.scheduler.advance)
+        self.frameSwapped.connect(self.update)
 
-        degree_dims = [pix2deg(pixel_dims[0], self.subject_distance, physical_dims[0], pixel_dims[0]), 
-                       pix2deg(pixel_dims[1], self.subject_distance, physical_dims[0], pixel_dims[0])]
+        # Set display to full screen
+        self.showFullScreen()
 
-        if self.context().format().redBufferSize() == 8:
-            QMessageBox.critical(None, "Color Depth Warning", """Currently running in 8-bit color mode.
-                                Maximum contrast limited!""", QMessageBox.StandardButton.Ok)
-        
-        # Generate gabors and fixation
-        self.top_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = 0, y_offset = self.eccentricity)
-        self.bottom_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = 0, y_offset = -self.eccentricity)
-        self.right_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = self.eccentricity, y_offset = 0)
-        self.left_gabor = GLGratingStim(size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0, x_offset = -self.eccentricity, y_offset = 0)
+    def initializeStims(self, geometry, refresh_rate):
+        """Create the stims, controllers and frame log for (geometry) in the current
+        OpenGL context. Needs no screen, so it is also used by offscreen.OffscreenRenderer."""
 
-        self.fixation = GLImageStim("Assets/fixation_hash.png", width = 0.5, height = 0.5, subject_distance = self.subject_distance)
-        self.explanation = GLImageStim("Assets/start_window.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance)
-        self.break_time = GLImageStim("Assets/break_time.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance)
-        self.test_over = GLImageStim("Assets/all_done.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance)
+        self.state = "instructions"
 
-        self.top_mask = GLMaskStim(size = self.stim_size, subject_distance = self.subject_distance, x_offset = 0, y_offset = self.eccentricity)
-        self.bottom_mask = GLMaskStim(size = self.stim_size, subject_distance = self.subject_distance, x_offset = 0, y_offset = -self.eccentricity)
-        self.right_mask = GLMaskStim(size = self.stim_size, subject_distance = self.subject_distance, x_offset = self.eccentricity, y_offset = 0)
-        self.left_mask = GLMaskStim(size = self.stim_size, subject_distance=self.subject_distance, x_offset = -self.eccentricity, y_offset = 0)
+        GL.glClearColor(0.5**(1/2.42), 0.5**(1/2.42), 0.5**(1/2.42), 1.0)
 
+        self.geometry = geometry
+        nyquist = self.geometry.nyquist
+        print(nyquist)
+        degree_dims = self.geometry.degree_dims
+        
         # Create controller classes
-        self.trialHandler = TrialHandler(stim_size = self.stim_size)
+        if self.method == "qcsf":
+            self.trialHandler = QuickCSFTrialHandler(stim_size = self.stim_size)
+        else:
+            self.trialHandler = TrialHandler(stim_size = self.stim_size, expectedThresholds = self.expected_thresholds)
         
         if self.trialHandler.sfMax > nyquist:
             raise ValueError("Max spatial frequency exceeds nyquist limit for this display and disatnce")
-        
-        self.displayHandler = DisplayHandler(num_stims = 4, stim_duration = self.duration, pre_stim_interval=1500)
 
-        # Add all shaders and uniforms to list
-
-        self.gabor_shaders = [self.top_gabor.shader_program,
-                                self.right_gabor.shader_program,
-                                self.bottom_gabor.shader_program,
-                                self.left_gabor.shader_program]
+        # Optionally prebuild every grating of the session at the stim's device pixel size
+        self.bank = None
+        if self.stimulus_bank:
+            # Gratings are kept in the stimulus library between sessions, generated here if it can't be opened
+            try:
+                library = StimulusLibrary()
+            except (OSError, ValueError):
+                library = None
+
+            self.bank = GLStimulusBank(self.trialHandler.SFs*self.stim_size,
+                                       size = ceil(self.geometry.deg2pix(self.stim_size)*self.geometry.pixel_ratio),
+                                       library = library)
+
+            # Every grating the trial handler can ask for must have a layer (raises ValueError
+            # here rather than in the middle of the session)
+            for sf in self.trialHandler.SFs*self.stim_size:
+                for ori in TEST_ORIENTATIONS:
+                    for phase in TEST_PHASES:
+                        self.bank.layer(sf, ori, phase)
+
+        # Generate gabors at the top, right, bottom and left locations (drawn in one batch) and fixation
+        self.gratings = GLGratingBatch([(0, self.eccentricity), (self.eccentricity, 0), (0, -self.eccentricity), (-self.eccentricity, 0)],
+                                       size = self.stim_size, subject_distance = self.subject_distance, sf = 1, contrast = 0.5, phase = 0, ori = 0,
+                                       geometry = self.geometry, bank = self.bank)
+
+        self.fixation = GLImageStim("Assets/fixation_hash.png", width = 0.5, height = 0.5, subject_distance = self.subject_distance, atlas = UI_IMAGES, geometry = self.geometry)
+        self.explanation = GLImageStim("Assets/start_window.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance, geometry = self.geometry)
+        self.break_time = GLImageStim("Assets/break_time.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance, geometry = self.geometry)
+        self.test_over = GLImageStim("Assets/all_done.png", width = degree_dims[1], height = degree_dims[1], subject_distance = self.subject_distance, geometry = self.geometry)
         
-        self.gabor_uniforms = [[self.top_gabor.u_sf, self.top_gabor.u_orientation, self.top_gabor.u_phase, self.top_gabor.u_contrast],
-                               [self.right_gabor.u_sf, self.right_gabor.u_orientation, self.right_gabor.u_phase, self.right_gabor.u_contrast],
-                               [self.bottom_gabor.u_sf, self.bottom_gabor.u_orientation, self.right_gabor.u_phase, self.bottom_gabor.u_contrast],
-                               [self.left_gabor.u_sf, self.left_gabor.u_orientation, self.left_gabor.u_phase, self.bottom_gabor.u_contrast]]
+        self.scheduler = FrameScheduler(refresh_rate)
+        self.frameLog = FrameTimingLog(refresh_rate = refresh_rate)
+        self.displayHandler = DisplayHandler(num_stims = 4, stim_duration = self.duration, scheduler = self.scheduler, pre_stim_interval=1500,
+                                             stim_onset = self.stimOnset, stim_offset = self.stimOffset, frame_log = self.frameLog)
 
-        # Sync screen repaint to vertical refresh rate
-        self.frameSwapped.connect(self.update)
+        # Gabors in the order used for stimulus locations
+        self.gabors = [self.gratings.instance(i) for i in range(4)]
+
+        # Every trial is written to disk by a background thread
+        self.trialLog = None
+        if self.trial_file is not None:
+            self.trialLog = TrialLog(self.trial_file)
 
         self.userInput = None
 
@@ -557,184 +802,142 @@ class GL_CSFTestWindow(QOpenGLWindow):
         GL.glEnable(GL.GL_BLEND)
         GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
 
-        # Set display to full screen
-        self.showFullScreen()
-
     def resizeGL(self, w: int, h: int) -> None:
         return super().resizeGL(w, h)
     
     def paintGL(self) -> None:
         GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+        visible = 0
+
+        # The stimulus bank is built a layer at a time behind the instructions,
+        # and any layers left when the test starts are built at once
+        if self.bank is not None and not self.bank.finished():
+            if self.state == "instructions":
+                self.bank.buildNext(BANK_LAYERS_PER_FRAME)
+            else:
+                self.bank.buildAll()
 
-        if self.trialHandler.trialOver:
+        if self.state == "instructions":
+            self.explanation.use()
+        elif self.state == "break":
             self.break_time.use()
-            self.spaceActive = True
-            self.arrowsActive = False
-        elif self.trialHandler.testOver:
+        elif self.state == "done":
             self.test_over.use()
-            self.spaceActive = True
-            self.arrowsActive = False
-        elif self.first_page:
-            self.explanation.use()
         else:
-            if self.show_fixation:
-                self.fixation.use()
+            self.fixation.use()
 
-            if self.displayHandler.trigger[0]:
-                self.top_gabor.use()
-            else:
-                self.top_mask.use()
-            
-            if self.displayHandler.trigger[1]:
-                self.right_gabor.use()
-            else:
-                self.right_mask.use()
-            
-            if self.displayHandler.trigger[2]:
-                self.bottom_gabor.use()
-            else:
-                self.bottom_mask.use()
+            for i in range(4):
+                self.gratings.setVisible(i, self.displayHandler.trigger[i])
+                visible |= self.displayHandler.trigger[i] << i
 
-            if self.displayHandler.trigger[3]:
-                self.left_gabor.use()
-            else:
-                self.left_mask.use()
-        
+            self.gratings.use()
+
+        self.frameLog.markFrame(visible)
+
+    # The test runs as a state machine driven by key presses and by the frame
+    # scheduler, so nothing here ever blocks the event loop:
+    #   instructions -> fixation -> stimulus -> response -> fixation ...
+    #   response -> break -> fixation, response -> done
     def keyPressEvent(self, event):
-        if event.key() == Qt.Key.Key_Escape:
+        key = event.key()
+
+        if key == Qt.Key.Key_Escape:
             self.close()
-        
-        if event.key() == Qt.Key.Key_Space:
-            if self.spaceActive:
-                if self.first_page:
-                    self.first_page = False
-                    self.show_fixation = True
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.current_stim_params
-                    if self.displayHandler.currentStim == 0 or self.displayHandler.currentStim == 2:
-                        stim_params[1] = 0
-                    else:
-                        stim_params[1] = 90
-                    self.displayHandler.showStim(stim_params, shader, uniforms)
-                    self.arrowsActive = True
-                    self.spaceActive = False
-                elif self.trialHandler.testOver:
-                    self.finished.emit(self.trialHandler.results)
-                    self.close()
-                else:
-                    self.trialHandler.trialOver = False
-                    self.show_fixation = True
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.current_stim_params
-                    if self.displayHandler.currentStim == 0 or self.displayHandler.currentStim == 2:
-                        stim_params[1] = 0
-                    else:
-                        stim_params[1] = 90
-                    self.displayHandler.showStim(stim_params, shader, uniforms)
-                    self.arrowsActive = True
-                    self.spaceActive = False
-                    time.sleep(0.5)
-                    
 
-        if event.key() == Qt.Key.Key_Up:
-            if self.arrowsActive:
-                self.confirmation_beep.play()
-                self.arrowsActive = False
-                if self.displayHandler.currentStim == 0:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(1, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                else:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(0, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                self.keyPressTimer.start()
+        elif key == Qt.Key.Key_Space:
+            if self.state == "break" or (self.state == "instructions" and self.trialHandler.ready()):
+                self.startTrial()
+            elif self.state == "done":
+                self.finished.emit(self.trialHandler.results, self.trialHandler.reversals)
+                self.close()
 
+        elif key in RESPONSE_KEYS and self.state == "response":
+            self.respond(RESPONSE_KEYS[key])
 
-        if event.key() == Qt.Key.Key_Right:
-            if self.arrowsActive:
-                self.confirmation_beep.play()
-                self.arrowsActive = False
-                if self.displayHandler.currentStim == 1:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(1, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                else:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(0, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                self.keyPressTimer.start()
+    def startTrial(self):
+        """Show fixation and schedule the current stimulus at a new random location."""
 
-        if event.key() == Qt.Key.Key_Down:
-            if self.arrowsActive:
-                self.confirmation_beep.play()
-                self.arrowsActive = False
-                if self.displayHandler.currentStim == 2:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(1, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                else:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(0, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                self.keyPressTimer.start()
+        self.trialHandler.trialOver = False
+        self.state = "fixation"
 
+        stim = self.displayHandler.pickStim(self.gabors)
+        stim_params = self.trialHandler.current_stim_params
+        if self.displayHandler.currentStim == 0 or self.displayHandler.currentStim == 2:
+            stim_params[1] = 0
+        else:
+            stim_params[1] = 90
+        self.displayHandler.showStim(stim_params, stim)
 
-        if event.key() == Qt.Key.Key_Left:
-            if self.arrowsActive:
-                self.confirmation_beep.play()
-                self.arrowsActive = False
-                if self.displayHandler.currentStim == 3:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(1, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                else:
-                    shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                    stim_params = self.trialHandler.nextStim(0, self.displayHandler.currentStim)
-                    if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                        self.displayHandler.showStim(stim_params, shader, uniforms)
-                self.keyPressTimer.start()
-        
-        if event.key() == Qt.Key.Key_Z:
-            if self.arrowsActive:
-                self.confirmation_beep.play()
-                self.arrowsActive = False
-                shader, uniforms = self.displayHandler.pickStim(self.gabor_shaders, self.gabor_uniforms)
-                stim_params = self.trialHandler.nextStim(0, self.displayHandler.currentStim)
-                if not self.trialHandler.trialOver and not self.trialHandler.testOver:
-                    self.displayHandler.showStim(stim_params, shader, uniforms)
-                self.keyPressTimer.start()
+    def stimOnset(self):
+        self.state = "stimulus"
+
+    def stimOffset(self):
+        self.state = "response"
+
+    def respond(self, location):
+        """Score a response (location is None for 'not seen') and move on to the
+        next stimulus, a break or the end of the test."""
+
+        response_time = time.perf_counter_ns()
+        self.confirmation_beep.play()
+        correct = int(location == self.displayHandler.currentStim)
+
+        if self.trialLog is not None:
+            self.logTrial(location, correct, response_time)
+
+        stim = self.displayHandler.pickStim(self.gabors)
+        stim_params = self.trialHandler.nextStim(correct, self.displayHandler.currentStim)
+
+        if self.trialHandler.testOver:
+            self.state = "done"
+        elif self.trialHandler.trialOver:
+            self.state = "break"
+        else:
+            self.state = "fixation"
+            self.displayHandler.showStim(stim_params, stim)
+
+    def logTrial(self, response, correct, response_time):
+        """Queue the trial that was just answered to the trial log."""
+
+        sf, ori, phase, contrast = self.trialHandler.current_stim_params
+        onset_frame = self.displayHandler.onset_frame
+
+        # Reaction time from the swap that put the stimulus on screen, if it is still in the frame log
+        reaction_time = np.nan
+        if self.frameLog.count - self.frameLog.capacity <= onset_frame < self.frameLog.count:
+            onset_time = self.frameLog.timestamps[onset_frame % self.frameLog.capacity]
+            reaction_time = (response_time - onset_time)/1e6
 
-    def activateArrows(self):
-        self.arrowsActive = True
+        self.trialLog.record(sf/self.stim_size, self.displayHandler.currentStim, ori, phase, contrast, response, correct,
+                             self.trialHandler.currentStaircase(), onset_frame, response_time, reaction_time,
+                             self.displayHandler.achieved_duration)
 
     def close(self):
-        self.top_gabor.destroy()
-        self.left_gabor.destroy()
-        self.right_gabor.destroy()
-        self.bottom_gabor.destroy()
+        if self.timing_file is not None:
+            self.frameLog.export(self.timing_file)
+
+        if self.trialLog is not None:
+            self.trialLog.close()
+
+        self.gratings.destroy()
+        if self.bank is not None:
+            self.bank.destroy()
         self.fixation.destroy()
         self.explanation.destroy()
         self.break_time.destroy()
-        self.top_mask.destroy()
-        self.bottom_mask.destroy()
-        self.left_mask.destroy()
-        self.right_mask.destroy()
+        self.test_over.destroy()
+        purgeTextures()
         super().close()
 
 ## Stimulus and Trial Controllers ##
 
 class DemoController:
-    
-    def __init__(self, num_stims = 4, stim_duration = 250, countdown_time = 2000):
+    """Shows one demo gabor at a random location after a countdown. Both the
+    countdown and the exposure are counted in display frames by (scheduler)."""
+
+    def __init__(self, scheduler, num_stims = 4, stim_duration = 250, countdown_time = 2000):
         
+        self.scheduler = scheduler
         self.num_stims = num_stims
         self.stim_duration = stim_duration
         self.countdown_time = countdown_time
@@ -747,28 +950,15 @@ class DemoController:
         for i in range(1,num_stims+1):
             self.trigger[i] = False
 
-        self.countdown_timer = QTimer()
-        self.countdown_timer.setTimerType(Qt.TimerType.PreciseTimer)
-        self.countdown_timer.setSingleShot(True)
-        self.countdown_timer.setInterval(self.countdown_time)
-        self.countdown_timer.timeout.connect(self.showStim)
-        
-
-        self.stim_timer = QTimer()
-        self.stim_timer.setTimerType(Qt.TimerType.PreciseTimer)
-        self.stim_timer.setSingleShot(True)
-        self.stim_timer.setInterval(self.stim_duration)
-        self.stim_timer.timeout.connect(self.hideStim)
-
 
     def next(self):
         self.current_trigger = np.random.choice([1, 2, 3, 4])
-        self.countdown_timer.start()
+        self.scheduler.schedule(self.countdown_time, self.showStim)
 
     def showStim(self):
         self.beep.play()
         self.trigger[self.current_trigger] = True
-        self.stim_timer.start()
+        self.scheduler.schedule(self.stim_duration, self.hideStim)
 
     def hideStim(self):
         self.trigger[self.current_trigger] = False
@@ -799,6 +989,11 @@ class singleStaircaseController:
 
     def next(self, userInput: bool):
 
+        # A finished staircase keeps its result (multiStaircaseController can present
+        # one more trial from it before noticing it is done)
+        if self.testOver:
+            return self.result
+
         if not userInput:
             self._numWrongInARow += 1
         else:
@@ -837,6 +1032,15 @@ class singleStaircaseController:
 
         return self.currentValue
     
+    def reversalValues(self):
+        """Reversal values averaged into the result, or just the result if the
+        staircase ended at maximum contrast."""
+
+        if self._countReversals >= self._nReversals+1:
+            return list(self._reversalValues)
+
+        return [self.result]
+
     def decreaseStepSize(self):
         
         idx = np.where(self._stepSizes==self._currentStep)[0][0]
@@ -918,6 +1122,12 @@ class multiStaircaseController:
 
         return self.currentValue
 
+    def currentStaircase(self):
+        """Index of the staircase that chose currentValue."""
+        if self.firstRound:
+            return self.staircases.index(self.first_staircase)
+
+        return self.current_staircase
     
     def identifyValidStaircases(self):
         choices = []
@@ -934,6 +1144,15 @@ class multiStaircaseController:
             results.append(self.staircases[i].result)
 
         return results
+
+    def reversalValues(self):
+        """Reversal values of every staircase pooled, with each staircase's repeated to
+        the same count so the mean of the pool is the mean of the results."""
+
+        values = [staircase.reversalValues() for staircase in self.staircases]
+        count = max(len(staircase_values) for staircase_values in values)
+
+        return np.concatenate([np.resize(staircase_values, count) for staircase_values in values])
     
     def reset(self, startVals: list[float]):
 
@@ -956,7 +1175,13 @@ class multiStaircaseController:
 class TrialHandler:
 
     def __init__(self, stim_size, sfMin = 0.5, sfMax = 32, numTrials: int = 13, numStaircases: int = 2, scale: str = "log",
-                 nReversals: int = 7):
+                 nReversals: int = 7, expectedThresholds = None):
+        """
+        Parameters:
+            expectedThresholds (function): optional function returning the expected contrast
+                threshold at each of an array of spatial frequencies (e.g. a norms.NormTable
+                lookup), used to seed the staircases
+        """
         
         self.sfMin = sfMin
         self.sfMax = sfMax
@@ -967,6 +1192,7 @@ class TrialHandler:
         self.nReversals = nReversals
         self.currentTrial = 0
         self.results={}
+        self.reversals = {}
         self.phase = np.random.choice([0, 45, 90, 135, 180, 225, 270, 315])
         self.ori = np.random.choice([225, 225])
         self.testOver = False
@@ -978,13 +1204,16 @@ class TrialHandler:
         # Shuffle their order in place
         np.random.shuffle(self.SFs)
 
-        # generate the expected values given an average CSF, and set start values for staircases accordingly (ignoring this for now)
-        expected_values = csfParabola(self.SFs, 200, 3, 3.5, 20)
-        self.startVals = np.empty((self.numTrials, self.numStaircases))
+        # Start each SF's staircases around the threshold expected from the cohort norms,
+        # or from far below and far above any plausible threshold without them
+        expected_thresholds = expectedThresholds(self.SFs) if expectedThresholds is not None else None
 
-        for i in range(len(expected_values)):
-            # self.startVals[i,:] = [np.max([expected_values[i]*2,1]), np.max([expected_values[i]/2,1])]
-            self.startVals[i,:] = [0.005, 0.8]
+        if expected_thresholds is not None:
+            self.startVals = normStartValues(expected_thresholds, self.numStaircases)
+        else:
+            self.startVals = np.empty((self.numTrials, self.numStaircases))
+            for i in range(self.numTrials):
+                self.startVals[i,:] = [0.005, 0.8]
 
         self.staircaseHandler = self.genStaircase(self.currentTrial)
 
@@ -996,6 +1225,7 @@ class TrialHandler:
         if self.staircaseHandler.results: 
             self.trialOver = True
             self.results[self.SFs[self.currentTrial]] = self.staircaseHandler.results
+            self.reversals[self.SFs[self.currentTrial]] = self.staircaseHandler.reversalValues()
 
         if self.trialOver and self.currentTrial == self.numTrials-1:
             self.testOver = True
@@ -1024,6 +1254,12 @@ class TrialHandler:
         
         return self.current_stim_params
 
+    def ready(self):
+        # The staircases are set up in the constructor
+        return True
+
+    def currentStaircase(self):
+        return self.staircaseHandler.currentStaircase()
 
     def genStaircase(self, currentTrial):
 
@@ -1033,9 +1269,98 @@ class TrialHandler:
         return staircase
 
 
+class QuickCSFTrialHandler:
+    """Bayesian adaptive (qCSF) alternative to TrialHandler that estimates the
+    csfParabola parameters directly, choosing the spatial frequency and contrast
+    of every trial by expected information gain."""
+
+    def __init__(self, stim_size, sfMin = 0.5, sfMax = 32, numSFs: int = 13, numTrials: int = 60,
+                 breakEvery: int = 30):
+
+        self.sfMin = sfMin
+        self.sfMax = sfMax
+        self.stim_size = stim_size
+        self.numTrials = numTrials
+        self.breakEvery = breakEvery
+        self.currentTrial = 0
+        self.results = {}
+        # There are no staircase reversals, the thresholds are estimated all at once
+        self.reversals = {}
+        self.testOver = False
+        self.trialOver = False
+
+        # Spatial frequencies the procedure may choose from
+        self.SFs = np.geomspace(sfMin, sfMax, numSFs)
+
+        # The estimator is built on a worker thread (its likelihood tables may
+        # not be cached yet), the first stimulus is chosen once it is ready
+        self.quickCSF = None
+        self.loading = loadQuickCSF(self.SFs)
+        self.stimIndex = None
+
+        # Set current stim parameters
+        self.current_stim_params = [self.SFs[0]*self.stim_size, 0, 0, 1.0]
+
+    def ready(self):
+        """True once the estimator is built and the first stimulus chosen, the test can't start before."""
+
+        if self.quickCSF is None and self.loading.done():
+            self.quickCSF = self.loading.result()
+
+            self.stimIndex, sf, contrast = self.quickCSF.nextStimulus()
+            self.quickCSF.lookahead(self.stimIndex)
+            self.current_stim_params = [sf*self.stim_size, 0, np.random.choice([0, 45, 90, 135, 180, 225, 270, 315]), contrast]
+
+        return self.quickCSF is not None
+
+    # Stim Param 0 = SF, Stim Param 1 = Orientation, Stim Param 2 = Phase, Stim Param 3 = Contrast
+    def nextStim(self, userInput, stimLocation):
+        # The posterior update and the next stimulus were worked out for both responses
+        # while the stimulus was shown (see QuickCSF.lookahead), so this only picks them up
+        self.quickCSF.update(self.stimIndex, userInput)
+        self.currentTrial += 1
+
+        if self.currentTrial >= self.numTrials:
+            # Report thresholds in the same form as the staircase results
+            thresholds = 1/self.quickCSF.sensitivity()
+            self.results = {sf: [threshold] for sf, threshold in zip(self.SFs, thresholds)}
+            self.testOver = True
+            return self.current_stim_params
+
+        if self.currentTrial % self.breakEvery == 0:
+            self.trialOver = True
+
+        self.stimIndex, sf, contrast = self.quickCSF.nextStimulus()
+        self.quickCSF.lookahead(self.stimIndex)
+        self.current_stim_params[0] = sf*self.stim_size
+        if stimLocation == 0 or stimLocation == 2:
+            self.current_stim_params[1] = 0
+        else:
+            self.current_stim_params[1] = 90
+        self.current_stim_params[2] = np.random.choice([0, 45, 90, 135, 180, 225, 270, 315])
+        self.current_stim_params[3] = contrast
+
+        return self.current_stim_params
+
+    def currentStaircase(self):
+        # The whole test is one adaptive procedure, there are no separate staircases
+        return None
+
+
 class DisplayHandler:
+    """Runs the pre-stimulus interval and stimulus exposure of each trial.
+
+    Durations are converted to whole display frames by (scheduler), which is
+    advanced on every buffer swap, so the stimulus appears and disappears on
+    frame boundaries. stim_frames and nominal_duration are the exposure
+    scheduled, which can differ from the requested stim_duration by up to
+    half a frame. achieved_duration is the exposure of the last stimulus as
+    measured from the swap timestamps in (frame_log), which also counts any
+    dropped frames.
+    """
 
-    def __init__(self, num_stims, stim_duration, pre_stim_interval = 1000):
+    def __init__(self, num_stims, stim_duration, scheduler, pre_stim_interval = 1000, stim_onset = None, stim_offset = None,
+                 frame_log = None):
 
         self.numStims = num_stims
         self.showFixation = False
@@ -1043,85 +1368,59 @@ class DisplayHandler:
         for i in np.arange(0,num_stims):
             self.trigger[i] = False
         self.currentStim = None
+        self.onset_frame = None
+        self.offset_frame = None
 
-        self.stim_timer = QTimer()
-        self.stim_timer.setTimerType(Qt.TimerType.PreciseTimer)
-        self.stim_timer.setSingleShot(True)
-        self.stim_timer.setInterval(stim_duration)
-
-        self.wait_timer = QTimer()
-        self.wait_timer.setTimerType(Qt.TimerType.PreciseTimer)
-        self.wait_timer.setSingleShot(True)
-        self.wait_timer.setInterval(pre_stim_interval)
+        self.scheduler = scheduler
+        self.stim_duration = stim_duration
+        self.pre_stim_interval = pre_stim_interval
+        self.stim_onset = stim_onset
+        self.stim_offset = stim_offset
+        self.frame_log = frame_log
 
-        self.stim_timer.timeout.connect(self.showInterStim)
-        self.wait_timer.timeout.connect(self.makeVisible)
+        self.stim_frames = scheduler.framesFor(stim_duration)
+        self.nominal_duration = scheduler.durationOf(self.stim_frames)
 
         self.beep = QSoundEffect()
         self.beep.setSource(QUrl.fromLocalFile("Assets/beep.wav"))
 
-    def pickStim(self, shaderArray, uniformArray):
-        self.currentStim = np.random.choice(np.arange(0, self.numStims))
-        shader = shaderArray[self.currentStim]
-        uniforms = uniformArray[self.currentStim]
+    @property
+    def achieved_duration(self):
+        """Time in ms from the swap that showed the last stimulus to the swap that
+        removed it (NaN until that swap is logged, or without a frame log)."""
 
-        return shader, uniforms
+        if self.frame_log is None:
+            return np.nan
 
+        return self.frame_log.interval(self.onset_frame, self.offset_frame)
+
+    def pickStim(self, stimArray):
+        self.currentStim = np.random.choice(np.arange(0, self.numStims))
+        stim = stimArray[self.currentStim]
 
-    def showStim(self, stim_parameters, shader, uniforms):
-        sf = stim_parameters[0]
-        ori = stim_parameters[1]
-        phase = stim_parameters[2]
-        contrast = stim_parameters[3]
+        return stim
 
-        GL.glUseProgram(shader)
-        GL.glUniform1f(uniforms[0], sf)
-        GL.glUniform1f(uniforms[1], ori)
-        GL.glUniform1f(uniforms[2], phase)
-        GL.glUniform1f(uniforms[3], contrast)
 
-        self.wait_timer.start()
+    def showStim(self, stim_parameters, stim):
+        stim.setParams(sf = stim_parameters[0], ori = stim_parameters[1],
+                       phase = stim_parameters[2], contrast = stim_parameters[3])
+
+        self.scheduler.schedule(self.pre_stim_interval, self.makeVisible)
 
     def makeVisible(self):
         self.beep.play()
         self.trigger[self.currentStim] = True
-        self.stim_timer.start()
+        self.onset_frame = self.scheduler.frame
+        self.offset_frame = None
+        self.scheduler.schedule(self.stim_duration, self.showInterStim)
+        if self.stim_onset is not None:
+            self.stim_onset()
     
     def showInterStim(self):
         self.trigger[self.currentStim] = False
-
-
-## Plotting Class ##
-
-class ResultsPlot(FigureCanvasQTAgg):
-
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = fig.add_subplot(111)
-        super(ResultsPlot, self).__init__(fig)
-        self.setPlaceholderResults()
-
-    def setPlaceholderResults(self):
-        xvals = np.geomspace(0.4, 32, 50)
-        sampleSFs = np.geomspace(0.5, 32, 13)
-        sampleData = np.asarray([60, 82, 108, 132, 149, 161, 152, 126, 90, 43, 23, 8, 2.3])
-
-        bestFit = csfBestFit(xvals, sampleSFs, sampleData)
-
-        self.axes.scatter(sampleSFs, sampleData, marker = 's', color='k', label = "Sample Data")
-        self.axes.plot(xvals, bestFit, "-r", label="Best Fit", linewidth = 2)
-        self.axes.set_xscale('log')
-        self.axes.set_yscale('log')
-        self.axes.set_ylim([1,200])
-        self.axes.set_xlim(([0.1, 50]))
-        self.axes.set_yticks([1, 10, 50, 100, 200], ['1', '10', '50', '100', '200'])
-        self.axes.set_xticks([0.1, 0.5, 1, 2, 4, 8, 16, 32], ['0.1', '0.5', '1', '2', '4', '8', '16', '32'])
-        self.axes.set_xlabel("Spatial Frequency (c/deg)")
-        self.axes.set_ylabel("Contrast Sensitivity")
-        self.axes.set_title("Sample CSF Results")
-        self.axes.legend()
-        self.axes.grid(True)
-        self.draw()
+        self.offset_frame = self.scheduler.frame
+        if self.stim_offset is not None:
+            self.stim_offset()
 
 
 def testStaircase(scaletype: str, start: float, reversals: int, true_val: float):
@@ -1142,6 +1441,8 @@ def testStaircase(scaletype: str, start: float, reversals: int, true_val: float)
     print(f"Test took a total of {len(trackvals)} steps")
     print(f"Final Value is {test_case.result}")
 
+    import matplotlib.pyplot as plt
+
     plt.figure()
     plt.plot(trackvals, marker='s')
     plt.grid(True)
@@ -1173,6 +1474,8 @@ def testMultiStaircase(scaletype: str, numStaircases: int, startVals: list[float
     print(f"S2 took a total of {len(track_vals2)} steps")
     print(f"Final Value is {np.mean(test_case.results)}")
 
+    import matplotlib.pyplot as plt
+
     plt.figure()
     plt.plot(track_vals1, marker = 's')
     plt.plot(track_vals2, marker = 's')
@@ -1,14 +1,38 @@
-from PyQt6.QtWidgets import QApplication
 import numpy as np
-from PyQt6.QtGui import QGuiApplication
-from scipy import signal
-from scipy.optimize import least_squares
-from PIL import Image
-from OpenGL import GL
+from PyQt6.QtGui import QGuiApplication, QOpenGLContext
+from PyQt6 import sip
 import ctypes
-import matplotlib.pyplot as plt
 from math import ceil
 import sys
+import os
+import hashlib
+import importlib.util
+from functools import lru_cache
+
+### Deferred Imports ###
+
+# scipy, PIL and PyOpenGL together take seconds to import, which would all be
+# spent before the intro window appears. scipy and PIL are imported inside the
+# few functions that use them; GL is used throughout this file, so it is bound
+# to a lazy module that only runs the real import on first attribute access.
+
+def lazyImport(name):
+    """Module (name) that is only executed when one of its attributes is first used.
+    Modules that are already imported are returned as they are."""
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
+
+GL = lazyImport("OpenGL.GL")
 
 ### Screen to Visual Angle Conversion Functions ###
 
@@ -91,6 +115,76 @@ def getNyquist(screen_width_in_mm, screen_width_in_pixels, subject_distance):
     return nyquist
 
 
+class ScreenGeometry:
+    """Screen size and viewing distance for one window, queried once, with
+    vectorized conversions between degrees of visual angle and pixels.
+
+    Conversions use the exact geometry of a flat screen viewed from
+    (subject_distance) along the normal through its centre: an extent of
+    (size) degrees centred on fixation covers 2*d*tan(size/2) mm, and a
+    point (eccentricity) degrees from fixation lies d*tan(eccentricity) mm
+    from the centre. Pixels are device independent (Qt logical) pixels.
+    """
+
+    def __init__(self, subject_distance, pixel_ratio, pixel_dims, mm_dims):
+        """
+        Parameters:
+            subject_distance (float): subject viewing distance from display in millimeters
+            pixel_ratio (float): device pixel ratio of the screen
+            pixel_dims (1x2 array): width and height of the screen in device independent pixels
+            mm_dims (1x2 array): width and height of the screen in millimeters
+        """
+
+        self.subject_distance = subject_distance
+        self.pixel_ratio = pixel_ratio
+        self.pixel_dims = np.asarray(pixel_dims, dtype = np.float64)
+        self.device_pixel_dims = self.pixel_dims*pixel_ratio
+        self.mm_dims = np.asarray(mm_dims, dtype = np.float64)
+
+        self.mm_per_pixel = self.mm_dims[0]/self.pixel_dims[0]
+        self.pixels_per_degree = float(self.deg2pix(1.0))
+        self.degree_dims = self.pix2deg(self.pixel_dims)
+
+        # Highest displayable spatial frequency (c/deg) given the physical pixels
+        self.nyquist = 0.5*self.pixels_per_degree*self.pixel_ratio
+
+    @classmethod
+    def fromScreen(cls, subject_distance, screen = 0):
+        """Build the geometry of a Qt screen (QApplication must be active)."""
+
+        pixel_ratio, pixel_dims, mm_dims = getScreenDims(screen)
+
+        return cls(subject_distance, pixel_ratio, [pixel_dims[0]/pixel_ratio, pixel_dims[1]/pixel_ratio], mm_dims)
+
+    def deg2pix(self, size_in_degrees):
+        """Convert sizes centred on fixation from degrees of visual angle to pixels."""
+
+        half_angle = np.deg2rad(np.asarray(size_in_degrees, dtype = np.float64))/2
+
+        return 2*self.subject_distance*np.tan(half_angle)/self.mm_per_pixel
+
+    def pix2deg(self, size_in_pixels):
+        """Convert sizes centred on fixation from pixels to degrees of visual angle."""
+
+        half_size = np.asarray(size_in_pixels, dtype = np.float64)*self.mm_per_pixel/2
+
+        return np.rad2deg(2*np.arctan(half_size/self.subject_distance))
+
+    def ecc2pix(self, eccentricity):
+        """Convert (signed) eccentricities from fixation in degrees to pixel offsets."""
+
+        angle = np.deg2rad(np.asarray(eccentricity, dtype = np.float64))
+
+        return self.subject_distance*np.tan(angle)/self.mm_per_pixel
+
+    def pix2ecc(self, offset_in_pixels):
+        """Convert (signed) pixel offsets from the screen centre to eccentricities in degrees."""
+
+        offset = np.asarray(offset_in_pixels, dtype = np.float64)*self.mm_per_pixel
+
+        return np.rad2deg(np.arctan(offset/self.subject_distance))
+
+
 ### Numpy 10-bit stimulus creation functions (currently unused but maybe useful later) ###
 
 def make10BitGabor(size, sf = 50, contrast = 0.5, ori = 90, phase = 180, wave = 'sin'):
@@ -115,6 +209,8 @@ def make10BitGabor(size, sf = 50, contrast = 0.5, ori = 90, phase = 180, wave =
         numpy array: gabor stim of shape (size x size) as unsigned int
     """
 
+    from scipy import signal
+
     x, y = np.meshgrid(np.arange(size), np.arange(size))
     gradient = np.sin(ori * np.pi / 180) * x - np.cos(ori * np.pi / 180) * y
 
@@ -178,25 +274,187 @@ def make10BitTestRamp(size, start, stop):
     
     return rgb
 
+# Number of envelopes (sizes and windows) gratingEnvelope keeps
+ENVELOPE_CACHE_SIZE = 32
+
+def makeWindowedGrating(size, sf, ori = 0, phase = 0, wave = 'sin'):
+    """Generate the windowed grating drawn by the gabor and square wave shaders,
+    before contrast scaling and the gamma transform, so that the shaders' output
+    is pow(0.5 + 0.5*contrast*grating, 1/2.42).
+
+    Parameters:
+        size (int): size of the grating (in pixels)
+        sf (float): spatial frequency (in cycles per stimulus)
+        ori (float): wave orientation (in degrees, [0-360])
+        phase (float): phase of the wave (in degrees, [0-360])
+        wave (string): type of wave ('sin' = sine wave, 'sqr' = square wave)
+
+    Returns:
+        numpy array: float32 grating of shape (size x size) in [-1, 1], first
+        row at texture coordinate v = 0
+    """
+
+    return makeWindowedGratingStack(size, [sf], [phase], ori, wave)[0, 0]
+
+def makeWindowedGratingStack(size, sfs, phases, ori = 0, wave = 'sin', out = None):
+    """Generate makeWindowedGrating for every combination of (sfs) and (phases)
+    at once, in float32.
+
+    The grating is separable: at 0, 90, 180 and 270 degrees it varies along
+    one axis only, so it is a 1-D sine table per sf and phase multiplied by
+    the cached envelope. Other orientations use sin(a*u + b*v + phase) =
+    sin(a*u)*cos(b*v + phase) + cos(a*u)*sin(b*v + phase), two products of
+    1-D tables. No size x size temporaries are needed in the axis-aligned case.
+
+    The phase of the wave is computed in float64, as float32 phase errors at
+    high spatial frequencies flip the sign of a square wave near its zero
+    crossings. Square waves are +1 where the sine is within SQUARE_WAVE_TOLERANCE
+    of zero, like the shader's step. Only the envelope and the product are float32.
+
+    Parameters:
+        size (int): size of each grating (in pixels)
+        sfs (list or array): spatial frequencies (in cycles per stimulus)
+        phases (list or array): phases (in degrees, [0-360])
+        ori (float): wave orientation shared by every grating (in degrees, [0-360])
+        wave (string): type of wave ('sin' = sine wave, 'sqr' = square wave)
+        out (array): optional preallocated float32 output of shape
+            (len(sfs) x len(phases) x size x size)
+
+    Returns:
+        numpy array: float32 gratings of shape (len(sfs) x len(phases) x size x size)
+    """
+
+    if wave not in ('sin', 'sqr'):
+        raise NotImplementedError
+
+    sfs = np.asarray(sfs, dtype = np.float64).reshape(-1, 1, 1)
+    phases = np.deg2rad(np.asarray(phases, dtype = np.float64)).reshape(1, -1, 1)
+
+    if out is None:
+        out = np.empty((sfs.shape[0], phases.shape[1], size, size), dtype = np.float32)
+
+    coords = (np.arange(size) + 0.5)/size
+    envelope = gratingEnvelope(size, wave)
+
+    if ori % 90 == 0:
+        # One (sfs x phases x size) sine table along whichever axis the grating varies over
+        along = coords*(1 if ori % 360 in (0, 90) else -1)
+        table = np.sin(2*np.pi*sfs*along + phases)
+        if wave == 'sqr':
+            table = squareWave(table)
+        table = table.astype(np.float32)
+
+        if ori % 180 == 0:
+            np.multiply(table[:, :, np.newaxis, :], envelope, out = out)
+        else:
+            np.multiply(table[:, :, :, np.newaxis], envelope, out = out)
+
+        return out
+
+    cos_ori = np.cos(ori*np.pi/180)
+    sin_ori = np.sin(ori*np.pi/180)
+
+    if wave == 'sqr':
+        # The sign needs the full float64 phase, one sf at a time
+        x = np.add.outer(coords*sin_ori, coords*cos_ori)
+        for i, sf in enumerate(sfs[:, 0, 0]):
+            out[i] = squareWave(np.sin(2*np.pi*sf*x + phases[0, :, :, np.newaxis]))
+    else:
+        # Columns are u and rows are v
+        a = 2*np.pi*sfs*cos_ori*coords
+        b = 2*np.pi*sfs*sin_ori*coords + phases
+        np.multiply(np.cos(b).astype(np.float32)[:, :, :, np.newaxis], np.sin(a).astype(np.float32)[:, :, np.newaxis, :], out = out)
+        out += np.sin(b).astype(np.float32)[:, :, :, np.newaxis]*np.cos(a).astype(np.float32)[:, :, np.newaxis, :]
+
+    out *= envelope
+
+    return out
+
+# Sines closer than this to zero count as zero (+1) in a square wave
+SQUARE_WAVE_TOLERANCE = 1e-9
+
+def squareWave(sine):
+    """Square wave of +1 where (sine) >= 0 and -1 elsewhere, with sines within
+    SQUARE_WAVE_TOLERANCE of zero taken as zero."""
+
+    return np.where(sine >= -SQUARE_WAVE_TOLERANCE, 1.0, -1.0)
+
+@lru_cache(maxsize = ENVELOPE_CACHE_SIZE)
+def gratingEnvelope(size, window = 'sin', sigma = 0.15):
+    """Envelope of a (size x size) stimulus, cached so it is computed once.
+
+    Parameters:
+        size (int): size of the envelope (in pixels)
+        window (string): 'sin' or 'sqr' for the smoothstep windows of the gabor and
+            square wave shaders, 'gauss' for the gaussian of gaussian_filter
+        sigma (float): standard deviation of the gaussian as a fraction of (size)
+
+    Returns:
+        numpy array: read-only float32 envelope of shape (size x size)
+    """
+
+    if window == 'gauss':
+        # The gaussian is separable, so it is the outer product of two 1-D gaussians
+        x = np.linspace(0, size, size, dtype = np.float32)
+        sd = sigma*size
+        profile = np.exp(-((x - size//2)**2)/np.float32(2.0*sd**2))
+        envelope = np.multiply.outer(profile, profile)
+    else:
+        edges = (0.05, 0.5) if window == 'sin' else (0.4, 0.5)
+        offset = (np.arange(size, dtype = np.float32) + np.float32(0.5))/np.float32(size) - np.float32(0.5)
+        offset *= offset
+
+        envelope = np.add.outer(offset, offset)
+        np.sqrt(envelope, out = envelope)
+        envelope -= np.float32(edges[0])
+        envelope /= np.float32(edges[1] - edges[0])
+        np.clip(envelope, 0, 1, out = envelope)
+
+        # 1 - smoothstep = 1 - t*t*(3 - 2*t)
+        smooth = envelope*envelope
+        envelope *= -2
+        envelope += 3
+        envelope *= smooth
+        np.subtract(1, envelope, out = envelope)
+
+    envelope.setflags(write = False)
+
+    return envelope
+
+def pack10BitSigned(values, out = None):
+    """Pack values in [-1, 1] as 10-bit gray levels in a 32-bit integer per
+    pixel, in the GL_UNSIGNED_INT_2_10_10_10_REV layout (red in the low bits).
+    Zero is stored exactly as 512, so a shader decodes (level*1023 - 512)/511.
+
+    Parameters:
+        values (array): values in [-1, 1]
+        out (array): optional preallocated uint32 output, same shape as (values)
+
+    Returns:
+        numpy array: packed pixels as unsigned int, same shape as (values)
+    """
+
+    levels = np.array(values, dtype = np.float32)
+    levels *= np.float32(511)
+    np.rint(levels, out = levels)
+    levels += np.float32(512)
+
+    if out is None:
+        out = np.empty(levels.shape, dtype = np.uint32)
+    out[...] = levels
+
+    # Copy the level into red, green and blue (the fields don't overlap) and set alpha
+    out *= np.uint32(1 | 1 << 10 | 1 << 20)
+    out |= np.uint32(3 << 30)
+
+    return out
+
 def gaussian_filter(size, sigma=0.15):
     """Generate gaussian filter of size (size) with a standard
     deviation of (sigma) percent."""
- 
-    # Initializing value of x,y as grid of size (size x size)
- 
-    x, y = np.meshgrid(np.linspace(0, size, size),
-                       np.linspace(0, size, size))
-    
-    # Convert sigma to standard deviation, assign center
-    # of image as the mean/peak, and precalculate the divisor
-    sd = sigma*size
-    center = size//2
-    divisor = 2.0*sd**2
- 
-    # Calculate Gaussian filter
-    gauss = np.exp(-(((x-center)**2 + ((y-center)**2))/divisor))
 
-    return gauss
+    # Separable and cached, see gratingEnvelope
+    return gratingEnvelope(size, 'gauss', sigma).astype(np.float64)
 
 def make8BitGabor(size, sf = 5, contrast = 0.5, ori = 90, phase = 90):
     x, y = np.meshgrid(np.arange(size), np.arange(size))
@@ -227,6 +485,13 @@ def make8BitGabor(size, sf = 5, contrast = 0.5, ori = 90, phase = 90):
 
 #### CSF data plotting and best fit ####
 
+# Starting guess and bounds for [peak_sensitivity, peak_frequency, width_l, width_r]
+CSF_PARAMETER_GUESS = np.asarray([150, 3.5, 5.0, 20.0])
+CSF_PARAMETER_BOUNDS = np.asarray([[5, 0.1, 1.2, 1.2], [500, 32, 500.0, 500.0]])
+
+# Spatial frequencies the results plot draws fit lines and confidence bands at
+CSF_CURVE_SFS = np.geomspace(0.4, 32, 50)
+
 def lsResiduals(x, sfs, data):
     """Residual function used to calculate best fit for 
     contrast sensitivity function using asymetric parabolic
@@ -244,8 +509,54 @@ def lsResiduals(x, sfs, data):
 
     return np.log10(data) - np.log10(parabola)
 
+def lsResidualsLog(log_x, log_sfs, log_data):
+    """Residual function for the asymetric parabolic CSF fit with all
+    four parameters expressed as log10 values, so no logarithms need to
+    be taken on each least squares iteration.
+    
+    Parameters:
+        log_x (list or array): log10 of the 4 parameters to optimize
+        log_sfs (array): log10 of the spatial frequency values tested
+        log_data (array): log10 of the contrast sensitivity test results
+        
+    Returns:
+        array: vector of residuals for least squares fitting
+    """
+    distance = log_sfs - log_x[1]
+    width = np.where(distance < 0, log_x[2], log_x[3])
+
+    return log_data - log_x[0] + distance**2 * width**2
+
+def lsJacobianLog(log_x, log_sfs, log_data):
+    """Closed-form Jacobian of lsResidualsLog with respect to the
+    log10 parameters.
+    
+    Parameters:
+        log_x (list or array): log10 of the 4 parameters to optimize
+        log_sfs (array): log10 of the spatial frequency values tested
+        log_data (array): log10 of the contrast sensitivity test results
+        
+    Returns:
+        array: (M x 4) matrix of partial derivatives of each residual
+    """
+    distance = log_sfs - log_x[1]
+    left = distance < 0
+    width = np.where(left, log_x[2], log_x[3])
+
+    jacobian = np.empty((len(log_sfs), 4))
+    jacobian[:, 0] = -1.0
+    jacobian[:, 1] = -2.0 * distance * width**2
+    jacobian[:, 2] = np.where(left, 2.0 * distance**2 * log_x[2], 0.0)
+    jacobian[:, 3] = np.where(left, 0.0, 2.0 * distance**2 * log_x[3])
+
+    return jacobian
+
 def csfParabola(spatial_frequencies, peak_sensitivity, peak_frequency, width_l, width_r):
     """Plot contrast sensitivity function as an asymetric parabolic function.
+
+    Each parameter may be a scalar or a length-N array, in which case one curve
+    is computed per parameter set and the result has shape (N x M) for M
+    spatial frequencies.
     
     Parameters:
         spatial_frequencies: spatial frequency values across which to compute CSF
@@ -255,25 +566,78 @@ def csfParabola(spatial_frequencies, peak_sensitivity, peak_frequency, width_l,
         width_r: width of the right side of the parabola
         
     Returns:
-        y values for asymmetric parabolic function with given parameters
+        numpy array: y values for asymmetric parabolic function with given parameters
     """
 
-    spatial_frequencies = np.log10(spatial_frequencies)
-    peak_sensitivity = np.log10(peak_sensitivity)
-    peak_frequency = np.log10(peak_frequency)
-    width_l = np.log10(width_l)
-    width_r = np.log10(width_r)
+    spatial_frequencies = np.log10(np.asarray(spatial_frequencies, dtype = np.float64))
 
-    parabola = []
-    for value in spatial_frequencies:
-        if value < peak_frequency:
-            parabola.append(10**(peak_sensitivity - (value - peak_frequency)**2 * (width_l)**2))
-        else:
-            parabola.append(10**(peak_sensitivity - (value - peak_frequency)**2 * (width_r)**2))
+    # Trailing axis lets a column of parameter sets broadcast against the row of sfs
+    peak_sensitivity = np.log10(np.asarray(peak_sensitivity, dtype = np.float64))[..., np.newaxis]
+    peak_frequency = np.log10(np.asarray(peak_frequency, dtype = np.float64))[..., np.newaxis]
+    width_l = np.log10(np.asarray(width_l, dtype = np.float64))[..., np.newaxis]
+    width_r = np.log10(np.asarray(width_r, dtype = np.float64))[..., np.newaxis]
+
+    distance = spatial_frequencies - peak_frequency
+    width = np.where(distance < 0, width_l, width_r)
+    parabola = 10**(peak_sensitivity - distance**2 * width**2)
 
     return parabola
 
-def csfBestFit(best_fit_xvals, data_xvals, data):
+def csfParabolaBatch(spatial_frequencies, parameters):
+    """Evaluate many asymetric parabolic CSF curves in a single call.
+    
+    Parameters:
+        spatial_frequencies (list or array): M spatial frequency values
+        parameters (array): (N x 4) array of [peak_sensitivity, peak_frequency,
+            width_l, width_r] parameter sets
+        
+    Returns:
+        numpy array: (N x M) array with one CSF curve per parameter set
+    """
+
+    parameters = np.atleast_2d(np.asarray(parameters, dtype = np.float64))
+
+    if parameters.shape[-1] != 4:
+        raise ValueError("Parameters must have shape (N x 4)")
+
+    return csfParabola(spatial_frequencies, *parameters.T)
+
+def csfFitParameters(data_xvals, data, x0 = None):
+    """Calculate best fit parameters for contrast sensitivity data
+    using asymetric parabolic function and least squares.
+
+    The fit is done on the log10 of the parameters using an analytic
+    Jacobian, which gives the same solution as fitting the linear
+    parameters with far fewer residual evaluations.
+
+    Parameters:
+        data_xvals (list or array): x values for your data
+        data (list or array): data from your experiment
+        x0 (list or array): optional starting parameters, e.g. from a previous
+            fit of the same subject (default is the population guess)
+    
+    Returns:
+        array: best fit [peak_sensitivity, peak_frequency, width_l, width_r]
+    """
+
+    from scipy.optimize import least_squares
+
+    if x0 is None:
+        x0 = CSF_PARAMETER_GUESS
+
+    # Work in log10 space and keep the starting point inside the bounds
+    log_bounds = np.log10(CSF_PARAMETER_BOUNDS)
+    log_x0 = np.clip(np.log10(np.asarray(x0, dtype = np.float64)), log_bounds[0], log_bounds[1])
+    log_sfs = np.log10(np.asarray(data_xvals, dtype = np.float64))
+    log_data = np.log10(np.asarray(data, dtype = np.float64))
+
+    # Use scipy least squares to calculate best fit parameters
+    ls_results = least_squares(lsResidualsLog, log_x0, jac = lsJacobianLog, args = (log_sfs, log_data),
+                               method='trf', verbose=False, bounds=log_bounds)
+
+    return 10**ls_results.x
+
+def csfBestFit(best_fit_xvals, data_xvals, data, x0 = None):
     """Calculate best fit for contrast sensivitify data
     using asymetric parabolic function and least squares.
 
@@ -281,27 +645,172 @@ def csfBestFit(best_fit_xvals, data_xvals, data):
         best_fit_xvals (list or array): x values used to calculate best fit values
         data_xvals (list or array): x values for your data
         data (list or array): data from your experiment
+        x0 (list or array): optional starting parameters (see csfFitParameters)
     
     Returns:
         bestFit (list or array): y values of best fit line
     """
-    # Generate best guess for parameters using the input data
 
-    peak_sensitivity_guess = 150
-    peak_frequency_guess = 3.5
-    width_l_guess = 5.0
-    width_r_guess = 20.0
-    x0 = [peak_sensitivity_guess, peak_frequency_guess, width_l_guess, width_r_guess]
-    ls_bounds = [[5, 0.1, 1.2, 1.2], [500, 32, 500.0, 500.0]]
-
-    # Use scipy least squares to calculate best fit parameters
-    ls_results = least_squares(lsResiduals, x0, args = (data_xvals, data), method='trf', verbose=False, bounds=ls_bounds)
+    params = csfFitParameters(data_xvals, data, x0)
 
     # Calculate best fit values using best fit parameters and a given set of x values
-    bestFit = csfParabola(best_fit_xvals, ls_results.x[0], ls_results.x[1], ls_results.x[2], ls_results.x[3])
+    bestFit = csfParabola(best_fit_xvals, params[0], params[1], params[2], params[3])
 
     return bestFit
 
+def csfFitParametersBatch(data_xvals, data, x0 = None, max_iterations = 100, tolerance = 1e-10):
+    """Fit the asymetric parabolic CSF to many data sets measured at the same
+    spatial frequencies at once.
+
+    Every data set takes Levenberg-Marquardt steps on the log10 parameters
+    (the residuals and Jacobian of lsResidualsLog and lsJacobianLog) in lockstep,
+    with all (4 x 4) normal equations solved in one batched call, so thousands
+    of fits cost about as much as a few dozen scipy fits. Steps are clipped to
+    CSF_PARAMETER_BOUNDS.
+
+    Parameters:
+        data_xvals (list or array): M spatial frequencies shared by every data set
+        data (array): (N x M) contrast sensitivities, one data set per row
+        x0 (list or array): starting parameters, either one set for all or (N x 4)
+            (default is the population guess; a fit of the combined data converges faster)
+        max_iterations (int): maximum number of steps
+        tolerance (float): relative cost change below which a fit counts as converged
+
+    Returns:
+        array: (N x 4) best fit [peak_sensitivity, peak_frequency, width_l, width_r] per data set
+    """
+
+    if x0 is None:
+        x0 = CSF_PARAMETER_GUESS
+
+    log_bounds = np.log10(CSF_PARAMETER_BOUNDS)
+    log_sfs = np.log10(np.asarray(data_xvals, dtype = np.float64))
+    log_data = np.log10(np.atleast_2d(np.asarray(data, dtype = np.float64)))
+    num_fits = len(log_data)
+
+    log_x = np.clip(np.log10(np.broadcast_to(np.asarray(x0, dtype = np.float64), (num_fits, 4))),
+                    log_bounds[0], log_bounds[1])
+
+    def residuals(log_x):
+        distance = log_sfs - log_x[:, 1:2]
+        width = np.where(distance < 0, log_x[:, 2:3], log_x[:, 3:4])
+        return log_data - log_x[:, 0:1] + distance**2 * width**2, distance
+
+    residual, distance = residuals(log_x)
+    cost = np.sum(residual**2, axis = 1)
+    damping = np.full(num_fits, 1e-3)
+    active = np.ones(num_fits, dtype = bool)
+
+    for _ in range(max_iterations):
+        if not np.any(active):
+            break
+
+        # Jacobian of every fit (N x M x 4), see lsJacobianLog
+        left = distance < 0
+        width = np.where(left, log_x[:, 2:3], log_x[:, 3:4])
+        jacobian = np.empty(residual.shape + (4,))
+        jacobian[..., 0] = -1.0
+        jacobian[..., 1] = -2.0 * distance * width**2
+        jacobian[..., 2] = np.where(left, 2.0 * distance**2 * log_x[:, 2:3], 0.0)
+        jacobian[..., 3] = np.where(left, 0.0, 2.0 * distance**2 * log_x[:, 3:4])
+
+        hessian = np.einsum('nmi,nmj->nij', jacobian, jacobian)
+        gradient = np.einsum('nmi,nm->ni', jacobian, residual)
+
+        # Marquardt scaling, with a floor so parameters no residual depends on stay put
+        diagonal = np.diagonal(hessian, axis1 = 1, axis2 = 2)
+        hessian[:, np.arange(4), np.arange(4)] += damping[:, np.newaxis]*diagonal + 1e-12
+        step = np.linalg.solve(hessian, -gradient[..., np.newaxis])[..., 0]
+
+        trial_x = np.clip(log_x + step, log_bounds[0], log_bounds[1])
+        trial_residual, trial_distance = residuals(trial_x)
+        trial_cost = np.sum(trial_residual**2, axis = 1)
+
+        improved = active & (trial_cost < cost)
+        converged = improved & (cost - trial_cost <= tolerance*np.maximum(cost, 1e-30))
+
+        log_x[improved] = trial_x[improved]
+        residual[improved] = trial_residual[improved]
+        distance[improved] = trial_distance[improved]
+        cost[improved] = trial_cost[improved]
+
+        damping = np.where(improved, np.maximum(damping/3, 1e-12), np.minimum(damping*4, 1e12))
+
+        # A fit is done once a step barely lowers its cost, or no step lowers it at any damping
+        active &= ~converged & (damping < 1e12)
+
+    return 10**log_x
+
+def _fitParametersChunk(task):
+    """Process pool entry point: csfFitParametersBatch on one chunk of resampled data."""
+
+    data_xvals, data, x0 = task
+
+    return csfFitParametersBatch(data_xvals, data, x0)
+
+def csfBootstrap(data_xvals, samples, num_resamples = 2000, ci = 95, xvals = CSF_CURVE_SFS, seed = None,
+                 max_workers = None):
+    """Bootstrap confidence intervals for the CSF fit parameters and curve.
+
+    The samples measured at each spatial frequency (e.g. the result of every
+    staircase, or their reversal values) are resampled with replacement and
+    averaged to a sensitivity of 1/mean contrast. If every spatial frequency has
+    a single sample the residuals of the fit are resampled across spatial
+    frequencies instead. All resamples are fit together with csfFitParametersBatch,
+    starting from the fit of the original data.
+
+    Parameters:
+        data_xvals (list or array): M spatial frequencies tested
+        samples (list of lists or arrays): contrast thresholds measured at each spatial frequency
+        num_resamples (int): number of bootstrap resamples
+        ci (float): confidence level in percent
+        xvals (list or array): spatial frequencies of the confidence band
+        seed (int): random seed (default is None, unpredictable)
+        max_workers (int): number of worker processes to split the fits over
+            (default is None, fit in this process)
+
+    Returns:
+        parameters (array): best fit [peak_sensitivity, peak_frequency, width_l, width_r] of the data
+        parameter_ci (array): (2 x 4) lower and upper confidence limits of each parameter
+        band (array): (2 x len(xvals)) lower and upper confidence limits of the curve
+        resampled (array): (num_resamples x 4) fit parameters of every resample
+    """
+
+    rng = np.random.default_rng(seed)
+    data_xvals = np.asarray(data_xvals, dtype = np.float64)
+    samples = [np.asarray(values, dtype = np.float64) for values in samples]
+
+    # Sensitivities of the original data
+    data = 1/np.asarray([np.mean(values) for values in samples])
+    parameters = csfFitParameters(data_xvals, data)
+
+    if all(len(values) == 1 for values in samples):
+        log_fit = np.log10(csfParabola(data_xvals, *parameters))
+        log_residuals = np.log10(data) - log_fit
+        picks = rng.integers(0, len(data), (num_resamples, len(data)))
+        resampled_data = 10**(log_fit + log_residuals[picks])
+    else:
+        resampled_data = np.empty((num_resamples, len(samples)))
+        for i, values in enumerate(samples):
+            picks = rng.integers(0, len(values), (num_resamples, len(values)))
+            resampled_data[:, i] = 1/np.mean(values[picks], axis = 1)
+
+    if max_workers is None or max_workers <= 1:
+        resampled = csfFitParametersBatch(data_xvals, resampled_data, parameters)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunks = np.array_split(resampled_data, max_workers)
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            resampled = np.concatenate(list(executor.map(_fitParametersChunk,
+                                                         [(data_xvals, chunk, parameters) for chunk in chunks])))
+
+    limits = [(100 - ci)/2, 100 - (100 - ci)/2]
+    parameter_ci = np.percentile(resampled, limits, axis = 0)
+    band = np.percentile(csfParabolaBatch(xvals, resampled), limits, axis = 0)
+
+    return parameters, parameter_ci, band, resampled
+
 
 
 ### OpenGL Helper Functions ###
@@ -310,6 +819,8 @@ def genTextureFromImage(filename):
     """Generate and bind an OpenGL texture from an image by filename.
     Returns the texture ID"""
 
+    from PIL import Image
+
     image = Image.open(filename)
     image.convert("RGBA")
     texture = GL.GLuint()
@@ -329,22 +840,26 @@ def genTextureFromImage(filename):
 
     return texture
     
-def genQuadWithTextureCoords(quad_width, quad_height, screen_width, screen_height, x_offset = 0, y_offset = 0):
+def genQuadWithTextureCoords(quad_width, quad_height, screen_width, screen_height, x_offset = 0, y_offset = 0,
+                             tex_coords = (0.0, 0.0, 1.0, 1.0)):
     """Generate vertices for an OpenGL 'quad' (a rectangle made out of two triangles) with
-    a given width, height, x offset and y offset that also has a texture bound to its corners."""
+    a given width, height, x offset and y offset that also has a texture bound to its corners.
+    (tex_coords) gives the (left, top, right, bottom) region of the texture to map onto the
+    quad, e.g. an image's region of a texture atlas."""
 
     width_percent = quad_width/screen_width
     height_percent = quad_height/screen_height
     x_offset_percent = (x_offset/screen_width)*2
     y_offset_percent = (y_offset/screen_height)*2
+    u0, v0, u1, v1 = tex_coords
     
-    vertices = (0.0-width_percent+x_offset_percent, 0.0-height_percent+y_offset_percent, 0.0, 0.0, 1.0,
-            0.0+width_percent+x_offset_percent, 0.0-height_percent+y_offset_percent, 0.0, 1.0, 1.0,
-            0.0-width_percent+x_offset_percent, 0.0+height_percent+y_offset_percent, 0.0, 0.0, 0.0,
+    vertices = (0.0-width_percent+x_offset_percent, 0.0-height_percent+y_offset_percent, 0.0, u0, v1,
+            0.0+width_percent+x_offset_percent, 0.0-height_percent+y_offset_percent, 0.0, u1, v1,
+            0.0-width_percent+x_offset_percent, 0.0+height_percent+y_offset_percent, 0.0, u0, v0,
             
-            0.0-width_percent+x_offset_percent, 0.0+height_percent+y_offset_percent, 0.0, 0.0, 0.0,
-            0.0+width_percent+x_offset_percent, 0.0+height_percent+y_offset_percent, 0.0, 1.0, 0.0,
-            0.0+width_percent+x_offset_percent, 0.0-height_percent+y_offset_percent, 0.0, 1.0, 1.0)
+            0.0-width_percent+x_offset_percent, 0.0+height_percent+y_offset_percent, 0.0, u0, v0,
+            0.0+width_percent+x_offset_percent, 0.0+height_percent+y_offset_percent, 0.0, u1, v0,
+            0.0+width_percent+x_offset_percent, 0.0-height_percent+y_offset_percent, 0.0, u1, v1)
     
     vertices = np.asarray(vertices, dtype = np.float32)
     vertex_count = len(vertices)//5
@@ -363,6 +878,15 @@ def createShaderProgram(vertex_filename, fragment_filename):
     with open(fragment_filename, 'r') as f:
         fragment_src = f.readlines()
 
+    return linkShaderProgram(vertex_src, fragment_src)
+
+def linkShaderProgram(vertex_src, fragment_src, retrievable = False):
+    """Compile vertex and fragment shader source and link them into a
+    shader program. If (retrievable) is True the driver is asked to keep
+    the program binary so it can be read back with glGetProgramBinary.
+    
+    Returns linked shader program."""
+
     vertex = GL.glCreateShader(GL.GL_VERTEX_SHADER)
     fragment = GL.glCreateShader(GL.GL_FRAGMENT_SHADER)
     GL.glShaderSource(vertex, vertex_src)
@@ -382,6 +906,10 @@ def createShaderProgram(vertex_filename, fragment_filename):
         raise Exception("ERROR: Fragment Shader Failed to Compile")
     
     shader_program = GL.glCreateProgram()
+
+    if retrievable:
+        GL.glProgramParameteri(shader_program, GL.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL.GL_TRUE)
+
     GL.glAttachShader(shader_program, vertex)
     GL.glAttachShader(shader_program, fragment)
     GL.glLinkProgram(shader_program)
@@ -395,6 +923,330 @@ def createShaderProgram(vertex_filename, fragment_filename):
     
     return shader_program
 
+
+### Shader Program Cache ###
+
+# Directory for linked program binaries (set to None to disable the on-disk cache)
+SHADER_CACHE_DIR = os.path.join("Cache", "Shaders")
+
+_shader_sources = {}
+_shader_programs = {}
+_shader_program_keys = {}
+
+def readShaderSource(filename):
+    """Read shader source by filename, reading each file only once per process."""
+
+    if filename not in _shader_sources:
+        with open(filename, 'r') as f:
+            _shader_sources[filename] = f.read()
+
+    return _shader_sources[filename]
+
+def programBinarySupported():
+    """Check whether the current context can save and load program binaries."""
+
+    if not GL.glGetProgramBinary or not GL.glProgramBinary:
+        return False
+
+    num_formats = GL.GLint()
+    GL.glGetIntegerv(GL.GL_NUM_PROGRAM_BINARY_FORMATS, ctypes.byref(num_formats))
+
+    return num_formats.value > 0
+
+def currentShareGroup():
+    """Identify the share group of the current OpenGL context. Programs can
+    only be reused between contexts that share objects."""
+
+    context = QOpenGLContext.currentContext()
+
+    if context is None:
+        return None
+
+    return sip.unwrapinstance(context.shareGroup())
+
+def loadProgramBinary(filename):
+    """Create a shader program from a binary saved by saveProgramBinary.
+    Returns None if the file is missing or the driver rejects the binary."""
+
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename, 'rb') as f:
+        binary_format = int.from_bytes(f.read(4), 'little')
+        binary = f.read()
+
+    shader_program = GL.glCreateProgram()
+    buffer = (ctypes.c_ubyte * len(binary)).from_buffer_copy(binary)
+    GL.glProgramBinary(shader_program, binary_format, buffer, len(binary))
+
+    success = GL.GLint()
+    GL.glGetProgramiv(shader_program, GL.GL_LINK_STATUS, ctypes.byref(success))
+
+    if not success:
+        GL.glDeleteProgram(shader_program)
+        return None
+
+    return shader_program
+
+def saveProgramBinary(shader_program, filename):
+    """Save a linked program binary (prefixed by its 4-byte format) to disk."""
+
+    length = GL.GLint()
+    GL.glGetProgramiv(shader_program, GL.GL_PROGRAM_BINARY_LENGTH, ctypes.byref(length))
+
+    if length.value <= 0:
+        return
+
+    binary = (ctypes.c_ubyte * length.value)()
+    binary_format = GL.GLenum()
+    GL.glGetProgramBinary(shader_program, length.value, ctypes.byref(length),
+                          ctypes.byref(binary_format), binary)
+
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    with open(filename, 'wb') as f:
+        f.write(binary_format.value.to_bytes(4, 'little'))
+        f.write(bytes(binary)[:length.value])
+
+def getShaderProgram(vertex_filename, fragment_filename, cache_dir = None):
+    """Get a linked shader program for a pair of shader files, shared by every
+    caller using the same source in the same OpenGL share group.
+
+    Programs are cached by a hash of their vertex and fragment source and
+    reference counted; release them with releaseShaderProgram. If the driver
+    supports program binaries they are also saved to (cache_dir) so later
+    launches skip compiling and linking.
+
+    Parameters:
+        vertex_filename (str): path to the vertex shader source
+        fragment_filename (str): path to the fragment shader source
+        cache_dir (str): directory for program binaries (default is SHADER_CACHE_DIR)
+
+    Returns:
+        linked shader program
+    """
+
+    if cache_dir is None:
+        cache_dir = SHADER_CACHE_DIR
+
+    vertex_src = readShaderSource(vertex_filename)
+    fragment_src = readShaderSource(fragment_filename)
+    source_hash = hashlib.sha1((vertex_src + "\0" + fragment_src).encode()).hexdigest()
+    key = (currentShareGroup(), source_hash)
+
+    if key in _shader_programs:
+        _shader_programs[key][1] += 1
+        return _shader_programs[key][0]
+
+    shader_program = None
+    binary_filename = None
+
+    if cache_dir and programBinarySupported():
+        # Binaries are only valid for the driver that produced them
+        driver = b"".join(GL.glGetString(name) or b"" for name in (GL.GL_VENDOR, GL.GL_RENDERER, GL.GL_VERSION))
+        binary_hash = hashlib.sha1(source_hash.encode() + driver).hexdigest()
+        binary_filename = os.path.join(cache_dir, f"{binary_hash}.bin")
+        shader_program = loadProgramBinary(binary_filename)
+
+    if shader_program is None:
+        shader_program = linkShaderProgram(vertex_src, fragment_src, retrievable = binary_filename is not None)
+
+        if binary_filename is not None:
+            saveProgramBinary(shader_program, binary_filename)
+
+    _shader_programs[key] = [shader_program, 1]
+    _shader_program_keys[(key[0], shader_program)] = key
+
+    return shader_program
+
+def releaseShaderProgram(shader_program):
+    """Release a program returned by getShaderProgram, deleting it once the
+    last user has released it."""
+
+    key = _shader_program_keys.get((currentShareGroup(), shader_program))
+
+    if key is None:
+        GL.glDeleteProgram(shader_program)
+        return
+
+    _shader_programs[key][1] -= 1
+
+    if _shader_programs[key][1] <= 0:
+        GL.glDeleteProgram(shader_program)
+        del _shader_programs[key]
+        del _shader_program_keys[(key[0], shader_program)]
+
+### Texture Cache and Atlas ###
+
+# Bytes of unused textures purgeTextures keeps on the GPU, enough for every UI panel
+# at full size, so the next window reuses them instead of decoding and uploading again
+TEXTURE_CACHE_BUDGET = 128*2**20
+
+# Entries are [texture, refcount, regions, size in bytes], least recently used first
+_textures = {}
+_texture_keys = {}
+
+def _retainTexture(key):
+    """Add a reference to a cached texture, returning its cache entry or None."""
+
+    entry = _textures.pop(key, None)
+
+    if entry is not None:
+        entry[1] += 1
+        _textures[key] = entry
+
+    return entry
+
+def _storeTexture(key, texture, nbytes, regions = None):
+    """Add a newly created texture to the cache with one reference."""
+
+    _textures[key] = [texture, 1, regions, nbytes]
+    _texture_keys[(key[1], texture.value)] = key
+
+def _uploadTexture(width, height, pixels):
+    """Create an RGBA8 texture from a (height x width x 4) uint8 buffer. The
+    minifying filter is GL_NEAREST, so no mipmaps are generated."""
+
+    texture = GL.GLuint()
+    GL.glGenTextures(1, ctypes.byref(texture))
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+    GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, width, height, 0,
+                    GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, pixels)
+
+    return texture
+
+def getTexture(filename):
+    """Get a texture for an image file, decoding and uploading it only once
+    per OpenGL share group for as long as the file is unchanged.
+
+    Textures are cached by file path and modification time and reference
+    counted; release them with releaseTexture.
+
+    Returns the texture ID"""
+
+    path = os.path.abspath(filename)
+    key = ("image", currentShareGroup(), path, os.path.getmtime(path))
+
+    entry = _retainTexture(key)
+    if entry is not None:
+        return entry[0]
+
+    from PIL import Image
+
+    image = Image.open(path).convert("RGBA")
+    texture = _uploadTexture(image.width, image.height, image.tobytes())
+    _storeTexture(key, texture, 4*image.width*image.height)
+
+    return texture
+
+def getTextureAtlas(filenames, padding = 4, max_image_size = None):
+    """Get a single texture holding several small images packed into a grid,
+    so they share one upload and one texture binding.
+
+    Atlases are cached by the paths and modification times of their images
+    and reference counted; release them with releaseTexture.
+
+    Parameters:
+        filenames (list of str): image files to pack
+        padding (int): transparent pixels between neighbouring images
+        max_image_size (int): images with a side longer than this many pixels
+            are downscaled to fit before packing (default is no limit)
+
+    Returns:
+        texture: texture ID (None if the atlas would exceed GL_MAX_TEXTURE_SIZE)
+        regions (dict): (left, top, right, bottom) texture coordinates of each
+            filename, for use with genQuadWithTextureCoords
+    """
+
+    paths = [os.path.abspath(filename) for filename in filenames]
+    key = ("atlas", currentShareGroup(), tuple((path, os.path.getmtime(path)) for path in paths), max_image_size)
+
+    entry = _retainTexture(key)
+    if entry is not None:
+        return entry[0], entry[2]
+
+    from PIL import Image
+
+    # Image headers give the sizes without decoding the pixels
+    sizes = []
+    for path in paths:
+        with Image.open(path) as image:
+            scale = 1.0 if max_image_size is None else min(1.0, max_image_size/max(image.size))
+            sizes.append((max(1, round(image.width*scale)), max(1, round(image.height*scale))))
+
+    columns = ceil(np.sqrt(len(paths)))
+    rows = ceil(len(paths)/columns)
+    cell_width = max(size[0] for size in sizes) + 2*padding
+    cell_height = max(size[1] for size in sizes) + 2*padding
+    width = columns*cell_width
+    height = rows*cell_height
+
+    max_size = GL.GLint()
+    GL.glGetIntegerv(GL.GL_MAX_TEXTURE_SIZE, ctypes.byref(max_size))
+
+    if width > max_size.value or height > max_size.value:
+        return None, {}
+
+    pixels = np.zeros((height, width, 4), dtype = np.uint8)
+    regions = {}
+
+    for i, (filename, path, size) in enumerate(zip(filenames, paths, sizes)):
+        x = (i % columns)*cell_width + padding
+        y = (i // columns)*cell_height + padding
+        image = Image.open(path).convert("RGBA")
+        if image.size != size:
+            image = image.resize(size, Image.Resampling.LANCZOS)
+        pixels[y:y+image.height, x:x+image.width] = np.asarray(image)
+
+        # Sample texel centres so linear filtering never reaches the padding
+        regions[filename] = ((x + 0.5)/width, (y + 0.5)/height,
+                             (x + image.width - 0.5)/width, (y + image.height - 0.5)/height)
+
+    texture = _uploadTexture(width, height, pixels)
+    _storeTexture(key, texture, pixels.nbytes, regions)
+
+    return texture, regions
+
+def releaseTexture(texture):
+    """Release a texture returned by getTexture or getTextureAtlas. Cached
+    textures stay on the GPU once unused so other stims in the share group
+    can reuse them; call purgeTextures (e.g. when a window closes) to keep them
+    within TEXTURE_CACHE_BUDGET."""
+
+    key = _texture_keys.get((currentShareGroup(), texture.value))
+
+    if key is None:
+        GL.glDeleteTextures(1, ctypes.byref(texture))
+        return
+
+    entry = _textures.pop(key)
+    entry[1] = max(entry[1] - 1, 0)
+    _textures[key] = entry
+
+def purgeTextures(budget = TEXTURE_CACHE_BUDGET):
+    """Delete the least recently used cached textures in the current share group
+    that are no longer in use, until the unused ones take up at most (budget)
+    bytes (0 deletes every unused texture)."""
+
+    group = currentShareGroup()
+    unused = [key for key, entry in _textures.items() if key[1] == group and entry[1] <= 0]
+    excess = sum(_textures[key][3] for key in unused) - budget
+
+    for key in unused:
+        if excess <= 0:
+            break
+
+        texture, _, _, nbytes = _textures.pop(key)
+        GL.glDeleteTextures(1, ctypes.byref(texture))
+        del _texture_keys[(group, texture.value)]
+        excess -= nbytes
+
 def genVAOandVBOWithTextureCoords(vertices):
 
 
@@ -0,0 +1,245 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from corefunctions import csfParabola, csfFitParameters, CSF_PARAMETER_GUESS, CSF_PARAMETER_BOUNDS
+
+### CSF Model Functions ###
+
+def truncatedLogParabola(spatial_frequencies, peak_sensitivity, peak_frequency, bandwidth, truncation):
+    """Truncated log-parabola CSF (Watson & Ahumada 2005, the qCSF model of Lesmes et al. 2010).
+
+    Parameters:
+        spatial_frequencies: spatial frequency values across which to compute CSF
+        peak_sensitivity: peak contrast sensitivity
+        peak_frequency: spatial frequency that coincides with peak_sensitivity
+        bandwidth: full width at half maximum (in octaves)
+        truncation: most the sensitivity falls below the peak at low spatial frequencies (in log10 units)
+
+    Returns:
+        numpy array: contrast sensitivity at each spatial frequency
+    """
+
+    log_sfs = np.log10(np.asarray(spatial_frequencies, dtype = np.float64))
+    log_peak = np.log10(peak_sensitivity)
+    distance = log_sfs - np.log10(peak_frequency)
+
+    log_sensitivity = log_peak - np.log10(2)*(distance/(np.log10(2*bandwidth)/2))**2
+    truncated = (distance < 0) & (log_sensitivity < log_peak - truncation)
+
+    return 10**np.where(truncated, log_peak - truncation, log_sensitivity)
+
+def logGaussian(spatial_frequencies, peak_sensitivity, peak_frequency, sigma):
+    """Symmetric log-Gaussian CSF, a Gaussian in log10 sensitivity against log10 spatial frequency.
+
+    Parameters:
+        spatial_frequencies: spatial frequency values across which to compute CSF
+        peak_sensitivity: peak contrast sensitivity
+        peak_frequency: spatial frequency that coincides with peak_sensitivity
+        sigma: standard deviation (in log10 units of spatial frequency)
+
+    Returns:
+        numpy array: contrast sensitivity at each spatial frequency
+    """
+
+    distance = np.log10(np.asarray(spatial_frequencies, dtype = np.float64)) - np.log10(peak_frequency)
+
+    return peak_sensitivity*10**(-distance**2/(2*sigma**2))
+
+def doubleExponential(spatial_frequencies, gain, low_slope, decay):
+    """Double-exponential CSF gain*f^low_slope*exp(-decay*f) (Movshon & Kiorpes 1988), a power
+    law rise at low spatial frequencies and an exponential fall at high ones.
+
+    Parameters:
+        spatial_frequencies: spatial frequency values across which to compute CSF
+        gain: overall sensitivity
+        low_slope: log-log slope of the low spatial frequency rise
+        decay: exponential fall off (per c/deg); the peak is at low_slope/decay
+
+    Returns:
+        numpy array: contrast sensitivity at each spatial frequency
+    """
+
+    spatial_frequencies = np.asarray(spatial_frequencies, dtype = np.float64)
+
+    return gain*spatial_frequencies**low_slope*np.exp(-decay*spatial_frequencies)
+
+
+### CSF Model Registry ###
+
+class CSFModel:
+    """A CSF model sensitivity = function(sfs, *parameters), with every
+    parameter positive and fit as a log10 value within bounds so the least
+    squares on log10 sensitivity is well scaled."""
+
+    def __init__(self, name, function, parameter_names, guess, bounds, fitter = None):
+        """
+        Parameters:
+            name (str): registry name
+            function (function): module level function(spatial_frequencies, *parameters)
+                (it is pickled to the worker processes)
+            parameter_names (list of str): names of the parameters
+            guess (list or array): starting parameters
+            bounds (array): (2 x K) lower and upper bounds of the parameters
+            fitter (function): optional fitter(sfs, data) returning the parameters,
+                used instead of the generic least squares fit
+        """
+
+        self.name = name
+        self.function = function
+        self.parameter_names = parameter_names
+        self.guess = np.asarray(guess, dtype = np.float64)
+        self.bounds = np.asarray(bounds, dtype = np.float64)
+        self.fitter = fitter
+
+    def __call__(self, spatial_frequencies, parameters):
+        return self.function(spatial_frequencies, *parameters)
+
+    def fit(self, sfs, data):
+        """Least squares fit of log10 sensitivity.
+
+        Returns:
+            parameters (array), residual sum of squares (float)
+        """
+
+        sfs = np.asarray(sfs, dtype = np.float64)
+        log_data = np.log10(np.asarray(data, dtype = np.float64))
+
+        if self.fitter is not None:
+            parameters = self.fitter(sfs, data)
+        else:
+            from scipy.optimize import least_squares
+
+            log_bounds = np.log10(self.bounds)
+            log_x0 = np.clip(np.log10(self.guess), log_bounds[0], log_bounds[1])
+
+            ls_results = least_squares(lambda log_x: log_data - np.log10(self.function(sfs, *10**log_x)), log_x0,
+                                       method = 'trf', bounds = log_bounds)
+            parameters = 10**ls_results.x
+
+        residuals = log_data - np.log10(self(sfs, parameters))
+
+        return parameters, float(np.sum(residuals**2))
+
+    def key(self, sfs, data):
+        """Hash of the data and of everything about the model its fit depends on."""
+
+        digest = hashlib.sha1(self.name.encode())
+        for values in (sfs, data, self.guess, self.bounds):
+            digest.update(np.ascontiguousarray(values, dtype = np.float64).tobytes())
+
+        return digest.hexdigest()
+
+
+CSF_MODELS = {model.name: model for model in [
+    CSFModel("asymmetric log-parabola", csfParabola, ["peak_sensitivity", "peak_frequency", "width_l", "width_r"],
+             CSF_PARAMETER_GUESS, CSF_PARAMETER_BOUNDS, fitter = csfFitParameters),
+    CSFModel("truncated log-parabola", truncatedLogParabola,
+             ["peak_sensitivity", "peak_frequency", "bandwidth", "truncation"],
+             [150, 3.0, 3.0, 0.5], [[5, 0.1, 0.6, 0.01], [500, 32, 12, 2]]),
+    CSFModel("log-Gaussian", logGaussian, ["peak_sensitivity", "peak_frequency", "sigma"],
+             [150, 3.0, 0.4], [[5, 0.1, 0.05], [500, 32, 3]]),
+    CSFModel("double-exponential", doubleExponential, ["gain", "low_slope", "decay"],
+             [100, 1.0, 0.3], [[0.1, 0.01, 0.001], [1e4, 5, 5]]),
+]}
+
+def registerModel(model):
+    """Add a CSFModel to the registry (its function must be importable by the worker processes)."""
+
+    CSF_MODELS[model.name] = model
+
+
+### Concurrent Model Fitting and Selection ###
+
+# Fits of recently seen data, by CSFModel.key
+CSF_MODEL_CACHE_SIZE = 1024
+_modelFitCache = {}
+
+_modelPool = None
+
+def modelPool():
+    """Process pool shared by every fitModels call, started on first use so
+    the worker processes only pay their imports once. Workers are spawned
+    rather than forked, since the pool is started from a worker thread of a
+    running Qt application."""
+
+    global _modelPool
+
+    if _modelPool is None:
+        _modelPool = ProcessPoolExecutor(max_workers = min(len(CSF_MODELS), os.cpu_count() or 1),
+                                         mp_context = multiprocessing.get_context("spawn"))
+
+    return _modelPool
+
+def _importFitting(_):
+    """Process pool entry point: import scipy.optimize so the first real fit doesn't have to."""
+
+    from scipy.optimize import least_squares
+
+    return os.getpid()
+
+def warmModelPool():
+    """Start the model pool's workers and their imports ahead of the first fit
+    (e.g. while a test is running)."""
+
+    list(modelPool().map(_importFitting, range(len(CSF_MODELS))))
+
+def _fitModel(model, sfs, data):
+    """Process pool entry point: fit one model."""
+
+    return model.fit(sfs, data)
+
+def informationCriteria(rss, num_points, num_parameters):
+    """AIC and BIC of a least squares fit with normally distributed residuals."""
+
+    log_likelihood_term = num_points*np.log(max(rss, 1e-300)/num_points)
+
+    return (float(log_likelihood_term + 2*num_parameters),
+            float(log_likelihood_term + num_parameters*np.log(num_points)))
+
+def fitModels(sfs, data, models = None, executor = None):
+    """Fit contrast sensitivity data with several CSF models at once.
+
+    Every model is fit on its own worker and fits are cached by a hash of the
+    data, so refitting a session (e.g. replotting it) costs nothing.
+
+    Parameters:
+        sfs (list or array): spatial frequencies tested
+        data (list or array): contrast sensitivities measured
+        models (list of str): names of the models to fit (default is every registered model)
+        executor (concurrent.futures.Executor): pool to fit on (default is the shared modelPool)
+
+    Returns:
+        dict: {model name: {"parameters", "rss", "aic", "bic"}} in the order of (models)
+    """
+
+    sfs = np.asarray(sfs, dtype = np.float64)
+    data = np.asarray(data, dtype = np.float64)
+    models = [CSF_MODELS[name] for name in (models or CSF_MODELS)]
+
+    keys = {model.name: model.key(sfs, data) for model in models}
+    futures = {model.name: (executor or modelPool()).submit(_fitModel, model, sfs, data)
+               for model in models if keys[model.name] not in _modelFitCache}
+
+    fits = {}
+    for model in models:
+        key = keys[model.name]
+        if key not in _modelFitCache:
+            _modelFitCache[key] = futures[model.name].result()
+            while len(_modelFitCache) > CSF_MODEL_CACHE_SIZE:
+                del _modelFitCache[next(iter(_modelFitCache))]
+
+        parameters, rss = _modelFitCache[key]
+        aic, bic = informationCriteria(rss, len(data), len(parameters))
+        fits[model.name] = {"parameters": parameters, "rss": rss, "aic": aic, "bic": bic}
+
+    return fits
+
+def selectModel(fits, criterion = "aic"):
+    """Name of the model with the lowest information criterion ('aic' or 'bic') in fitModels results."""
+
+    if criterion not in ("aic", "bic"):
+        raise ValueError(f"Unknown model selection criterion {criterion}")
+
+    return min(fits, key = lambda name: fits[name][criterion])
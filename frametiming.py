@@ -0,0 +1,201 @@
+import time
+import numpy as np
+
+### Frame-Accurate Presentation Timing ###
+
+class FrameTimingLog:
+    """Ring buffer of buffer swap timestamps and of which stimuli were on
+    screen in each swapped frame.
+
+    paintGL reports what it drew with markFrame, and frameSwapped (connected
+    to the window's frameSwapped signal) stamps that frame with a high
+    resolution timestamp. Everything is stored in preallocated arrays, so
+    logging a frame never allocates. Once the buffer is full the oldest
+    frames are overwritten.
+    """
+
+    def __init__(self, capacity = 2**16, refresh_rate = None):
+        """
+        Parameters:
+            capacity (int): number of frames to keep
+            refresh_rate (float): nominal display refresh rate in Hz (default is
+                None, estimated from the median frame interval)
+        """
+
+        self.capacity = capacity
+        self.refresh_rate = refresh_rate
+        self.timestamps = np.zeros(capacity, dtype = np.int64)
+        self.visible = np.zeros(capacity, dtype = np.uint8)
+        self.count = 0
+        self.pending = 0
+
+    def markFrame(self, visible):
+        """Record which stimuli the frame being painted shows, as a bit mask
+        with bit i set if stimulus location i is visible."""
+
+        self.pending = visible
+
+    def frameSwapped(self):
+        """Stamp the frame that was just swapped to the screen."""
+
+        index = self.count % self.capacity
+        self.timestamps[index] = time.perf_counter_ns()
+        self.visible[index] = self.pending
+        self.count += 1
+
+    def frames(self):
+        """Logged frames in chronological order.
+
+        Returns:
+            frame numbers, timestamps (ns) and visibility masks as arrays
+        """
+
+        num_frames = min(self.count, self.capacity)
+        first = self.count - num_frames
+        order = np.arange(first, self.count) % self.capacity
+
+        return np.arange(first, self.count), self.timestamps[order], self.visible[order]
+
+    def interval(self, first, last):
+        """Time in ms from the swap of frame (first) to the swap of frame (last),
+        NaN if either is not (or no longer) in the log."""
+
+        oldest = self.count - min(self.count, self.capacity)
+
+        if first is None or last is None or not oldest <= first <= last < self.count:
+            return np.nan
+
+        return (self.timestamps[last % self.capacity] - self.timestamps[first % self.capacity])/1e6
+
+    def frameInterval(self, intervals = None):
+        """Nominal frame interval in ns."""
+
+        if self.refresh_rate:
+            return 1e9/self.refresh_rate
+
+        if intervals is None:
+            intervals = np.diff(self.frames()[1])
+
+        return float(np.median(intervals)) if len(intervals) else np.nan
+
+    def lateFrames(self, tolerance = 1.5):
+        """Find swaps that came later than (tolerance) nominal frame intervals
+        after the previous one.
+
+        Returns:
+            frame numbers of the late swaps, their intervals (ns) and the
+            number of refreshes missed before each one
+        """
+
+        numbers, timestamps, visible = self.frames()
+        intervals = np.diff(timestamps)
+        nominal = self.frameInterval(intervals)
+
+        late = np.flatnonzero(intervals > tolerance*nominal)
+        missed = np.maximum(np.round(intervals[late]/nominal).astype(np.int64) - 1, 0)
+
+        return numbers[late + 1], intervals[late], missed
+
+    def presentations(self, num_stims = 8):
+        """Find every continuous run of frames in which a stimulus was visible.
+
+        Returns:
+            list of (location, first frame, last frame, number of frames, duration in ms)
+            tuples in order of onset. The duration runs from the swap of the first
+            frame to the swap that removed the stimulus (NaN if not yet logged).
+        """
+
+        numbers, timestamps, visible = self.frames()
+        presentations = []
+
+        for location in range(num_stims):
+            shown = (visible >> location) & 1
+            edges = np.diff(np.concatenate([[0], shown, [0]]).astype(np.int8))
+            onsets = np.flatnonzero(edges == 1)
+            offsets = np.flatnonzero(edges == -1) - 1
+
+            for onset, offset in zip(onsets, offsets):
+                if offset + 1 < len(timestamps):
+                    duration = (timestamps[offset + 1] - timestamps[onset])/1e6
+                else:
+                    duration = np.nan
+                presentations.append((location, numbers[onset], numbers[offset], offset - onset + 1, duration))
+
+        presentations.sort(key = lambda presentation: presentation[1])
+
+        return presentations
+
+    def export(self, filename_base):
+        """Write the frame log to (filename_base)_frames.csv and the stimulus
+        presentations to (filename_base)_stimuli.csv."""
+
+        numbers, timestamps, visible = self.frames()
+        intervals = np.diff(timestamps, prepend = timestamps[:1])
+        nominal = self.frameInterval(intervals[1:])
+        late = intervals > 1.5*nominal
+
+        frames = np.column_stack([numbers, (timestamps - timestamps[:1])/1e6, intervals/1e6, visible, late])
+        np.savetxt(f"{filename_base}_frames.csv", frames, delimiter = ",", fmt = ["%d", "%.4f", "%.4f", "%d", "%d"],
+                   header = "Frame,Time (ms),Interval (ms),Visible,Late", comments = "")
+
+        presentations = np.asarray(self.presentations(), dtype = np.float64).reshape(-1, 5)
+        np.savetxt(f"{filename_base}_stimuli.csv", presentations, delimiter = ",", fmt = ["%d", "%d", "%d", "%d", "%.4f"],
+                   header = "Location,First Frame,Last Frame,Frames,Duration (ms)", comments = "")
+
+
+### Frame-Counted Scheduling ###
+
+class FrameScheduler:
+    """Runs callbacks after a whole number of display refreshes instead of
+    after a wall clock interval.
+
+    advance must be connected to the window's frameSwapped signal. Callbacks
+    run right after a swap, before the next paintGL, so any state they change
+    takes effect on an exact frame boundary. Requested durations are rounded
+    to the nearest whole number of frames.
+    """
+
+    def __init__(self, refresh_rate = 60.0):
+        """
+        Parameters:
+            refresh_rate (float): display refresh rate in Hz
+        """
+
+        self.refresh_rate = refresh_rate
+        self.frame = 0
+        self.events = []
+
+    def framesFor(self, duration):
+        """Number of refreshes (at least one) closest to (duration) ms."""
+
+        return max(1, int(round(duration*self.refresh_rate/1000)))
+
+    def durationOf(self, frames):
+        """Nominal duration in ms of (frames) refreshes."""
+
+        return frames*1000/self.refresh_rate
+
+    def schedule(self, duration, callback):
+        """Run (callback) after the number of frames closest to (duration) ms.
+        Returns the frame number it will run on, which can be passed to cancel."""
+
+        frame = self.frame + self.framesFor(duration)
+        self.events.append((frame, callback))
+
+        return frame
+
+    def cancel(self, frame = None):
+        """Cancel the callbacks scheduled for (frame), or all of them if None."""
+
+        self.events = [event for event in self.events if frame is not None and event[0] != frame]
+
+    def advance(self):
+        """Count one swapped frame and run every callback that is now due."""
+
+        self.frame += 1
+
+        due = [event for event in self.events if event[0] <= self.frame]
+        if due:
+            self.events = [event for event in self.events if event[0] > self.frame]
+            for frame, callback in due:
+                callback()
@@ -0,0 +1,100 @@
+import argparse
+import subprocess
+import sys
+
+### Import-Time Budget ###
+
+# Longest cumulative import time in ms allowed for each startup module
+IMPORT_BUDGETS = {"main": 1500, "resultsstore": 150, "corefunctions": 150}
+
+# Modules the intro window must not import, they are only needed once a test,
+# the demo or a fit starts
+DEFERRED_MODULES = ["classes", "scipy.optimize", "scipy.signal", "OpenGL.GL", "matplotlib.pyplot",
+                    "PyQt6.QtMultimedia"]
+
+
+def measureImportTimes(module, repeats = 3):
+    """Import (module) in fresh interpreters with -X importtime.
+
+    Parameters:
+        module (str): module to import
+        repeats (int): number of interpreters, the fastest time of each module is kept
+            so one slow (cold disk cache) run doesn't count
+
+    Returns:
+        dict: {module name: (self time, cumulative time)} in ms of every module imported
+    """
+
+    times = {}
+
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                 capture_output = True, text = True)
+        if process.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{process.stderr}")
+
+        run = {}
+        for line in process.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            own, cumulative, name = line[len("import time:"):].split("|")
+            run[name.strip()] = (int(own)/1000, int(cumulative)/1000)
+
+        for name, (own, cumulative) in run.items():
+            if name not in times or cumulative < times[name][1]:
+                times[name] = (own, cumulative)
+
+    return times
+
+
+def checkImportBudget(module = "main", budgets = IMPORT_BUDGETS, deferred = DEFERRED_MODULES, repeats = 3):
+    """Measure the import of (module) against the budgets.
+
+    Returns:
+        times (dict): see measureImportTimes
+        problems (list of str): every budget exceeded and deferred module imported
+    """
+
+    times = measureImportTimes(module, repeats)
+    problems = []
+
+    for name, budget in budgets.items():
+        if name in times and times[name][1] > budget:
+            problems.append(f"{name} took {times[name][1]:.1f} ms to import (budget {budget} ms)")
+
+    for name in deferred:
+        if name in times:
+            problems.append(f"{name} is imported at startup ({times[name][1]:.1f} ms)")
+
+    return times, problems
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description = "Check the import time of the application against its budget.")
+    parser.add_argument("module", nargs = "?", default = "main", help = "module to import (default is main)")
+    parser.add_argument("-b", "--budget", type = float, default = None,
+                        help = "cumulative budget in ms for the module (default is IMPORT_BUDGETS)")
+    parser.add_argument("-r", "--repeats", type = int, default = 3, help = "number of interpreters to time")
+    parser.add_argument("-n", "--top", type = int, default = 15, help = "number of slowest modules to list")
+    args = parser.parse_args()
+
+    budgets = dict(IMPORT_BUDGETS)
+    if args.budget is not None:
+        budgets[args.module] = args.budget
+
+    times, problems = checkImportBudget(args.module, budgets, repeats = args.repeats)
+
+    print(f"{'self (ms)':>10} {'cumulative (ms)':>16}  module")
+    for name, (own, cumulative) in sorted(times.items(), key = lambda item: item[1][1], reverse = True)[:args.top]:
+        print(f"{own:10.1f} {cumulative:16.1f}  {name}")
+
+    for problem in problems:
+        print(f"OVER BUDGET: {problem}")
+
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,37 @@
 from PyQt6.QtWidgets import (QApplication, QWidget, QLabel, QLineEdit,
                              QPushButton, QHBoxLayout, QComboBox, QGridLayout, 
-                             QSpinBox)
+                             QSpinBox, QMessageBox)
 
 from PyQt6.QtGui import QFont, QSurfaceFormat
-from PyQt6.QtCore import Qt, pyqtSlot
+from PyQt6.QtCore import Qt, pyqtSignal, pyqtSlot
 import sys
-import csv
-from os.path import isfile
+import time
 import os
 import numpy as np
-from classes import ResultsPlot, GL_CSFDemoWindow, GL_CSFTestWindow
-from corefunctions import csfBestFit
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from resultsplot import ResultsPlot
+from corefunctions import csfBootstrap, csfParabola, CSF_CURVE_SFS
+from resultsstore import ResultsStore
+from csfmodels import fitModels, selectModel, warmModelPool
+from norms import NormTable
 
 
 class IntroWindow(QWidget):
+
+    # Emitted by the analysis worker with the session and its finished future, delivered on the GUI thread
+    analysisFinished = pyqtSignal(dict, object)
      
     def __init__(self, parent = None):
         super(IntroWindow, self).__init__(parent)
+        self.resultsStore = ResultsStore()
+        self.norms = NormTable(self.resultsStore)
+        self.sessionId = None
+
+        # One worker, so sessions are analysed and stored in the order they finish
+        self.analysisPool = ThreadPoolExecutor(max_workers = 1)
+        self.analysisFinished.connect(self.showResults)
+
         self.initializeWindow()
         
     def initializeWindow(self):
@@ -38,6 +53,12 @@ class IntroWindow(QWidget):
         resultsLabel.setFont(QFont("Arial", 30))
         resultsLabel.setAlignment(Qt.AlignmentFlag.AlignCenter)
 
+        # Model selection and cohort percentile ranks of the last analysed session
+        self.analysisLabel = QLabel("")
+        self.analysisLabel.setFont(QFont("Arial", 14))
+        self.analysisLabel.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.analysisLabel.setWordWrap(True)
+
         nameLabel = QLabel("Name: ")
         nameLabel.setFont(QFont("Arial", 18))
         nameLabel.setAlignment(Qt.AlignmentFlag.AlignLeft)
@@ -115,6 +136,28 @@ class IntroWindow(QWidget):
         self.distanceSpinBox.setFixedHeight(30)
         self.distanceSpinBox.setValue(250)
 
+        methodLabel = QLabel("Procedure: ")
+        methodLabel.setFont(QFont("Arial", 18))
+        methodLabel.setAlignment(Qt.AlignmentFlag.AlignLeft)
+
+        self.methodSelect = QComboBox()
+        self.methodSelect.addItem("Staircase", "staircase")
+        self.methodSelect.addItem("Quick CSF", "qcsf")
+        self.methodSelect.setCurrentIndex(0)
+        self.methodSelect.setFont(QFont("Arial", 18))
+        self.methodSelect.setFixedHeight(30)
+
+        renderLabel = QLabel("Rendering: ")
+        renderLabel.setFont(QFont("Arial", 18))
+        renderLabel.setAlignment(Qt.AlignmentFlag.AlignLeft)
+
+        self.renderSelect = QComboBox()
+        self.renderSelect.addItem("Shader", False)
+        self.renderSelect.addItem("Prebuilt", True)
+        self.renderSelect.setCurrentIndex(0)
+        self.renderSelect.setFont(QFont("Arial", 18))
+        self.renderSelect.setFixedHeight(30)
+
         startButton = QPushButton("Start")
         startButton.setFont(QFont("Arial", 18))
         startButton.clicked.connect(self.startButtonClicked)
@@ -164,12 +207,17 @@ class IntroWindow(QWidget):
         leftGrid.addWidget(self.eccentricitySelect, 13, 1, 2, 2)
         leftGrid.addWidget(distanceLabel, 15, 0, 2, 1, Qt.AlignmentFlag.AlignVCenter)
         leftGrid.addWidget(self.distanceSpinBox, 15, 1, 2, 2)
-        leftGrid.addWidget(startButton, 17, 1, 1, 1, Qt.AlignmentFlag.AlignBottom)
+        leftGrid.addWidget(methodLabel, 17, 0, 2, 1, Qt.AlignmentFlag.AlignVCenter)
+        leftGrid.addWidget(self.methodSelect, 17, 1, 2, 2)
+        leftGrid.addWidget(renderLabel, 19, 0, 2, 1, Qt.AlignmentFlag.AlignVCenter)
+        leftGrid.addWidget(self.renderSelect, 19, 1, 2, 2)
+        leftGrid.addWidget(startButton, 21, 1, 1, 1, Qt.AlignmentFlag.AlignBottom)
         
         rightGrid = QGridLayout()
         rightGrid.addWidget(resultsLabel, 0, 0, 1, 3, Qt.AlignmentFlag.AlignTop)
-        rightGrid.addWidget(self.resultPlot, 1, 0, 15, 3)
-        rightGrid.addWidget(demoButton, 17, 1, 1, 1, Qt.AlignmentFlag.AlignBottom)
+        rightGrid.addWidget(self.resultPlot, 1, 0, 19, 3)
+        rightGrid.addWidget(self.analysisLabel, 20, 0, 1, 3)
+        rightGrid.addWidget(demoButton, 21, 1, 1, 1, Qt.AlignmentFlag.AlignBottom)
 
         mainHLayout = QHBoxLayout()
         mainHLayout.addLayout(leftGrid)
@@ -185,101 +233,76 @@ class IntroWindow(QWidget):
         if not os.path.exists(f"Results/{self.nameText.text()}"):
             os.makedirs(f"Results/{self.nameText.text()}")
 
-        if isfile(f"Results/{self.nameText.text()}/TestInfo.csv"):
-            with open(f"Results/{self.nameText.text()}/TestInfo.csv", 'a', newline='') as file:
-                csv_writer = csv.writer(file)
-                
-                data = [f"{self.nameText.text()}",
-                        f"{self.ageSpinBox.value()}",
-                        f"{self.ethnicitySelect.currentText()}",
-                        f"{self.durationSelect.currentText()}",
-                        f"{self.sizeSelect.currentText()}",
-                        f"{self.eccentricitySelect.currentText()}",
-                        f"{self.distanceSpinBox.value()}"]
-
-                csv_writer.writerow(data)
-        else:
-            with open(f"Results/{self.nameText.text()}/TestInfo.csv", 'a', newline ='') as file:
-                csv_writer = csv.writer(file)
-                csv_writer.writerow(["Name", "Age", "Ethnicity", "Stim Duration", "Stim Size", "Stim Eccentricity", "Subject Distance"])
-
-                data = [f"{self.nameText.text()}",
-                        f"{self.ageSpinBox.value()}",
-                        f"{self.ethnicitySelect.currentText()}",
-                        f"{self.durationSelect.currentText()}",
-                        f"{self.sizeSelect.currentText()}",
-                        f"{self.eccentricitySelect.currentText()}",
-                        f"{self.distanceSpinBox.value()}"]
-
-                csv_writer.writerow(data)
+        # Sessions are recorded in the results store and named by their start time
+        self.sessionName = time.strftime('%Y%m%d_%H%M%S')
+        self.sessionId = self.resultsStore.addSession(self.nameText.text(),
+                                                      age = self.ageSpinBox.value(),
+                                                      ethnicity = self.ethnicitySelect.currentText(),
+                                                      stim_duration = float(self.durationSelect.currentText()),
+                                                      stim_size = float(self.sizeSelect.currentText()),
+                                                      eccentricity = float(self.eccentricitySelect.currentText()),
+                                                      distance = self.distanceSpinBox.value(),
+                                                      method = self.methodSelect.currentData(),
+                                                      started = time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+        # Start the model fitting workers while the test runs, so the first analysis doesn't wait for them
+        # (they are spawned, not forked, so starting them from the analysis worker is safe)
+        self.analysisPool.submit(warmModelPool)
+
+        # The OpenGL windows pull in PyOpenGL and QtMultimedia, so they are only imported once needed
+        from classes import GL_CSFTestWindow
 
         self.testWindow = GL_CSFTestWindow(subject_distance = self.distanceSpinBox.value()*10,
                                            stim_duration = int(self.durationSelect.currentText()),
                                            stim_size = int(self.sizeSelect.currentText()),
-                                           eccentricity= int(self.eccentricitySelect.currentText()))
+                                           eccentricity= int(self.eccentricitySelect.currentText()),
+                                           method = self.methodSelect.currentData(),
+                                           stimulus_bank = self.renderSelect.currentData(),
+                                           expected_thresholds = partial(self.norms.expectedThresholds,
+                                                                         age = self.ageSpinBox.value(),
+                                                                         ethnicity = self.ethnicitySelect.currentText(),
+                                                                         eccentricity = float(self.eccentricitySelect.currentText()),
+                                                                         stim_size = float(self.sizeSelect.currentText()),
+                                                                         stim_duration = float(self.durationSelect.currentText())),
+                                           timing_file = f"Results/{self.nameText.text()}/FrameTiming_{self.sessionName}",
+                                           trial_file = f"Results/{self.nameText.text()}/Trials_{self.sessionName}.csv")
         
-        self.testWindow.finished.connect(self.plotResults)
+        # The session is bound now, the name field may hold the next subject by the time it finishes
+        session = {"name": self.nameText.text(), "session_name": self.sessionName, "session_id": self.sessionId}
+        self.testWindow.finished.connect(partial(self.plotResults, session))
         self.testWindow.show()
 
-    @pyqtSlot(dict)
-    def plotResults(self, results):
-        sfs = []
-        values = []
-        sortedKeys = sorted(results.keys())
+    def plotResults(self, session, results, reversals):
+        """Analyse a finished test on the analysis worker, so the intro window
+        stays responsive and the next subject can be entered in the meantime."""
 
-        for key in sortedKeys:
-            sfs.append(key)
-            values.append(np.mean(results[key]))
+        future = self.analysisPool.submit(analyseSession, self.resultsStore.filename, session, results, reversals)
+        future.add_done_callback(partial(self.analysisFinished.emit, session))
 
-        for i in range(len(values)):
-            values[i]=1/values[i]
+    @pyqtSlot(dict, object)
+    def showResults(self, session, future):
+        # An exception escaping a slot aborts the application, so a failed analysis is only reported
+        try:
+            _, sfs, values, xvals, bestFit, band, bestModels, ranks = future.result()
+        except Exception as error:
+            self.analysisLabel.setText(f"Analysis of {session['name']} failed: {error}")
+            QMessageBox.warning(self, "Analysis Failed", f"The results of {session['name']} ({session['session_name']}) "
+                                f"could not be analysed:\n{error}", QMessageBox.StandardButton.Ok)
+            return
 
-        sfs = np.asarray(sfs)
-        values = np.asarray(values)
+        self.resultPlot.setResults(sfs, values, xvals, bestFit, f"{session['name']} CSF Results", band = band)
 
-        if isfile(f"Results/{self.nameText.text()}/TestResults.csv"):
-            with open(f'Results/{self.nameText.text()}/TestResults.csv', 'a', newline='') as file:
-                csv_writer = csv.writer(file)
-                csv_writer.writerow(values)
-                
+        if ranks is None:
+            rankText = "no cohort with enough sessions yet"
         else:
-            with open(f'Results/{self.nameText.text()}/TestResults.csv', 'w', newline='') as file:
-                csv_writer = csv.writer(file)
-                csv_writer.writerow(sfs)
-                csv_writer.writerow(values)
-
-        xvals = np.geomspace(0.4, 32, 50)
-        bestFit = csfBestFit(xvals, sfs, values) 
-
-        self.resultPlot.axes.clear()
-        
-        self.resultPlot.axes.scatter(sfs, values, marker = 's', color='k', label = "Data")
-        self.resultPlot.axes.plot(xvals, bestFit, "-r", label="Best Fit", linewidth = 2)
-        self.resultPlot.axes.set_xscale('log')
-        self.resultPlot.axes.set_yscale('log')
-        self.resultPlot.axes.set_ylim([1, 200])
-        self.resultPlot.axes.set_xlim(([0.1, 50]))
-        self.resultPlot.axes.set_yticks([1, 10, 50, 100, 200], ['1', '10', '50', '100', '200'])
-        self.resultPlot.axes.set_xticks([0.1, 0.5, 1, 2, 4, 8, 16, 32], ['0.1', '0.5', '1', '2', '4', '8', '16', '32'])
-        self.resultPlot.axes.set_xlabel("Spatial Frequency (c/deg)")
-        self.resultPlot.axes.set_ylabel("Contrast Sensitivity")
-        self.resultPlot.axes.set_title(f"{self.nameText.text()} CSF Results")
-        self.resultPlot.axes.legend()
-        self.resultPlot.axes.grid(True)
-        self.resultPlot.draw()
-
-        directory = f"Results/{self.nameText.text()}"
-        numPlots = 0
-        for filename in os.listdir(directory):
-            if "Plot" in filename:
-                numPlots+= 1
-
-        if numPlots:        
-            self.resultPlot.print_png(f"Results/{self.nameText.text()}/Plot_{numPlots}.png")
-        else:
-            self.resultPlot.print_png(f"Results/{self.nameText.text()}/Plot.png")
+            rankText = ", ".join(f"{sf:.3g}: {rank:.0f}" for sf, rank in zip(sfs, ranks) if np.isfinite(rank))
+        self.analysisLabel.setText(f"Best CSF model: {bestModels['aic']} (AIC), {bestModels['bic']} (BIC)\n"
+                                   f"Cohort percentile rank by SF (c/deg): {rankText}")
+        self.resultPlot.export(f"Results/{session['name']}/Plot_{session['session_name']}.png")
 
     def demoButtonClicked(self):
+        from classes import GL_CSFDemoWindow
+
         self.demoWindow = GL_CSFDemoWindow(subject_distance=self.distanceSpinBox.value()*10)
         self.demoWindow.show()
 
@@ -288,6 +311,55 @@ class IntroWindow(QWidget):
             self.close()
 
 
+def analyseSession(store_file, session, results, reversals = None):
+    """Fit the CSF of a finished test with a bootstrap confidence band, fit every
+    registered CSF model for model selection, store both and update the norms.
+    Runs on the analysis worker with its own results store connection, since
+    sqlite connections can't be shared between threads.
+
+    Parameters:
+        store_file (str): results store database
+        session (dict): name, session_name and session_id of the test
+        results (dict): thresholds measured at each spatial frequency
+        reversals (dict): staircase reversal values at each spatial frequency, which are
+            bootstrapped (default is None, the fit residuals are bootstrapped, e.g. for qCSF)
+
+    Returns:
+        session, sfs, sensitivities, fit line spatial frequencies, fit line sensitivities
+        and the (2 x 50) 95% confidence band of the fit line, and the best CSF model
+        by 'aic' and 'bic' (see csfmodels.selectModel), and the session's percentile rank
+        within its cohort at each spatial frequency (None if no cohort has enough sessions)
+    """
+
+    sortedKeys = sorted(results.keys())
+    sfs = np.asarray(sortedKeys)
+    values = 1/np.asarray([np.mean(results[key]) for key in sortedKeys])
+
+    xvals = CSF_CURVE_SFS
+    reversals = reversals or {}
+    samples = [reversals[key] if key in reversals else np.mean(results[key], keepdims = True) for key in sortedKeys]
+    parameters, _, band, _ = csfBootstrap(sfs, samples, xvals = xvals)
+    bestFit = csfParabola(xvals, *parameters)
+
+    modelFits = fitModels(sfs, values)
+    bestModels = {"aic": selectModel(modelFits), "bic": selectModel(modelFits, "bic")}
+
+    # The norms are opened before the thresholds are stored, since opening them adds any missing sessions
+    store = ResultsStore(store_file)
+    norms = NormTable(store)
+    store.addThresholds(session["session_id"], sfs, values)
+    store.addFit(session["session_id"], parameters)
+    store.addModelFits(session["session_id"], modelFits)
+
+    # Rank the session within its cohort, then add it to the cohort statistics
+    # that later subjects' staircases start from
+    _, ranks = norms.sessionPercentileRanks(session["session_id"])
+    norms.addSession(session["session_id"])
+    store.close()
+
+    return session, sfs, values, xvals, bestFit, band, bestModels, ranks
+
+
 def main() -> None:
     
     # Set the OpenGL version, profile, and bits-per-channel
@@ -300,6 +372,9 @@ def main() -> None:
     format_10bit.setAlphaBufferSize(2)
     QSurfaceFormat.setDefaultFormat(format_10bit)
 
+    # Share OpenGL objects between windows so shader programs are only built once
+    QApplication.setAttribute(Qt.ApplicationAttribute.AA_ShareOpenGLContexts)
+
     # Initialize the application
     app = QApplication(sys.argv)
 
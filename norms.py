@@ -0,0 +1,377 @@
+import argparse
+import numpy as np
+from resultsstore import ResultsStore, RESULTS_STORE_FILE
+from simulation import simulateStaircases, summarizeSimulation
+
+### Cohort Norm Table ###
+
+COHORT_SCHEMA = """
+DROP TABLE IF EXISTS norms;
+
+CREATE TABLE IF NOT EXISTS cohort_stats (
+    age_band INTEGER NOT NULL,
+    ethnicity TEXT NOT NULL,
+    eccentricity REAL NOT NULL,
+    stim_size REAL NOT NULL,
+    stim_duration REAL NOT NULL,
+    sf REAL NOT NULL,
+    count INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    m2 REAL NOT NULL,
+    sketch BLOB NOT NULL,
+    PRIMARY KEY (age_band, ethnicity, eccentricity, stim_size, stim_duration, sf)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS cohort_sessions (
+    session_id INTEGER PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE
+);
+"""
+
+COHORT_KEY_CLAUSE = "age_band = ? AND ethnicity = ? AND eccentricity = ? AND stim_size = ? AND stim_duration = ?"
+
+# Width of the age bands in years
+NORM_AGE_BAND = 10
+
+# Stands for every value of a field in a pooled cohort
+NORM_ANY = -1
+NORM_ANY_ETHNICITY = "*"
+
+# Fields pooled over, in order, when the cohort of a subject's own group has too few sessions
+NORM_POOLING = [(), ("ethnicity",), ("ethnicity", "age_band"), ("ethnicity", "age_band", "stim_duration"),
+                ("ethnicity", "age_band", "stim_duration", "stim_size"),
+                ("ethnicity", "age_band", "stim_duration", "stim_size", "eccentricity")]
+
+NORM_FIELDS = ["age_band", "ethnicity", "eccentricity", "stim_size", "stim_duration"]
+
+# Quantile sketch: a histogram of log10 sensitivity from 0.3 to 1000 in 0.025 log unit bins
+NORM_SKETCH_RANGE = (-0.5, 3.0)
+NORM_SKETCH_BINS = 140
+NORM_SKETCH_EDGES = np.linspace(*NORM_SKETCH_RANGE, NORM_SKETCH_BINS + 1)
+
+# Staircases start this factor below and above the expected threshold
+NORM_START_SPREAD = 2.0
+
+
+def normKey(age, ethnicity, eccentricity, stim_size, stim_duration, pooled = ()):
+    """Cohort key of a group, with the fields in (pooled) replaced by their 'any' value."""
+
+    fields = {"age_band": (age // NORM_AGE_BAND)*NORM_AGE_BAND, "ethnicity": ethnicity or "",
+              "eccentricity": eccentricity, "stim_size": stim_size, "stim_duration": stim_duration}
+
+    return tuple((NORM_ANY_ETHNICITY if field == "ethnicity" else NORM_ANY) if field in pooled else fields[field]
+                 for field in NORM_FIELDS)
+
+
+def sketchQuantile(sketch, q):
+    """Quantile(s) (q) in [0-1] of the log10 sensitivities counted in a sketch,
+    interpolated linearly within the bins."""
+
+    cumulative = np.concatenate([[0], np.cumsum(sketch)])/max(np.sum(sketch), 1)
+
+    return np.interp(q, cumulative, NORM_SKETCH_EDGES)
+
+
+def sketchRank(sketch, value):
+    """Percentile rank of log10 sensitivity (value) among those counted in a sketch."""
+
+    cumulative = np.concatenate([[0], np.cumsum(sketch)])/max(np.sum(sketch), 1)
+
+    return 100*np.interp(value, NORM_SKETCH_EDGES, cumulative)
+
+
+class NormTable:
+    """Running statistics of contrast sensitivity by cohort, kept up to date
+    one session at a time, so norms and percentile ranks never need a rescan
+    of the results.
+
+    A cohort is a group of sessions by age band, ethnicity, eccentricity,
+    stimulus size and duration, or one of the pooled groups in NORM_POOLING.
+    For every cohort and spatial frequency the indexed cohort_stats table holds
+    the count, mean and sum of squared deviations (Welford's algorithm) of
+    log10 sensitivity, and a fixed-size histogram sketch for quantiles and
+    percentile ranks. addSession updates them in constant time per session,
+    and sessions stored without it (e.g. by ResultsStore.importCSVTree or
+    before the statistics existed) are added when the table is opened.
+    Lookups use the first cohort with enough sessions, so a new combination of
+    settings still gets a usable norm.
+    """
+
+    def __init__(self, store, min_sessions = 5):
+        """
+        Parameters:
+            store (ResultsStore): results store holding the sessions and the cohort statistics
+            min_sessions (int): fewest sessions a cohort needs for its statistics to be used
+        """
+
+        self.store = store
+        self.min_sessions = min_sessions
+        self.store.connection.executescript(COHORT_SCHEMA)
+        self.addMissingSessions()
+
+    def addSession(self, session):
+        """Add the thresholds of a session to the statistics of every cohort it belongs to.
+        Sessions already added, and sessions without age or test settings, are skipped.
+
+        Returns:
+            bool: True if the session was added
+        """
+
+        connection = self.store.connection
+        info = self.sessionCohort(session)
+
+        if info is None:
+            return False
+
+        with connection:
+            if connection.execute("INSERT OR IGNORE INTO cohort_sessions (session_id) VALUES (?)", (session,)).rowcount == 0:
+                return False
+
+            thresholds = connection.execute("SELECT sf, sensitivity FROM thresholds WHERE session_id = ? AND sensitivity > 0",
+                                            (session,)).fetchall()
+
+            for pooled in NORM_POOLING:
+                key = normKey(*info, pooled)
+                for sf, sensitivity in thresholds:
+                    self.updateStatistics(key + (round(sf, 6),), np.log10(sensitivity))
+
+        return True
+
+    def addMissingSessions(self):
+        """Add every session with thresholds and a cohort that isn't in the statistics yet.
+
+        Returns:
+            int: number of sessions added
+        """
+
+        sessions = self.store.connection.execute(
+            """SELECT id FROM sessions WHERE age IS NOT NULL AND eccentricity IS NOT NULL AND stim_size IS NOT NULL
+                                         AND stim_duration IS NOT NULL
+                                         AND id NOT IN (SELECT session_id FROM cohort_sessions)
+                                         AND EXISTS (SELECT 1 FROM thresholds WHERE session_id = sessions.id)
+               ORDER BY id""").fetchall()
+
+        return sum(self.addSession(row[0]) for row in sessions)
+
+    def sessionCohort(self, session):
+        """(age, ethnicity, eccentricity, stim_size, stim_duration) of a session, None if any but ethnicity is unknown."""
+
+        info = self.store.connection.execute(
+            "SELECT age, ethnicity, eccentricity, stim_size, stim_duration FROM sessions WHERE id = ?", (session,)).fetchone()
+
+        if info is None or any(info[field] is None for field in ("age", "eccentricity", "stim_size", "stim_duration")):
+            return None
+
+        return tuple(info)
+
+    def updateStatistics(self, key, value):
+        """Count log10 sensitivity (value) in the statistics of cohort and spatial frequency (key)."""
+
+        row = self.store.connection.execute(f"SELECT count, mean, m2, sketch FROM cohort_stats WHERE {COHORT_KEY_CLAUSE} AND sf = ?",
+                                            key).fetchone()
+
+        if row is None:
+            count, mean, m2 = 0, 0.0, 0.0
+            sketch = np.zeros(NORM_SKETCH_BINS, dtype = np.uint32)
+        else:
+            count, mean, m2 = row["count"], row["mean"], row["m2"]
+            sketch = np.frombuffer(row["sketch"], dtype = np.uint32).copy()
+
+        count += 1
+        delta = value - mean
+        mean += delta/count
+        m2 += delta*(value - mean)
+
+        width = NORM_SKETCH_EDGES[1] - NORM_SKETCH_EDGES[0]
+        sketch[int(np.clip((value - NORM_SKETCH_RANGE[0])//width, 0, NORM_SKETCH_BINS - 1))] += 1
+
+        self.store.connection.execute(
+            """INSERT OR REPLACE INTO cohort_stats (age_band, ethnicity, eccentricity, stim_size, stim_duration, sf,
+                                                    count, mean, m2, sketch) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (*key, count, mean, m2, sketch.tobytes()))
+
+    def build(self):
+        """Recompute every cohort's statistics from all the sessions in the store
+        (e.g. after sessions were deleted or edited).
+
+        Returns:
+            int: number of sessions added
+        """
+
+        with self.store.connection:
+            self.store.connection.execute("DELETE FROM cohort_stats")
+            self.store.connection.execute("DELETE FROM cohort_sessions")
+
+        return self.addMissingSessions()
+
+    def cohort(self, age, ethnicity, eccentricity, stim_size, stim_duration):
+        """Statistics of the first cohort in NORM_POOLING order with at least
+        min_sessions sessions at every spatial frequency.
+
+        Returns:
+            dict: 'key' of the cohort and per spatial frequency arrays 'sfs', 'count', 'mean'
+            and 'std' of log10 sensitivity and 'sketch' (sfs x NORM_SKETCH_BINS), or None
+            if no cohort has enough sessions
+        """
+
+        for pooled in NORM_POOLING:
+            key = normKey(age, ethnicity, eccentricity, stim_size, stim_duration, pooled)
+            rows = self.store.connection.execute(
+                f"SELECT sf, count, mean, m2, sketch FROM cohort_stats WHERE {COHORT_KEY_CLAUSE} ORDER BY sf", key).fetchall()
+
+            if rows and min(row["count"] for row in rows) >= self.min_sessions:
+                count = np.asarray([row["count"] for row in rows])
+                return {"key": key,
+                        "sfs": np.asarray([row["sf"] for row in rows]),
+                        "count": count,
+                        "mean": np.asarray([row["mean"] for row in rows]),
+                        "std": np.sqrt(np.asarray([row["m2"] for row in rows])/np.maximum(count - 1, 1)),
+                        "sketch": np.stack([np.frombuffer(row["sketch"], dtype = np.uint32) for row in rows])}
+
+        return None
+
+    def norm(self, age, ethnicity, eccentricity, stim_size, stim_duration):
+        """Mean log10 sensitivity of the cohort picked by cohort.
+
+        Returns:
+            sfs (array): spatial frequencies of the norm (None if no cohort has enough sessions)
+            log_sensitivities (array): mean log10 contrast sensitivity at each spatial frequency
+        """
+
+        cohort = self.cohort(age, ethnicity, eccentricity, stim_size, stim_duration)
+
+        if cohort is None:
+            return None, None
+
+        return cohort["sfs"], cohort["mean"]
+
+    def percentileRanks(self, sfs, sensitivities, age, ethnicity, eccentricity, stim_size, stim_duration):
+        """Percentile rank of a subject's sensitivity at each spatial frequency within their
+        cohort (NaN at spatial frequencies the cohort wasn't tested at, None if there is no cohort)."""
+
+        cohort = self.cohort(age, ethnicity, eccentricity, stim_size, stim_duration)
+
+        if cohort is None:
+            return None
+
+        rows = {round(sf, 6): i for i, sf in enumerate(cohort["sfs"])}
+
+        return np.asarray([sketchRank(cohort["sketch"][rows[round(float(sf), 6)]], np.log10(sensitivity))
+                           if round(float(sf), 6) in rows else np.nan for sf, sensitivity in zip(sfs, sensitivities)])
+
+    def sessionPercentileRanks(self, session):
+        """Percentile ranks of a recorded session's sensitivities within its cohort (see percentileRanks).
+
+        Returns:
+            sfs (array), percentile ranks (array, None if there is no cohort)
+        """
+
+        thresholds = self.store.connection.execute("SELECT sf, sensitivity FROM thresholds WHERE session_id = ? ORDER BY sf",
+                                                   (session,)).fetchall()
+        sfs = np.asarray([row[0] for row in thresholds])
+        info = self.sessionCohort(session)
+
+        if info is None:
+            return sfs, None
+
+        return sfs, self.percentileRanks(sfs, [row[1] for row in thresholds], *info)
+
+    def expectedThresholds(self, sfs, age, ethnicity, eccentricity, stim_size, stim_duration):
+        """Expected contrast thresholds at (sfs), interpolated from the norm in log-log
+        coordinates (None if there is no norm)."""
+
+        norm_sfs, log_sensitivities = self.norm(age, ethnicity, eccentricity, stim_size, stim_duration)
+
+        if norm_sfs is None:
+            return None
+
+        return 1/10**np.interp(np.log10(sfs), np.log10(norm_sfs), log_sensitivities)
+
+
+def normStartValues(expected_thresholds, num_staircases = 2, spread = NORM_START_SPREAD, min_value = 0.001):
+    """(N x num_staircases) start values for staircases spread evenly in log contrast
+    from (spread) times below to (spread) times above each expected threshold."""
+
+    expected_thresholds = np.asarray(expected_thresholds, dtype = np.float64)[:, np.newaxis]
+
+    return np.clip(expected_thresholds*np.geomspace(1/spread, spread, num_staircases), min_value, 1.0)
+
+
+def simulateNormStarts(norm_thresholds, individual_sd = 0.2, num_observers = 2000, spread = NORM_START_SPREAD,
+                       fixed_start_vals = (0.005, 0.8), seed = None):
+    """Compare staircases starting from fixed contrasts with staircases seeded from a norm,
+    for simulated observers whose thresholds scatter around the norm.
+
+    Parameters:
+        norm_thresholds (array): expected threshold at each spatial frequency of a session
+        individual_sd (float): standard deviation of observers around the norm (log10 units)
+        num_observers (int): observers simulated per spatial frequency
+        spread (float): see normStartValues
+        fixed_start_vals (tuple): start values of the unseeded staircases
+        seed (int): random seed
+
+    Returns:
+        dict: {'fixed', 'norm'} summaries, each with the mean trials per session and the
+        mean log10 bias and variance of the threshold estimates over spatial frequencies
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Both kinds of start see the same observers
+    observers = [np.minimum(threshold*10**rng.normal(0, individual_sd, num_observers), 1.0)
+                 for threshold in norm_thresholds]
+    starts = {"fixed": lambda threshold: fixed_start_vals,
+              "norm": lambda threshold: normStartValues([threshold], spread = spread)[0]}
+    summary = {}
+
+    for name, start in starts.items():
+        trials = 0
+        log_bias = []
+        log_variance = []
+
+        for threshold, thresholds in zip(norm_thresholds, observers):
+            simulation = simulateStaircases(thresholds, num_observers, start(threshold), seed = rng.integers(2**32))
+            result = summarizeSimulation(simulation)
+            trials += result["mean_trials"]
+            log_bias.append(result["log_bias"])
+            log_variance.append(result["log_variance"])
+
+        summary[name] = {"mean_trials": trials, "log_bias": np.mean(log_bias), "log_variance": np.mean(log_variance)}
+
+    return summary
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description = "Rebuild the cohort statistics and simulate norm-seeded staircases.")
+    parser.add_argument("database", nargs = "?", default = RESULTS_STORE_FILE, help = "results store database")
+    parser.add_argument("--simulate", action = "store_true",
+                        help = "compare trials per session of fixed and norm-seeded staircases")
+    parser.add_argument("--age", type = int, default = 30)
+    parser.add_argument("--ethnicity", default = "")
+    parser.add_argument("--eccentricity", type = float, default = 2)
+    parser.add_argument("--size", type = float, default = 2)
+    parser.add_argument("--duration", type = float, default = 250)
+    args = parser.parse_args()
+
+    store = ResultsStore(args.database)
+    norms = NormTable(store)
+    print(f"Added {norms.build()} sessions from {args.database} to the cohort statistics")
+
+    if args.simulate:
+        from corefunctions import csfParabola
+
+        sfs = np.geomspace(0.5, 32, 13)
+        expected = norms.expectedThresholds(sfs, args.age, args.ethnicity, args.eccentricity, args.size, args.duration)
+        if expected is None:
+            print("No norm with enough sessions, simulating around the population CSF")
+            expected = 1/csfParabola(sfs, 200, 3, 3.5, 20)
+
+        for name, result in simulateNormStarts(expected, seed = 0).items():
+            print(f"{name:>6} start: {result['mean_trials']:.1f} trials per session, "
+                  f"log bias {result['log_bias']:.3f}, log variance {result['log_variance']:.4f}")
+
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
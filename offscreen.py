@@ -0,0 +1,170 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from OpenGL import GL
+from PyQt6.QtGui import QGuiApplication, QOffscreenSurface, QOpenGLContext, QSurfaceFormat
+from PyQt6.QtOpenGL import QOpenGLFramebufferObject, QOpenGLFramebufferObjectFormat
+from corefunctions import ScreenGeometry
+from classes import GLGratingStim, GL_CSFTestWindow
+
+### Headless Offscreen Rendering ###
+
+# Mid gray background used by the demo and test windows
+BACKGROUND_COLOR = (0.5**(1/2.42), 0.5**(1/2.42), 0.5**(1/2.42), 1.0)
+
+
+def syntheticGeometry(subject_distance = 1000, pixel_dims = (1920, 1080), mm_dims = (527.0, 296.4), pixel_ratio = 1.0):
+    """Screen geometry of a display that doesn't have to exist (default is a 24 inch 1080p monitor)."""
+
+    return ScreenGeometry(subject_distance, pixel_ratio, pixel_dims, mm_dims)
+
+
+class OffscreenRenderer:
+    """Renders stims into a framebuffer object through a QOffscreenSurface, so
+    GLGratingStim, GLImageStim and the test window's paintGL run without a
+    display. With the Qt 'offscreen' platform and Mesa this works on headless
+    machines (e.g. QT_QPA_PLATFORM=offscreen LIBGL_ALWAYS_SOFTWARE=1).
+
+    The framebuffer has the size of the geometry in device pixels and a
+    10 bit per channel color buffer, like the full screen windows request,
+    so pixels read back are what the stimulus shader produced.
+    """
+
+    def __init__(self, geometry = None, refresh_rate = 60.0, internal_format = GL.GL_RGB10_A2):
+        """
+        Parameters:
+            geometry (ScreenGeometry): screen to emulate (default is syntheticGeometry())
+            refresh_rate (float): refresh rate in Hz used for frame-counted timing
+            internal_format (GLenum): color buffer format of the framebuffer
+        """
+
+        if QGuiApplication.instance() is None:
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+            self.app = QGuiApplication(sys.argv)
+
+        if geometry is None:
+            geometry = syntheticGeometry()
+
+        self.geometry = geometry
+        self.refresh_rate = refresh_rate
+        self.width, self.height = (int(round(dim)) for dim in geometry.device_pixel_dims)
+
+        surface_format = QSurfaceFormat()
+        surface_format.setVersion(3, 3)
+        surface_format.setProfile(QSurfaceFormat.OpenGLContextProfile.CoreProfile)
+
+        self.surface = QOffscreenSurface()
+        self.surface.setFormat(surface_format)
+        self.surface.create()
+
+        self.context = QOpenGLContext()
+        self.context.setFormat(surface_format)
+        if not self.context.create() or not self.context.makeCurrent(self.surface):
+            raise RuntimeError("Could not create an offscreen OpenGL 3.3 context")
+
+        fbo_format = QOpenGLFramebufferObjectFormat()
+        fbo_format.setInternalTextureFormat(internal_format)
+        self.fbo = QOpenGLFramebufferObject(self.width, self.height, fbo_format)
+
+    def makeCurrent(self):
+        """Make the offscreen context current and bind its framebuffer."""
+
+        self.context.makeCurrent(self.surface)
+        self.fbo.bind()
+        GL.glViewport(0, 0, self.width, self.height)
+
+    def render(self, draw, clear = True):
+        """Clear the framebuffer to the background and call (draw), a callable
+        issuing GL commands (e.g. stim.use or window.paintGL). Waits for the GPU
+        to finish so the call covers the whole cost of the frame."""
+
+        self.makeCurrent()
+
+        if clear:
+            GL.glClearColor(*BACKGROUND_COLOR)
+            GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+
+        GL.glEnable(GL.GL_BLEND)
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+
+        draw()
+        GL.glFinish()
+
+    def renderWindowFrame(self, window):
+        """Render one frame of a window set up with initializeStims and emulate the
+        buffer swap, so its frame log and frame-counted scheduler advance."""
+
+        self.render(window.paintGL, clear = False)
+        window.frameLog.frameSwapped()
+        window.scheduler.advance()
+
+    def readPixels(self):
+        """Read back the framebuffer as a (height x width x 4) float32 RGBA array
+        in [0-1], top row first."""
+
+        self.makeCurrent()
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        pixels = GL.glReadPixels(0, 0, self.width, self.height, GL.GL_RGBA, GL.GL_FLOAT)
+        pixels = np.frombuffer(pixels, dtype = np.float32).reshape(self.height, self.width, 4)
+
+        return np.flipud(pixels)
+
+    def benchmark(self, draw, num_frames = 100, warmup = 10):
+        """Time (num_frames) renders of (draw) after (warmup) untimed ones.
+
+        Returns:
+            array: time per frame in ms
+        """
+
+        for _ in range(warmup):
+            self.render(draw)
+
+        times = np.empty(num_frames)
+        for i in range(num_frames):
+            start = time.perf_counter_ns()
+            self.render(draw)
+            times[i] = (time.perf_counter_ns() - start)/1e6
+
+        return times
+
+    def testWindow(self, **kwargs):
+        """Create a GL_CSFTestWindow (never shown) with its stims built for this
+        renderer's geometry. kwargs are passed to GL_CSFTestWindow."""
+
+        self.makeCurrent()
+        window = GL_CSFTestWindow(**kwargs)
+        window.initializeStims(self.geometry, self.refresh_rate)
+
+        return window
+
+    def destroy(self):
+        self.makeCurrent()
+        self.fbo.release()
+        self.fbo = None
+        self.context.doneCurrent()
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description = "Render gratings offscreen and report the cost per frame.")
+    parser.add_argument("-n", "--frames", type = int, default = 200, help = "number of timed frames")
+    parser.add_argument("-d", "--distance", type = float, default = 1000, help = "subject distance in mm")
+    parser.add_argument("-s", "--size", type = float, default = 2, help = "grating size in degrees")
+    args = parser.parse_args()
+
+    renderer = OffscreenRenderer(syntheticGeometry(args.distance))
+    renderer.makeCurrent()
+    grating = GLGratingStim(size = args.size, subject_distance = args.distance, sf = 4, contrast = 0.5,
+                            geometry = renderer.geometry)
+
+    times = renderer.benchmark(grating.use, args.frames)
+    print(f"{GL.glGetString(GL.GL_RENDERER).decode()}: "
+          f"median {np.median(times):.3f} ms, 95th percentile {np.percentile(times, 95):.3f} ms per frame")
+
+    renderer.destroy()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from corefunctions import csfParabolaBatch
+from simulation import weibullPsychometric
+
+### Bayesian Adaptive CSF Estimation (qCSF) ###
+
+# Parameter sets whose posterior falls below this fraction of the maximum are
+# dropped from the information gain computation
+QCSF_PRUNE_RATIO = 1e-8
+
+# Default parameter grid for [peak_sensitivity, peak_frequency, width_l, width_r]
+QCSF_PARAMETER_GRID = (np.geomspace(5, 500, 12),
+                       np.geomspace(0.5, 10, 10),
+                       np.geomspace(1.5, 30, 6),
+                       np.geomspace(3, 100, 8))
+
+QCSF_CACHE_DIR = "Cache"
+
+# Builds QuickCSF estimators (and any likelihood tables missing from the cache) and
+# runs their lookaheads off the GUI thread
+_quickCSFWorker = None
+
+def quickCSFWorker():
+    global _quickCSFWorker
+
+    if _quickCSFWorker is None:
+        _quickCSFWorker = ThreadPoolExecutor(max_workers = 1)
+
+    return _quickCSFWorker
+
+
+class QuickCSF:
+    """Bayesian adaptive estimate of the four csfParabola parameters.
+
+    The posterior lives on a fixed grid of parameter sets and every candidate
+    stimulus is a (spatial frequency, contrast) pair. The probability of a
+    correct response for every parameter set and stimulus, and its binary
+    entropy, are computed once and cached on disk, so each trial only costs
+    one column update of the posterior and one vector-matrix product to score
+    every stimulus by expected information gain. Parameter sets the posterior
+    has ruled out are pruned from that product as the estimate converges.
+
+    lookahead does that work for both possible responses on a worker thread
+    while a stimulus is shown, so update and nextStimulus only pick up the
+    result when the response comes in. The posterior and support are replaced
+    rather than modified in place, so a lookahead can read them safely.
+    """
+
+    def __init__(self, sfs, contrasts = None, parameter_grid = QCSF_PARAMETER_GRID, slope = 3.5,
+                 guess_rate = 0.25, lapse_rate = 0.02, cache_dir = QCSF_CACHE_DIR, seed = None):
+        """
+        Parameters:
+            sfs (list or array): spatial frequencies that may be tested (c/deg)
+            contrasts (list or array): contrasts that may be tested (default is 40 log-spaced values from 0.001 to 1)
+            parameter_grid (tuple of arrays): grid values of each of the 4 csfParabola parameters
+            slope, guess_rate, lapse_rate (float): observer psychometric function (see weibullPsychometric)
+            cache_dir (str): directory for cached likelihood tables (None to disable)
+            seed (int): random seed used to break ties between good stimuli
+        """
+
+        if contrasts is None:
+            contrasts = np.geomspace(0.001, 1.0, 40)
+
+        self.sfs = np.asarray(sfs, dtype = np.float64)
+        self.contrasts = np.asarray(contrasts, dtype = np.float64)
+        self.parameter_grid = tuple(np.asarray(values, dtype = np.float64) for values in parameter_grid)
+        self.slope = slope
+        self.guess_rate = guess_rate
+        self.lapse_rate = lapse_rate
+        self.rng = np.random.default_rng(seed)
+
+        # Flattened (P x 4) parameter sets and (K x 2) [sf, contrast] stimuli
+        self.parameters = np.stack([grid.ravel() for grid in np.meshgrid(*self.parameter_grid, indexing = 'ij')], axis = 1)
+        sf_grid, contrast_grid = np.meshgrid(self.sfs, self.contrasts, indexing = 'ij')
+        self.stimuli = np.stack([sf_grid.ravel(), contrast_grid.ravel()], axis = 1)
+
+        # Likelihood and entropy share one (P x 2K) table so a single product scores every stimulus
+        self.tables = self.loadTables(cache_dir)
+        self.likelihood = self.tables[:, :len(self.stimuli)]
+        self.entropy = self.tables[:, len(self.stimuli):]
+
+        self.reset()
+
+    def tableKey(self):
+        """Hash of everything the likelihood tables depend on."""
+
+        digest = hashlib.sha1()
+        for values in (self.sfs, self.contrasts, *self.parameter_grid,
+                       np.asarray([self.slope, self.guess_rate, self.lapse_rate])):
+            digest.update(np.ascontiguousarray(values, dtype = np.float64).tobytes())
+
+        return digest.hexdigest()[:16]
+
+    def buildTables(self):
+        """Compute the (P x K) probability of a correct response and its binary
+        entropy, side by side in a single (P x 2K) float32 table."""
+
+        sensitivity = csfParabolaBatch(self.sfs, self.parameters)
+        p_correct = weibullPsychometric(self.contrasts[np.newaxis, np.newaxis, :],
+                                        1/sensitivity[:, :, np.newaxis],
+                                        self.slope, self.guess_rate, self.lapse_rate)
+        p_correct = p_correct.reshape(len(self.parameters), -1)
+
+        return np.concatenate([p_correct, binaryEntropy(p_correct)], axis = 1).astype(np.float32)
+
+    def loadTables(self, cache_dir):
+        """Load likelihood tables from the disk cache, building and saving them if needed."""
+
+        if cache_dir is None:
+            return self.buildTables()
+
+        filename = os.path.join(cache_dir, f"qcsf_{self.tableKey()}.npy")
+
+        # A truncated or corrupt cache file (e.g. from a crash while saving) is rebuilt
+        if os.path.isfile(filename):
+            try:
+                tables = np.load(filename)
+                if tables.shape == (len(self.parameters), 2*len(self.stimuli)):
+                    return tables
+            except (OSError, ValueError, EOFError):
+                pass
+
+        tables = self.buildTables()
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Saved under a temporary name first, so the cache never holds a partly written table
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            np.save(file, tables)
+        os.replace(temporary, filename)
+
+        return tables
+
+    def reset(self, prior = None):
+        """Start a new estimate from a uniform (or given) prior over the parameter grid."""
+
+        if prior is None:
+            prior = np.ones(len(self.parameters), dtype = np.float32)
+
+        self.posterior = np.asarray(prior, dtype = np.float32)/np.sum(prior)
+        self.numTrials = 0
+
+        self.support = np.arange(len(self.parameters))
+        self.supportTables = self.tables
+
+        # Lookahead of the stimulus shown (see lookahead) and the next stimulus it chose
+        self.pending = None
+        self.nextChoice = None
+
+    def prunedSupport(self, posterior, support, support_tables):
+        """Parameter sets of (posterior) that still carry posterior mass and their
+        tables, compacted only when the current (support) halves."""
+
+        pruned = np.flatnonzero(posterior >= posterior.max()*QCSF_PRUNE_RATIO)
+
+        if len(pruned) <= len(support)//2:
+            return pruned, self.tables[pruned]
+
+        return support, support_tables
+
+    def prune(self):
+        """Restrict the information gain computation to parameter sets that still carry posterior mass."""
+
+        self.support, self.supportTables = self.prunedSupport(self.posterior, self.support, self.supportTables)
+
+    def expectedInformationGain(self, posterior = None, support = None, support_tables = None):
+        """Expected reduction in posterior entropy for every candidate stimulus
+        (default is for the current posterior)."""
+
+        if posterior is None:
+            posterior, support, support_tables = self.posterior, self.support, self.supportTables
+
+        posterior = posterior[support]
+        expected = (posterior/posterior.sum()) @ support_tables
+        num_stimuli = len(self.stimuli)
+
+        return binaryEntropy(expected[:num_stimuli]) - expected[num_stimuli:]
+
+    def chooseStimulus(self, gain, top_fraction, rng):
+        """Index of a stimulus drawn at random from the (top_fraction) with the highest (gain)."""
+
+        num_best = max(1, int(len(gain)*top_fraction))
+        best = np.argpartition(gain, -num_best)[-num_best:]
+
+        return int(rng.choice(best))
+
+    def updatedPosterior(self, posterior, index, correct):
+        """(posterior) updated with the response to stimulus (index), as a new array."""
+
+        likelihood = self.likelihood[:, index]
+        posterior = posterior*likelihood if correct else posterior*(1 - likelihood)
+
+        return posterior/posterior.sum()
+
+    def nextStimulus(self, top_fraction = 0.1):
+        """Choose the next stimulus at random from the most informative ones,
+        or take the one the lookahead chose.
+
+        Returns:
+            index (int): stimulus index, to be passed back to update
+            sf (float): spatial frequency in c/deg
+            contrast (float): contrast [0-1]
+        """
+
+        if self.nextChoice is not None and self.nextChoice[0] == top_fraction:
+            index = self.nextChoice[1]
+        else:
+            index = self.chooseStimulus(self.expectedInformationGain(), top_fraction, self.rng)
+
+        self.nextChoice = None
+
+        return index, self.stimuli[index, 0], self.stimuli[index, 1]
+
+    def lookahead(self, index, top_fraction = 0.1):
+        """Start updating the posterior with both possible responses to stimulus
+        (index), and choosing the stimulus after each, on the worker thread.
+        Call it when the stimulus is chosen; update and nextStimulus then only
+        pick up the result for the actual response."""
+
+        seed = self.rng.integers(2**32)
+        self.pending = (index, top_fraction, quickCSFWorker().submit(self.lookaheadOutcomes, index, top_fraction, seed))
+
+    def lookaheadOutcomes(self, index, top_fraction, seed):
+        """(posterior, support, support tables, next stimulus) after an incorrect and a correct response."""
+
+        rng = np.random.default_rng(seed)
+        outcomes = []
+
+        for correct in (False, True):
+            posterior = self.updatedPosterior(self.posterior, index, correct)
+            support, support_tables = self.prunedSupport(posterior, self.support, self.supportTables)
+            gain = self.expectedInformationGain(posterior, support, support_tables)
+            outcomes.append((posterior, support, support_tables, self.chooseStimulus(gain, top_fraction, rng)))
+
+        return outcomes
+
+    def update(self, index, correct):
+        """Update the posterior with the response to stimulus (index)."""
+
+        if self.pending is not None and self.pending[0] == index:
+            _, top_fraction, outcomes = self.pending
+            self.posterior, self.support, self.supportTables, choice = outcomes.result()[bool(correct)]
+            self.nextChoice = (top_fraction, choice)
+        else:
+            self.posterior = self.updatedPosterior(self.posterior, index, correct)
+            self.prune()
+            self.nextChoice = None
+
+        self.pending = None
+        self.numTrials += 1
+
+    def estimate(self):
+        """Posterior mean of the 4 csfParabola parameters (taken in log10 space)."""
+
+        return 10**(self.posterior @ np.log10(self.parameters))
+
+    def sensitivity(self, sfs = None):
+        """Estimated contrast sensitivity at (sfs) (default is the tested sfs)."""
+
+        if sfs is None:
+            sfs = self.sfs
+
+        return csfParabolaBatch(sfs, self.estimate())[0]
+
+
+def loadQuickCSF(sfs, **kwargs):
+    """Build a QuickCSF on a worker thread, so building its likelihood tables
+    on a cold cache doesn't block the caller (e.g. the GUI thread).
+
+    Parameters:
+        sfs (list or array): spatial frequencies that may be tested (c/deg)
+        kwargs: passed to QuickCSF
+
+    Returns:
+        concurrent.futures.Future: resolves to the QuickCSF
+    """
+
+    return quickCSFWorker().submit(QuickCSF, sfs, **kwargs)
+
+
+def binaryEntropy(p):
+    """Entropy in bits of a binary outcome with probability (p)."""
+
+    p = np.clip(p, 1e-6, 1 - 1e-6)
+
+    return -(p*np.log2(p) + (1 - p)*np.log2(1 - p))
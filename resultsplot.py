@@ -0,0 +1,150 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from corefunctions import csfParabola, CSF_CURVE_SFS
+
+import matplotlib
+matplotlib.use('QtAgg')
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+
+## Plotting Class ##
+
+# Placeholder shown before the first test: sample sensitivities and their fit,
+# precomputed with csfFitParameters so startup doesn't run a least squares fit
+SAMPLE_SFS = np.geomspace(0.5, 32, 13)
+SAMPLE_DATA = np.asarray([60, 82, 108, 132, 149, 161, 152, 126, 90, 43, 23, 8, 2.3])
+SAMPLE_FIT_PARAMETERS = (159.99387656, 3.37398925, 6.13534966, 24.24017809)
+
+
+class ResultsPlot(FigureCanvasQTAgg):
+    """CSF results plot that is drawn in full once and then updated in place.
+
+    The axes, ticks, labels and grid make up a cached background. The data,
+    confidence band, fit line, title and legend are animated artists drawn on
+    top of it, so setResults only restores the background, redraws those
+    artists and blits. export saves the plot on a worker thread.
+    """
+
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = fig.add_subplot(111)
+        super(ResultsPlot, self).__init__(fig)
+
+        self.background = None
+        self.exporter = ThreadPoolExecutor(max_workers = 1)
+
+        self.setUpAxes()
+        self.mpl_connect('draw_event', self.onDraw)
+        self.setPlaceholderResults()
+
+    def setUpAxes(self):
+        self.band = self.axes.add_patch(Polygon(np.zeros((0, 2)), closed = True, facecolor = 'r', edgecolor = 'none',
+                                                alpha = 0.2, label = "95% CI"))
+        self.dataLine, = self.axes.plot([], [], linestyle = 'none', marker = 's', color='k', label = "Data")
+        self.fitLine, = self.axes.plot([], [], "-r", label="Best Fit", linewidth = 2)
+        self.axes.set_xscale('log')
+        self.axes.set_yscale('log')
+        self.axes.set_ylim([1,200])
+        self.axes.set_xlim(([0.1, 50]))
+        self.axes.set_yticks([1, 10, 50, 100, 200], ['1', '10', '50', '100', '200'])
+        self.axes.set_xticks([0.1, 0.5, 1, 2, 4, 8, 16, 32], ['0.1', '0.5', '1', '2', '4', '8', '16', '32'])
+        self.axes.set_xlabel("Spatial Frequency (c/deg)")
+        self.axes.set_ylabel("Contrast Sensitivity")
+        self.title = self.axes.set_title("")
+        self.axes.grid(True)
+
+        # Everything that changes between sessions is kept out of the cached background
+        self.legend = None
+        self.resultArtists = [self.band, self.dataLine, self.fitLine, self.title]
+        for artist in self.resultArtists:
+            artist.set_animated(True)
+
+        self.setLegend()
+
+    def setLegend(self, show_band = False):
+        """Replace the legend, listing the confidence band only if it is shown."""
+
+        if self.legend is not None:
+            self.legend.remove()
+            self.resultArtists.remove(self.legend)
+
+        self.legend = self.axes.legend(handles = [self.dataLine, self.fitLine] + ([self.band] if show_band else []))
+        self.legend.set_animated(True)
+        self.resultArtists.append(self.legend)
+
+    def setPlaceholderResults(self):
+        bestFit = csfParabola(CSF_CURVE_SFS, *SAMPLE_FIT_PARAMETERS)
+
+        self.setResults(SAMPLE_SFS, SAMPLE_DATA, CSF_CURVE_SFS, bestFit, "Sample CSF Results", data_label = "Sample Data")
+
+    def setResults(self, sfs, values, xvals, best_fit, title, data_label = "Data", band = None, ci = 95):
+        """Show new results, updating the existing artists in place.
+
+        Parameters:
+            sfs, values (array): measured spatial frequencies and sensitivities
+            xvals, best_fit (array): spatial frequencies and sensitivities of the fit line
+            title (str): plot title
+            data_label (str): legend label of the measured data
+            band (array): optional (2 x len(xvals)) lower and upper confidence limits of the fit
+                (see csfBootstrap, default is None, no band)
+            ci (float): confidence level of the band in percent
+        """
+
+        self.dataLine.set_data(sfs, values)
+        self.dataLine.set_label(data_label)
+        self.fitLine.set_data(xvals, best_fit)
+        self.title.set_text(title)
+
+        if band is None:
+            self.band.set_xy(np.zeros((0, 2)))
+        else:
+            self.band.set_xy(np.column_stack([np.concatenate([xvals, xvals[::-1]]),
+                                              np.concatenate([band[0], band[1][::-1]])]))
+            self.band.set_label(f"{ci:g}% CI")
+
+        self.setLegend(band is not None)
+
+        if self.background is None:
+            # Not drawn yet, onDraw draws the artists once the background exists
+            self.draw_idle()
+            return
+
+        self.restore_region(self.background)
+        self.drawResultArtists()
+        self.blit(self.figure.bbox)
+
+    def drawResultArtists(self):
+        for artist in self.resultArtists:
+            self.figure.draw_artist(artist)
+
+    def onDraw(self, event):
+        # Full redraws (first show, resize) refresh the background, then add the results on top
+        self.background = self.copy_from_bbox(self.figure.bbox)
+        self.drawResultArtists()
+
+    def export(self, filename):
+        """Save the plot to (filename) (png, pdf or any other matplotlib format)
+        on a worker thread. The figure is snapshotted here, so it can keep being
+        updated while the file is written.
+
+        Returns:
+            concurrent.futures.Future: completes when the file is written
+        """
+
+        return self.exporter.submit(saveFigureSnapshot, pickle.dumps(self.figure), filename)
+
+
+def saveFigureSnapshot(snapshot, filename):
+    """Render a pickled figure to (filename) with its own Agg canvas (runs on a worker thread)."""
+
+    figure = pickle.loads(snapshot)
+
+    # Animated artists are skipped by a normal draw
+    for artist in figure.findobj(lambda artist: artist.get_animated()):
+        artist.set_animated(False)
+
+    FigureCanvasAgg(figure)
+    figure.savefig(filename)
@@ -0,0 +1,352 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import numpy as np
+from batchfit import readTestResults, fitSubject
+
+### SQLite Results Store ###
+
+RESULTS_STORE_FILE = os.path.join("Results", "Results.db")
+
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    subject_id INTEGER NOT NULL REFERENCES subjects(id),
+    started TEXT,
+    age INTEGER,
+    ethnicity TEXT,
+    stim_duration REAL,
+    stim_size REAL,
+    eccentricity REAL,
+    distance REAL,
+    method TEXT
+);
+
+CREATE TABLE IF NOT EXISTS thresholds (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    sf REAL NOT NULL,
+    sensitivity REAL NOT NULL,
+    PRIMARY KEY (session_id, sf)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS fits (
+    session_id INTEGER PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+    peak_sensitivity REAL,
+    peak_frequency REAL,
+    width_l REAL,
+    width_r REAL
+);
+
+CREATE TABLE IF NOT EXISTS model_fits (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    model TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    rss REAL,
+    aic REAL,
+    bic REAL,
+    PRIMARY KEY (session_id, model)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS csv_imports (
+    subject_id INTEGER PRIMARY KEY REFERENCES subjects(id)
+);
+
+CREATE INDEX IF NOT EXISTS sessions_subject ON sessions(subject_id, started);
+CREATE INDEX IF NOT EXISTS sessions_age ON sessions(age);
+CREATE INDEX IF NOT EXISTS sessions_ethnicity ON sessions(ethnicity, age);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions(started);
+CREATE INDEX IF NOT EXISTS thresholds_sf ON thresholds(sf);
+"""
+
+SESSION_COLUMNS = """sessions.id AS session, subjects.name AS name, sessions.started AS started,
+                     sessions.age AS age, sessions.ethnicity AS ethnicity, sessions.stim_duration AS stim_duration,
+                     sessions.stim_size AS stim_size, sessions.eccentricity AS eccentricity,
+                     sessions.distance AS distance, sessions.method AS method"""
+
+
+class ResultsStore:
+    """One SQLite database holding every subject's sessions, per-SF sensitivities
+    and CSF fit parameters, indexed by subject, age, ethnicity and date so cohort
+    queries don't have to walk the Results directory tree."""
+
+    def __init__(self, filename = RESULTS_STORE_FILE):
+        """
+        Parameters:
+            filename (str): database file, created with its schema if it doesn't exist
+        """
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(RESULTS_SCHEMA)
+
+    def subjectId(self, name):
+        """Id of subject (name), added if new."""
+
+        self.connection.execute("INSERT OR IGNORE INTO subjects (name) VALUES (?)", (name,))
+
+        return self.connection.execute("SELECT id FROM subjects WHERE name = ?", (name,)).fetchone()[0]
+
+    def addSession(self, name, age = None, ethnicity = None, stim_duration = None, stim_size = None,
+                   eccentricity = None, distance = None, method = None, started = None):
+        """Record the start of a test session.
+
+        Parameters:
+            name (str): subject name
+            age (int), ethnicity (str): subject information
+            stim_duration (ms), stim_size (deg), eccentricity (deg), distance (cm): test settings
+            method (str): procedure ('staircase' or 'qcsf')
+            started (str): ISO 8601 start time (default is None, unknown)
+
+        Returns:
+            int: session id
+        """
+
+        with self.connection:
+            return self.insertSession(name, age, ethnicity, stim_duration, stim_size, eccentricity, distance, method, started)
+
+    def addThresholds(self, session, sfs, sensitivities):
+        """Record the contrast sensitivity measured at each spatial frequency of a session."""
+
+        with self.connection:
+            self.insertThresholds(session, sfs, sensitivities)
+
+    def addFit(self, session, parameters):
+        """Record the [peak_sensitivity, peak_frequency, width_l, width_r] fit of a session."""
+
+        with self.connection:
+            self.insertFit(session, parameters)
+
+    def addFits(self, fits):
+        """Record the fits of several sessions ({session: parameters}) in one transaction."""
+
+        with self.connection:
+            for session, parameters in fits.items():
+                self.insertFit(session, parameters)
+
+    # The insert methods don't commit, so several can make up one transaction (see importCSVTree)
+
+    def insertSession(self, name, age, ethnicity, stim_duration, stim_size, eccentricity, distance, method, started):
+        cursor = self.connection.execute(
+            """INSERT INTO sessions (subject_id, started, age, ethnicity, stim_duration, stim_size,
+                                     eccentricity, distance, method) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (self.subjectId(name), started, age, ethnicity, stim_duration, stim_size, eccentricity, distance, method))
+
+        return cursor.lastrowid
+
+    def insertThresholds(self, session, sfs, sensitivities):
+        self.connection.executemany("INSERT OR REPLACE INTO thresholds (session_id, sf, sensitivity) VALUES (?, ?, ?)",
+                                    [(session, float(sf), float(value)) for sf, value in zip(sfs, sensitivities)])
+
+    def insertFit(self, session, parameters):
+        self.connection.execute("""INSERT OR REPLACE INTO fits (session_id, peak_sensitivity, peak_frequency,
+                                   width_l, width_r) VALUES (?, ?, ?, ?, ?)""",
+                                (session, *(float(value) for value in parameters)))
+
+    def addModelFits(self, session, fits):
+        """Record the fit of every CSF model of a session (see csfmodels.fitModels).
+        Parameters are stored as a JSON list, since models have different numbers of them."""
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO model_fits (session_id, model, parameters, rss, aic, bic) VALUES (?, ?, ?, ?, ?, ?)",
+                [(session, model, json.dumps([float(value) for value in fit["parameters"]]), fit["rss"], fit["aic"], fit["bic"])
+                 for model, fit in fits.items()])
+
+    def modelFits(self, session):
+        """CSF model fits of a session, in the form of csfmodels.fitModels, best AIC first."""
+
+        rows = self.connection.execute("SELECT model, parameters, rss, aic, bic FROM model_fits WHERE session_id = ? ORDER BY aic",
+                                       (session,)).fetchall()
+
+        return {row["model"]: {"parameters": np.asarray(json.loads(row["parameters"])), "rss": row["rss"],
+                               "aic": row["aic"], "bic": row["bic"]} for row in rows}
+
+    def filterClause(self, name = None, min_age = None, max_age = None, ethnicity = None, start = None, end = None):
+        """SQL WHERE clause and arguments selecting sessions (every filter is optional,
+        start and end are ISO 8601 dates or times, end is exclusive)."""
+
+        conditions = []
+        args = []
+
+        for condition, value in (("subjects.name = ?", name), ("sessions.age >= ?", min_age),
+                                 ("sessions.age <= ?", max_age), ("sessions.ethnicity = ?", ethnicity),
+                                 ("sessions.started >= ?", start), ("sessions.started < ?", end)):
+            if value is not None:
+                conditions.append(condition)
+                args.append(value)
+
+        return ("WHERE " + " AND ".join(conditions)) if conditions else "", args
+
+    def sessions(self, **filters):
+        """Sessions matching the filters of filterClause, with their fit parameters
+        (None if not fit), oldest first.
+
+        Returns:
+            list of sqlite3.Row
+        """
+
+        where, args = self.filterClause(**filters)
+
+        return self.connection.execute(
+            f"""SELECT {SESSION_COLUMNS}, fits.peak_sensitivity, fits.peak_frequency, fits.width_l, fits.width_r
+                FROM sessions JOIN subjects ON subjects.id = sessions.subject_id
+                LEFT JOIN fits ON fits.session_id = sessions.id
+                {where} ORDER BY sessions.started, sessions.id""", args).fetchall()
+
+    def thresholds(self, **filters):
+        """Every measured sensitivity of the sessions matching the filters of filterClause.
+
+        Returns:
+            sessions (array): session id of every measurement
+            sfs (array): spatial frequency of every measurement (c/deg)
+            sensitivities (array): contrast sensitivity of every measurement
+        """
+
+        where, args = self.filterClause(**filters)
+        table = self.numericQuery(
+            f"""SELECT thresholds.session_id, thresholds.sf, thresholds.sensitivity
+                FROM thresholds JOIN sessions ON sessions.id = thresholds.session_id
+                JOIN subjects ON subjects.id = sessions.subject_id
+                {where} ORDER BY thresholds.session_id, thresholds.sf""", args, 3)
+
+        return table[:, 0].astype(np.int64), table[:, 1], table[:, 2]
+
+    def fitParameters(self, **filters):
+        """(N x 4) fit parameters of the fitted sessions matching the filters of filterClause."""
+
+        where, args = self.filterClause(**filters)
+
+        return self.numericQuery(
+            f"""SELECT fits.peak_sensitivity, fits.peak_frequency, fits.width_l, fits.width_r
+                FROM fits JOIN sessions ON sessions.id = fits.session_id
+                JOIN subjects ON subjects.id = sessions.subject_id
+                {where} ORDER BY sessions.started, sessions.id""", args, 4)
+
+    def numericQuery(self, query, args, num_columns):
+        """Run a query returning only numbers straight into a float64 array (plain
+        tuples are much faster to convert than sqlite3.Row objects)."""
+
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        values = np.fromiter((value for row in cursor.execute(query, args) for value in row), dtype = np.float64)
+
+        return values.reshape(-1, num_columns)
+
+    def sessionCount(self, name):
+        """Number of sessions recorded for subject (name)."""
+
+        return self.connection.execute("""SELECT COUNT(*) FROM sessions JOIN subjects ON subjects.id = sessions.subject_id
+                                          WHERE subjects.name = ?""", (name,)).fetchone()[0]
+
+    def importCSVTree(self, results_dir = "Results", fit = True):
+        """Import a Results/<name>/TestInfo.csv and TestResults.csv tree.
+
+        TestInfo rows are sessions and TestResults rows are the sensitivities of
+        the sessions that finished. A test quit part way through has an info row
+        but no results row, so the two are only matched in order when every
+        session has results, or when every session of the subject used the same
+        settings. Otherwise which session a result belongs to can't be told, and
+        the subject's sessions are imported without thresholds or fits. Start
+        times aren't recorded in the csv files and are left NULL.
+
+        The whole tree is imported in one transaction, so a bad file leaves the
+        store unchanged. Subjects already imported are skipped, so importing the
+        same tree again adds nothing.
+
+        Parameters:
+            results_dir (str): directory holding one sub-directory per subject
+            fit (bool): also fit and store the CSF parameters of every session
+
+        Returns:
+            num_sessions (int): number of sessions imported
+            unmatched (list of str): subjects whose results couldn't be matched to their sessions
+        """
+
+        num_sessions = 0
+        unmatched = []
+
+        with self.connection:
+            for name in sorted(os.listdir(results_dir)):
+                info_file = os.path.join(results_dir, name, "TestInfo.csv")
+                results_file = os.path.join(results_dir, name, "TestResults.csv")
+                if not os.path.isfile(info_file):
+                    continue
+
+                subject = self.subjectId(name)
+                if self.importedSubject(subject):
+                    continue
+                self.connection.execute("INSERT INTO csv_imports (subject_id) VALUES (?)", (subject,))
+
+                with open(info_file, 'r', newline='') as file:
+                    infos = [row for row in csv.reader(file) if row][1:]
+
+                sfs, results = (readTestResults(results_file) if os.path.isfile(results_file) else (np.empty(0), []))
+
+                if len(results) != len(infos) and len({tuple(info[1:7]) for info in infos}) > 1:
+                    unmatched.append(name)
+                    results = []
+
+                fits = fitSubject(name, sfs, results) if fit else []
+
+                for i, info in enumerate(infos):
+                    age, ethnicity, duration, size, eccentricity, distance = (info + [None]*7)[1:7]
+                    session = self.insertSession(name, int(age) if age else None, ethnicity, float(duration),
+                                                 float(size), float(eccentricity), float(distance), None, None)
+
+                    if i < len(results) and len(results[i]) == len(sfs):
+                        self.insertThresholds(session, sfs, results[i])
+                    if i < len(fits) and np.all(np.isfinite(fits[i][2:])):
+                        self.insertFit(session, fits[i][2:])
+
+                    num_sessions += 1
+
+        return num_sessions, unmatched
+
+    def importedSubject(self, subject):
+        """True if subject id (subject) was imported from csv files, including by versions
+        of importCSVTree that didn't record imports (their sessions have no start time)."""
+
+        return (self.connection.execute("SELECT 1 FROM csv_imports WHERE subject_id = ?", (subject,)).fetchone() is not None
+                or self.connection.execute("SELECT 1 FROM sessions WHERE subject_id = ? AND started IS NULL",
+                                           (subject,)).fetchone() is not None)
+
+    def close(self):
+        self.connection.close()
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description = "Import a Results directory of csv files into the results store.")
+    parser.add_argument("results_dir", nargs = "?", default = "Results",
+                        help = "directory containing <name>/TestInfo.csv and TestResults.csv files")
+    parser.add_argument("-o", "--output", default = None,
+                        help = "database file (default is <results_dir>/Results.db)")
+    parser.add_argument("--no-fit", action = "store_true", help = "don't fit the imported sessions")
+    args = parser.parse_args()
+
+    output_file = args.output or os.path.join(args.results_dir, "Results.db")
+    store = ResultsStore(output_file)
+    num_sessions, unmatched = store.importCSVTree(args.results_dir, fit = not args.no_fit)
+    store.close()
+
+    print(f"Imported {num_sessions} sessions into {output_file}")
+    if unmatched:
+        print(f"Results of {', '.join(unmatched)} don't match their test info and were imported without thresholds")
+
+
+if __name__ == "__main__":
+    main()
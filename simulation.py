@@ -0,0 +1,163 @@
+import numpy as np
+
+### Simulated Observers ###
+
+def weibullPsychometric(contrast, threshold, slope = 3.5, guess_rate = 0.25, lapse_rate = 0.02):
+    """Probability of a correct response for a simulated observer using a
+    Weibull psychometric function.
+
+    Parameters:
+        contrast (float or array): stimulus contrast [0-1]
+        threshold (float or array): observer contrast threshold [0-1]
+        slope (float): steepness of the psychometric function
+        guess_rate (float): chance performance (0.25 for 4 stimulus locations)
+        lapse_rate (float): probability of missing a clearly visible stimulus
+
+    Returns:
+        float or array: probability of a correct response
+    """
+
+    # Very steep functions overflow far above threshold, which correctly saturates to 1
+    with np.errstate(over = 'ignore'):
+        seen = 1 - np.exp(-(np.asarray(contrast)/threshold)**slope)
+
+    return guess_rate + (1 - guess_rate - lapse_rate)*seen
+
+
+### Vectorized Staircase Simulation ###
+
+def simulateStaircases(true_thresholds, num_observers = 10000, start_vals = (0.005, 0.8), nReversals = 7,
+                       scale = "log", slope = 3.5, guess_rate = 0.25, lapse_rate = 0.02,
+                       max_trials = 1000, seed = None):
+    """Run many simulated observers through interleaved reversal staircases
+    at once, following the same rules as singleStaircaseController and
+    multiStaircaseController.
+
+    Every observer owns one staircase per start value. On each trial one of
+    the observer's still-running staircases is picked at random, the observer
+    responds stochastically according to weibullPsychometric, and the staircase
+    is stepped. All observers are advanced together as NumPy arrays.
+
+    Parameters:
+        true_thresholds (float or array): contrast threshold of every observer
+            (scalar or array of length num_observers)
+        num_observers (int): number of simulated observers
+        start_vals (list or array): starting contrast of each interleaved staircase, shared by
+            every observer or (num_observers x staircases) for observer specific start values
+        nReversals (int): number of reversals before a staircase ends
+        scale (str): 'log' or 'linear' step sizes
+        slope, guess_rate, lapse_rate (float): psychometric function parameters
+        max_trials (int): give up on an observer after this many trials
+        seed (int): random seed (default is None)
+
+    Returns:
+        dict: 'thresholds' (true threshold per observer), 'estimates' (mean of the
+        staircase results, NaN if the observer hit max_trials), 'staircase_results'
+        (observers x staircases), 'trials' (total trials per observer) and
+        'staircase_trials' (observers x staircases)
+    """
+
+    rng = np.random.default_rng(seed)
+    start_vals = np.asarray(start_vals, dtype = np.float64)
+    num_staircases = start_vals.shape[-1]
+    thresholds = np.broadcast_to(np.asarray(true_thresholds, dtype = np.float64), (num_observers,))
+
+    if "log" in scale:
+        step_sizes = np.logspace(0.3, 0.0075, nReversals)
+    else:
+        step_sizes = np.linspace(0.5, 0.0015, nReversals)
+
+    # Staircase state, one row per observer and one column per staircase
+    shape = (num_observers, num_staircases)
+    value = np.broadcast_to(start_vals, shape).copy()
+    num_wrong = np.zeros(shape, dtype = np.int64)
+    num_reversals = np.zeros(shape, dtype = np.int64)
+    previous = np.full(shape, -1, dtype = np.int8)
+    over = np.zeros(shape, dtype = bool)
+    result = np.full(shape, np.nan)
+    reversal_values = np.zeros(shape + (nReversals,))
+    staircase_trials = np.zeros(shape, dtype = np.int64)
+
+    for trial in range(max_trials):
+
+        rows = np.flatnonzero(~over.all(axis = 1))
+        if not len(rows):
+            break
+
+        # Pick one running staircase per observer, uniformly at random
+        active = ~over[rows]
+        pick = (rng.random(len(rows))*active.sum(axis = 1)).astype(np.int64)
+        cols = np.argmax(np.cumsum(active, axis = 1) > pick[:, np.newaxis], axis = 1)
+
+        contrast = value[rows, cols]
+        correct = rng.random(len(rows)) < weibullPsychometric(contrast, thresholds[rows], slope,
+                                                               guess_rate, lapse_rate)
+        staircase_trials[rows, cols] += 1
+
+        # Too many misses at high contrast ends the staircase at full contrast
+        wrong = np.where(correct, 0, num_wrong[rows, cols] + 1)
+        num_wrong[rows, cols] = wrong
+        gave_up = (wrong > 9) & (contrast > 0.8)
+
+        # A reversal is any change of answer after the first trial
+        last = previous[rows, cols]
+        is_reversal = (last >= 0) & (last != correct) & ~gave_up
+        count = num_reversals[rows, cols] + is_reversal
+        num_reversals[rows, cols] = count
+        previous[rows, cols] = correct
+
+        # Finished staircases drop the first two reversals and average the rest
+        finished = ~gave_up & (count >= nReversals + 1)
+        result[rows[gave_up], cols[gave_up]] = 1.0
+        result[rows[finished], cols[finished]] = reversal_values[rows[finished], cols[finished], 2:].mean(axis = 1)
+        over[rows, cols] |= gave_up | finished
+
+        running = ~(gave_up | finished)
+        store = running & is_reversal
+        reversal_values[rows[store], cols[store], count[store] - 1] = contrast[store]
+
+        step = step_sizes[np.minimum(count, nReversals - 1)]
+        if "log" in scale:
+            new_value = np.where(correct, contrast/step, np.minimum(contrast*step, 1.0))
+        else:
+            new_value = np.where(correct, np.maximum(contrast - step, 0), np.minimum(contrast + step, 1.0))
+
+        value[rows[running], cols[running]] = new_value[running]
+
+    estimates = np.where(over.all(axis = 1), np.mean(result, axis = 1), np.nan)
+
+    return {"thresholds": np.array(thresholds),
+            "estimates": estimates,
+            "staircase_results": result,
+            "trials": staircase_trials.sum(axis = 1),
+            "staircase_trials": staircase_trials}
+
+
+def summarizeSimulation(simulation, percentiles = (5, 25, 50, 75, 95)):
+    """Summarize the accuracy and cost of a staircase simulation.
+
+    Parameters:
+        simulation (dict): output of simulateStaircases
+        percentiles (list): trial count percentiles to report
+
+    Returns:
+        dict: bias and variance of the threshold estimates (in linear and
+        log10 units), number of unfinished observers and trial count statistics
+    """
+
+    done = np.isfinite(simulation["estimates"])
+    estimates = simulation["estimates"][done]
+    thresholds = simulation["thresholds"][done]
+    trials = simulation["trials"]
+
+    error = estimates - thresholds
+    log_error = np.log10(estimates) - np.log10(thresholds)
+
+    return {"bias": np.mean(error),
+            "variance": np.var(error),
+            "log_bias": np.mean(log_error),
+            "log_variance": np.var(log_error),
+            "rmse": np.sqrt(np.mean(error**2)),
+            "unfinished": int(np.count_nonzero(~done)),
+            "mean_trials": np.mean(trials),
+            "trial_percentiles": dict(zip(percentiles, np.percentile(trials, percentiles)))}
@@ -0,0 +1,193 @@
+import ctypes
+import os
+import numpy as np
+from OpenGL import GL
+from corefunctions import makeWindowedGrating, pack10BitSigned
+
+### Memory-Mapped Stimulus Library ###
+
+STIMULUS_LIBRARY_FILE = os.path.join("Cache", "StimulusBank.bin")
+STIMULUS_LIBRARY_MAGIC = b"CSFSTIM1"
+STIMULUS_LIBRARY_VERSION = 1
+
+# The file starts with a fixed size header, followed by the packed uint32 stimuli
+# and an index with one record per stimulus, which the header points to
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("num_entries", "<u4"), ("index_offset", "<u8")])
+INDEX_DTYPE = np.dtype([("size", "<u4"), ("wave", "<u4"), ("sf", "<f8"), ("ori", "<f8"), ("phase", "<f8"),
+                        ("contrast", "<f8"), ("offset", "<u8")])
+WAVES = ["sin", "sqr"]
+
+
+def makePackedGrating(size, sf, contrast = 1.0, ori = 0, phase = 0, wave = 'sin'):
+    """Windowed grating (see makeWindowedGrating) scaled by (contrast) and packed with
+    pack10BitSigned, the layer format of a GLStimulusBank (which uses contrast 1)."""
+
+    grating = makeWindowedGrating(size, sf, ori, phase, wave)
+
+    return pack10BitSigned(grating if contrast == 1 else contrast*grating)
+
+
+class StimulusLibrary:
+    """Persistent library of packed 10-bit stimuli (see makePackedGrating) keyed by
+    (size_px, sf, ori, phase, contrast, wave).
+
+    The library file is memory mapped read-only, so opening it costs nothing and
+    a stimulus only occupies memory once its pages are touched. get returns a
+    view straight into the mapping, which can be passed to glTexImage2D or
+    glTexSubImage2D without a copy. Missing stimuli are generated once and
+    appended to the file (see append); only one process should add to a
+    library at a time.
+    """
+
+    def __init__(self, filename = STIMULUS_LIBRARY_FILE, generator = makePackedGrating):
+        """
+        Parameters:
+            filename (str): library file, created if it doesn't exist
+            generator (function): called as generator(size, sf = sf, contrast = contrast,
+                ori = ori, phase = phase, wave = wave) to build missing stimuli
+        """
+
+        self.filename = filename
+        self.generator = generator
+
+        if not os.path.isfile(filename):
+            self.create()
+
+        self.load()
+
+    def create(self):
+        """Write an empty library."""
+
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.filename, 'wb') as file:
+            self.writeHeader(file, 0, HEADER_SIZE)
+
+    def writeHeader(self, file, num_entries, index_offset):
+        header = np.zeros(1, dtype = HEADER_DTYPE)
+        header[0] = (STIMULUS_LIBRARY_MAGIC, STIMULUS_LIBRARY_VERSION, num_entries, index_offset)
+
+        file.seek(0)
+        file.write(header.tobytes().ljust(HEADER_SIZE, b"\0"))
+
+    def load(self):
+        """Map the library file and read its index."""
+
+        header = np.fromfile(self.filename, dtype = HEADER_DTYPE, count = 1)
+
+        if len(header) == 0 or header[0]["magic"] != STIMULUS_LIBRARY_MAGIC:
+            raise ValueError(f"{self.filename} is not a stimulus library")
+        if header[0]["version"] != STIMULUS_LIBRARY_VERSION:
+            raise ValueError(f"{self.filename} has unsupported version {header[0]['version']}")
+
+        self.index_offset = int(header[0]["index_offset"])
+        self.index = np.fromfile(self.filename, dtype = INDEX_DTYPE, count = int(header[0]["num_entries"]),
+                                 offset = self.index_offset)
+        self.entries = {self.key(*record[["size", "sf", "ori", "phase", "contrast"]], WAVES[record["wave"]]): i
+                        for i, record in enumerate(self.index)}
+
+        self.map = np.memmap(self.filename, dtype = np.uint8, mode = 'r')
+
+    def key(self, size, sf, ori, phase, contrast, wave = 'sin'):
+        return (int(size), round(float(sf), 6), round(float(ori) % 360, 6), round(float(phase) % 360, 6),
+                round(float(contrast), 6), wave)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return self.key(*key) in self.entries
+
+    def view(self, entry):
+        """Read-only (size x size) uint32 view of index entry (entry) in the mapping."""
+
+        record = self.index[entry]
+        size = int(record["size"])
+        offset = int(record["offset"])
+
+        return self.map[offset:offset + 4*size*size].view(np.uint32).reshape(size, size)
+
+    def get(self, size, sf, ori, phase, contrast, wave = 'sin'):
+        """Stimulus with the given key, generated and added to the library if needed.
+
+        Returns:
+            numpy array: read-only (size x size) uint32 view into the library file
+        """
+
+        return self.getMany([(size, sf, ori, phase, contrast, wave)])[0]
+
+    def getMany(self, keys):
+        """Stimuli for a list of (size, sf, ori, phase, contrast, wave) keys. Every
+        missing stimulus is generated first and appended in a single write."""
+
+        # Lookups use the rounded keys, but missing stimuli are generated from the full precision values
+        keys = [tuple(key) + ('sin',)*(6 - len(key)) for key in keys]
+        rounded = [self.key(*key) for key in keys]
+        missing = list({rounded_key: key for rounded_key, key in zip(rounded, keys) if rounded_key not in self.entries}.values())
+
+        if missing:
+            self.append(missing)
+
+        return [self.view(self.entries[key]) for key in rounded]
+
+    def append(self, keys):
+        """Generate the stimuli for (keys) and append them to the library file.
+
+        The new stimuli and a new copy of the whole index are written past the
+        end of the file and flushed to disk before the header is switched to the
+        new index, so a crash part way through leaves the library as it was.
+        The file is never truncated (the old index is left as unused space), so
+        this also works on Windows while views into the mapping are alive.
+        """
+
+        records = np.zeros(len(keys), dtype = INDEX_DTYPE)
+
+        with open(self.filename, 'r+b') as file:
+            # Stimuli start 8 byte aligned, so every view into the mapping is aligned
+            offset = -(-file.seek(0, os.SEEK_END)//8)*8
+            file.seek(offset)
+
+            for i, (size, sf, ori, phase, contrast, wave) in enumerate(keys):
+                size = int(size)
+                stim = self.generator(size, sf = sf, contrast = contrast, ori = ori, phase = phase, wave = wave)
+                stim = np.ascontiguousarray(stim, dtype = "<u4")
+                if stim.shape != (size, size):
+                    raise ValueError(f"Generated stimulus has shape {stim.shape}, expected {(size, size)}")
+
+                file.write(stim.tobytes())
+                records[i] = (size, WAVES.index(wave), sf, ori, phase, contrast, offset)
+                offset += stim.nbytes
+
+            index = np.concatenate([self.index, records])
+            file.write(index.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+            self.writeHeader(file, len(index), offset)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.load()
+
+    def genTexture(self, size, sf, ori, phase, contrast, wave = 'sin'):
+        """Create a GL_RGB10_A2 texture holding a stimulus, uploaded straight from the mapping."""
+
+        pixels = self.get(size, sf, ori, phase, contrast, wave)
+
+        texture = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(texture))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB10_A2, size, size, 0,
+                        GL.GL_RGBA, GL.GL_UNSIGNED_INT_2_10_10_10_REV, pixels)
+
+        return texture
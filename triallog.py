@@ -0,0 +1,102 @@
+import csv
+import os
+import queue
+import threading
+
+### Trial-Level Event Log ###
+
+TRIAL_LOG_HEADER = ["Trial", "SF", "Location", "Orientation", "Phase", "Contrast", "Response", "Correct",
+                    "Staircase", "Onset Frame", "Response Time (ns)", "Reaction Time (ms)", "Exposure (ms)"]
+
+
+class TrialLog:
+    """Records every trial of a test to a csv file without touching the disk
+    from the GUI thread.
+
+    record puts a row on a queue.SimpleQueue (a lock-free put in CPython) and
+    returns immediately. A background writer thread takes rows off the queue,
+    batching everything that has arrived into one write and flush, so rows
+    reach the disk within (flush_interval) seconds of being recorded.
+    """
+
+    def __init__(self, filename, flush_interval = 0.5):
+        """
+        Parameters:
+            filename (str): csv file to append trials to (the header is written if it is new)
+            flush_interval (float): longest time in seconds a row waits before being written
+        """
+
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.num_trials = 0
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.writer = threading.Thread(target = self.writeLoop, name = "TrialLogWriter", daemon = True)
+        self.writer.start()
+
+    def record(self, sf, location, orientation, phase, contrast, response, correct, staircase,
+               onset_frame, response_time, reaction_time, exposure):
+        """Queue one trial. Safe to call from the GUI thread: it never blocks on I/O.
+
+        Parameters:
+            sf (float): spatial frequency (c/deg)
+            location (int): stimulus location (0 = top, 1 = right, 2 = bottom, 3 = left)
+            orientation, phase (float): grating orientation and phase (degrees)
+            contrast (float): stimulus contrast [0-1]
+            response (int or None): location reported by the subject (None if not seen)
+            correct (int): 1 if the response matched the location, 0 otherwise
+            staircase (int or None): staircase that chose the contrast (None for qCSF)
+            onset_frame (int): frame number of the first frame showing the stimulus
+            response_time (int): time.perf_counter_ns() of the key press
+            reaction_time (float): time from the stimulus onset swap to the key press in ms (NaN if unknown)
+            exposure (float): time the stimulus was on screen, from its onset to its offset swap in ms (NaN if unknown)
+        """
+
+        self.queue.put([self.num_trials, sf, location, orientation, phase, contrast,
+                        "" if response is None else response, correct,
+                        "" if staircase is None else staircase, onset_frame, response_time,
+                        f"{reaction_time:.3f}", f"{exposure:.3f}"])
+        self.num_trials += 1
+
+    def writeLoop(self):
+        """Writer thread: append queued rows in batches until close puts None on the queue."""
+
+        new_file = not os.path.isfile(self.filename)
+
+        with open(self.filename, 'a', newline='') as file:
+            csv_writer = csv.writer(file)
+            if new_file:
+                csv_writer.writerow(TRIAL_LOG_HEADER)
+                file.flush()
+
+            running = True
+            while running:
+                try:
+                    rows = [self.queue.get(timeout = self.flush_interval)]
+                except queue.Empty:
+                    continue
+
+                # Take everything else already waiting so it goes out in one write
+                while True:
+                    try:
+                        rows.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                if rows[-1] is None:
+                    running = False
+                    rows.pop()
+
+                csv_writer.writerows(rows)
+                file.flush()
+
+    def close(self):
+        """Write any queued trials and stop the writer thread."""
+
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()